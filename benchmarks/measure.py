@@ -0,0 +1,29 @@
+"""
+This script runs another Python script and saves its peak memory usage to a json file.
+The peak is read from VmHWM, which (unlike ru_maxrss) doesn't include the memory of the
+process that launched the script
+
+Usage: python measure.py <out_file> <script> [script arguments]
+"""
+
+import json
+import os
+import runpy
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from instrumentation import peak_rss_mb  # noqa: E402
+
+
+if __name__ == '__main__':
+    out_file, script = sys.argv[1], sys.argv[2]
+    sys.argv = sys.argv[2:]
+    # Match the import path the script would have if it were run directly
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+
+    try:
+        runpy.run_path(script, run_name='__main__')
+    finally:
+        with open(out_file, 'w') as measure_file:
+            json.dump({'peak_rss_mb': peak_rss_mb()}, measure_file)
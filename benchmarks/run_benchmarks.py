@@ -0,0 +1,274 @@
+"""
+This script times each pipeline stage on synthetic data (see synthetic.py) at several scales,
+recording the wall time, CPU time, and peak memory of every run in a json file so the results
+can be compared between commits
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import synthetic
+# synthetic adds src/ to the import path
+import mousiplier
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+SRC_DIR = os.path.join(REPO_DIR, 'src')
+MEASURE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'measure.py')
+
+# The sizes of the synthetic inputs at each scale
+SCALES = {
+    'small': {'samples': 200, 'genes': 2000, 'pathways': 100, 'studies': 20, 'lvs': 50},
+    'medium': {'samples': 2000, 'genes': 10000, 'pathways': 500, 'studies': 100, 'lvs': 200},
+    'large': {'samples': 10000, 'genes': 20000, 'pathways': 1500, 'studies': 500, 'lvs': 1000},
+}
+# The number of components to calculate in the PCA stage
+N_COMPONENTS = 10
+
+
+def generate_inputs(work_dir: str, scale: Dict[str, int], seed: int) -> None:
+    """
+    Write every synthetic input used by the benchmarks to work_dir
+
+    Arguments
+    ---------
+    work_dir: The directory to write the inputs to. The layout matches the pipeline's data/
+              directory so scripts with hard-coded paths can run from work_dir
+    scale: The sizes of the inputs, as in SCALES
+    seed: The seed for the random number generator
+    """
+    rng = np.random.default_rng(seed)
+    data_dir = os.path.join(work_dir, 'data')
+    os.makedirs(os.path.join(data_dir, 'markers'), exist_ok=True)
+    os.makedirs(os.path.join(work_dir, 'pcs'), exist_ok=True)
+
+    synthetic.write_ensembl_mapping(os.path.join(data_dir, 'ensembl_mapping.tsv'),
+                                    scale['genes'], rng)
+    synthetic.write_counts(os.path.join(data_dir, 'sra_counts.tsv'), scale['samples'],
+                           scale['genes'], rng)
+    synthetic.write_metadata(os.path.join(data_dir, 'recount_metadata.tsv'), scale['samples'],
+                             scale['studies'], rng)
+    synthetic.write_holdout_samples(os.path.join(data_dir, 'holdout_samples.txt'),
+                                    scale['samples'], scale['samples'] // 20, rng)
+    synthetic.write_gene_lengths(os.path.join(data_dir, 'gene_lengths.tsv'), scale['genes'], rng)
+    synthetic.write_reactome(data_dir, scale['pathways'], scale['genes'], rng)
+    synthetic.write_cell_markers(os.path.join(data_dir, 'Mouse_cell_markers.txt'),
+                                 scale['pathways'] // 2, scale['genes'], rng)
+    synthetic.write_marker_genes(os.path.join(data_dir, 'markers'), scale['genes'], rng)
+    genes = synthetic.write_pathway_matrix(os.path.join(data_dir, 'plier_pathways.tsv'),
+                                           scale['genes'], scale['pathways'], rng)
+    synthetic.write_expression(os.path.join(data_dir, 'no_scrna_rpkm.tsv'), scale['samples'],
+                               genes, rng)
+    synthetic.write_plier_model(data_dir, genes, scale['lvs'], rng)
+    synthetic.write_lv_table(os.path.join(data_dir, 'LVs.tsv'), scale['samples'], scale['lvs'],
+                             rng)
+
+
+def stage_commands(work_dir: str) -> Dict[str, List[str]]:
+    """
+    Get the command that runs each stage on the inputs in work_dir
+
+    Arguments
+    ---------
+    work_dir: The directory the inputs were generated in
+
+    Returns
+    -------
+    commands: A dict mapping stage names to commands, in the order the pipeline runs them
+    """
+    def data(name):
+        return os.path.join(work_dir, 'data', name)
+
+    def script(name):
+        return [sys.executable, os.path.join(SRC_DIR, name)]
+
+    return {
+        '1b_remove_scrnaseq': script('1b_remove_scrnaseq.py') + [
+            data('sra_counts.tsv'), data('recount_metadata.tsv'), data('no_scrna_counts.tsv')],
+        '1c_remove_test_studies': script('1c_remove_test_studies.py') + [
+            data('sra_counts.tsv'), data('no_scrna_filtered.tsv'), data('holdout_samples.txt')],
+        '2_create_pathway_graph': script('2_create_pathway_graph.py') + [
+            '--pathway_file', data('ReactomePathways.txt'),
+            '--pathway_relation_file', data('ReactomePathwaysRelation.txt'),
+            '--ensembl_to_pathway_file', data('Ensembl2Reactome_All_Levels.txt'),
+            '--cell_type_marker_file', data('Mouse_cell_markers.txt'),
+            '--out_file', data('created_pathways.tsv')],
+        # 2.5 writes to data/extended_plier_pathways.tsv relative to the working directory
+        '2.5_add_brain_markers': script('2.5_add_brain_markers.py') + [
+            '--pathway_file', data('plier_pathways.tsv'),
+            '--marker_files', data('markers/cerebral_cortex.txt'), data('markers/midbrain.txt'),
+            data('markers/striatum.txt')],
+        '3_preprocess_expression': script('3_preprocess_expression.py') + [
+            data('sra_counts.tsv'), data('gene_lengths.tsv'), data('plier_pathways.tsv'),
+            data('rpkm.tsv')],
+        '5_calculate_pcs': script('5_calculate_pcs.py') + [
+            data('no_scrna_rpkm.tsv'), os.path.join(work_dir, 'pcs'),
+            '--n_components', str(N_COMPONENTS)],
+        'transform': script('10_NAc_PFC_VTA_transform.py') + [
+            data('Z.tsv'), data('lambda.txt'), data('no_scrna_rpkm.tsv'),
+            data('transformed_LVs.tsv')],
+        '10a_select_lvs': script('10a_select_lvs.py') + [
+            data('LVs.tsv'), data('selected_LVs.tsv')],
+        '11_reformat_LVs': script('11_reformat_LVs.py') + [
+            data('LVs.tsv'), data('reformatted_LVs.tsv')],
+    }
+
+
+def cold_start_commands() -> Dict[str, List[str]]:
+    """
+    Get commands that measure the startup time of each mousiplier subcommand. Each one
+    prints the subcommand's help, so the time is spent starting Python and importing the
+    libraries the subcommand needs
+
+    Returns
+    -------
+    commands: A dict mapping subcommand names to commands
+    """
+    entry_point = os.path.join(SRC_DIR, 'mousiplier.py')
+    return {name: [sys.executable, entry_point, name, '--help'] for name in mousiplier.COMMANDS}
+
+
+def run_stage(command: List[str], work_dir: str, log_path: str) -> Dict[str, float]:
+    """
+    Run a command, measuring its wall time, CPU time, and peak memory
+
+    Arguments
+    ---------
+    command: The command to run
+    work_dir: The directory to run the command in
+    log_path: The file to save the command's output to
+
+    Returns
+    -------
+    measurements: The wall and CPU seconds, the peak resident memory in MB, and the exit code
+    """
+    env = dict(os.environ)
+    env['ENSEMBL_MAPPING_FILE'] = os.path.join(work_dir, 'data', 'ensembl_mapping.tsv')
+    measure_path = log_path + '.json'
+    # The script is run through measure.py, which records its peak memory
+    command = [command[0], MEASURE_SCRIPT, measure_path] + command[1:]
+
+    with open(log_path, 'w') as log_file:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=work_dir, env=env, stdout=log_file,
+                                   stderr=subprocess.STDOUT)
+        # wait4 gets the resource usage of this child alone
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_seconds = time.perf_counter() - start
+    if os.WIFEXITED(status):
+        process.returncode = os.WEXITSTATUS(status)
+    else:
+        process.returncode = -os.WTERMSIG(status)
+
+    peak_rss_mb = None
+    if os.path.exists(measure_path):
+        with open(measure_path) as measure_file:
+            peak_rss_mb = json.load(measure_file)['peak_rss_mb']
+
+    return {'wall_seconds': wall_seconds,
+            'cpu_seconds': usage.ru_utime + usage.ru_stime,
+            'peak_rss_mb': peak_rss_mb,
+            'returncode': process.returncode}
+
+
+def git_commit() -> Optional[str]:
+    """Get the commit the benchmarks are running on, if the repo is a git checkout"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results: List[Dict], baseline: List[Dict]) -> None:
+    """Print the ratio of each measurement to the same stage and scale in a baseline run"""
+    baseline_runs = {(run['stage'], run['scale']): run for run in baseline}
+    print('{:<26}{:<8}{:>12}{:>12}'.format('stage', 'scale', 'time ratio', 'mem ratio'))
+    for run in results:
+        old_run = baseline_runs.get((run['stage'], run['scale']))
+        if old_run is None:
+            continue
+        memory_ratio = float('nan')
+        if run['peak_rss_mb'] is not None and old_run['peak_rss_mb'] is not None:
+            memory_ratio = run['peak_rss_mb'] / old_run['peak_rss_mb']
+        print('{:<26}{:<8}{:>12.2f}{:>12.2f}'.format(
+              run['stage'], run['scale'], run['wall_seconds'] / old_run['wall_seconds'],
+              memory_ratio))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('out_file', help='The json file to save the results to')
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'],
+                        choices=list(SCALES), help='The input sizes to benchmark')
+    parser.add_argument('--stages', nargs='+',
+                        help='The stages to benchmark. Defaults to all stages')
+    parser.add_argument('--repeats', default=1, type=int,
+                        help='The number of times to run each stage')
+    parser.add_argument('--seed', default=42, type=int,
+                        help='The seed used to generate the synthetic data')
+    parser.add_argument('--work_dir',
+                        help='The directory to generate data in. Defaults to a temporary '
+                             'directory that is deleted afterwards')
+    parser.add_argument('--baseline',
+                        help='A results file from an earlier run to compare against')
+    parser.add_argument('--cold_start', action='store_true',
+                        help='Also measure the startup time of every mousiplier subcommand')
+    args = parser.parse_args()
+
+    results = []
+    for scale_name in args.scales:
+        with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+            print('Generating {} inputs'.format(scale_name))
+            generate_inputs(work_dir, SCALES[scale_name], args.seed)
+
+            commands = stage_commands(work_dir)
+            stages = args.stages if args.stages is not None else list(commands)
+            for stage in stages:
+                for repeat in range(args.repeats):
+                    log_path = os.path.join(work_dir, '{}.log'.format(stage))
+                    run = run_stage(commands[stage], work_dir, log_path)
+                    run.update({'stage': stage, 'scale': scale_name, 'repeat': repeat})
+                    run.update(SCALES[scale_name])
+                    results.append(run)
+
+                    print('{} ({}): {:.2f}s, {:.0f} MB'.format(stage, scale_name,
+                                                               run['wall_seconds'],
+                                                               run['peak_rss_mb'] or 0))
+                    if run['returncode'] != 0:
+                        with open(log_path) as log_file:
+                            print(log_file.read()[-2000:])
+
+    if args.cold_start:
+        with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+            for name, command in cold_start_commands().items():
+                for repeat in range(args.repeats):
+                    log_path = os.path.join(work_dir, '{}.log'.format(name))
+                    run = run_stage(command, work_dir, log_path)
+                    run.update({'stage': name, 'scale': 'cold_start', 'repeat': repeat})
+                    results.append(run)
+
+                    print('{} (cold start): {:.2f}s, {:.0f} MB'.format(name, run['wall_seconds'],
+                                                                      run['peak_rss_mb'] or 0))
+
+    report = {'commit': git_commit(),
+              'timestamp': datetime.datetime.now().isoformat(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'cpu_count': os.cpu_count(),
+              'results': results}
+    with open(args.out_file, 'w') as out_file:
+        json.dump(report, out_file, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as in_file:
+            compare_results(results, json.load(in_file)['results'])
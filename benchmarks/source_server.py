@@ -0,0 +1,220 @@
+"""
+This script is a local stand-in for the Reactome and CellMarker servers, used to check that
+src/fetch_sources.py resumes interrupted downloads and skips unchanged files. It serves the
+files in a directory with ETag and Last-Modified headers, answers If-None-Match and
+If-Modified-Since with 304, and answers Range requests with 206 unless If-Range shows the file
+changed. It can also drop the connection partway through the first download of each file.
+
+`python benchmarks/source_server.py serve <dir> --port 8000 --drop_after 100000` serves a
+directory for `python src/fetch_sources.py <out_dir> --base_url http://localhost:8000`, and
+`python benchmarks/source_server.py check` runs fetch_sources.py against it and checks that
+dropped downloads are resumed, unchanged files get a 304, and changed files are updated
+"""
+
+import argparse
+import asyncio
+import email.utils
+import hashlib
+import http.server
+import os
+import sys
+import tempfile
+import threading
+from typing import Dict, Optional, Set, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from fetch_sources import fetch_sources  # noqa: E402
+
+# The size of the files the check serves
+CHECK_FILE_BYTES = 3 * 2 ** 20
+# The check drops each file's first download after this many bytes
+CHECK_DROP_AFTER = 2 ** 20
+
+
+class SourceServer(http.server.ThreadingHTTPServer):
+    def __init__(self, directory: str, port: int = 0, drop_after: Optional[int] = None):
+        """
+        An HTTP server for the files in a directory that supports conditional and range
+        requests
+
+        Arguments
+        ---------
+        directory: The directory to serve
+        port: The port to listen on, or 0 for any free port
+        drop_after: If given, the first full download of each file is cut off after this many
+                    bytes
+        """
+        super().__init__(('localhost', port), SourceHandler)
+        self.directory = directory
+        self.drop_after = drop_after
+        self.dropped: Set[str] = set()
+        # The number of responses sent with each status code
+        self.statuses: Dict[int, int] = {}
+        self.lock = threading.Lock()
+
+    def record(self, status: int) -> None:
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    @property
+    def url(self) -> str:
+        return 'http://localhost:{}'.format(self.server_address[1])
+
+
+class SourceHandler(http.server.BaseHTTPRequestHandler):
+    server: SourceServer
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def _validators(self, path: str) -> Tuple[str, str]:
+        """Get the ETag and Last-Modified date of a file"""
+        with open(path, 'rb') as in_file:
+            etag = '"{}"'.format(hashlib.sha256(in_file.read()).hexdigest()[:16])
+        last_modified = email.utils.formatdate(os.path.getmtime(path), usegmt=True)
+        return etag, last_modified
+
+    def _send(self, status: int, headers: Dict[str, str]) -> None:
+        self.server.record(status)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def do_GET(self) -> None:
+        name = os.path.basename(self.path)
+        path = os.path.join(self.server.directory, name)
+        if not os.path.isfile(path):
+            self._send(404, {'Content-Length': '0'})
+            return
+
+        etag, last_modified = self._validators(path)
+        validators = {'ETag': etag, 'Last-Modified': last_modified}
+        # If-Modified-Since is only used when there's no If-None-Match, as in RFC 9110
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            not_modified = if_none_match == etag
+        else:
+            not_modified = self.headers.get('If-Modified-Since') == last_modified
+        if not_modified:
+            self._send(304, validators)
+            return
+
+        with open(path, 'rb') as in_file:
+            data = in_file.read()
+
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header is not None and if_range in (None, etag, last_modified):
+            start = int(range_header.split('=')[1].split('-')[0])
+            if start >= len(data):
+                self._send(416, {'Content-Range': 'bytes */{}'.format(len(data))})
+                return
+            self._send(206, dict(validators, **{
+                'Content-Length': str(len(data) - start),
+                'Content-Range': 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data))}))
+            self.wfile.write(data[start:])
+            return
+
+        self._send(200, dict(validators, **{'Content-Length': str(len(data))}))
+        drop_after = self.server.drop_after
+        with self.server.lock:
+            drop = drop_after is not None and name not in self.server.dropped
+            if drop:
+                self.server.dropped.add(name)
+        if drop:
+            # Promise the whole file but close the connection partway through it
+            self.wfile.write(data[:drop_after])
+            self.close_connection = True
+            return
+        self.wfile.write(data)
+
+
+def fetch(server: SourceServer, names, out_dir: str) -> Dict[str, Dict]:
+    """Download files from the server with fetch_sources.py and return their manifest"""
+    sources = {name: server.url + '/' + name for name in names}
+    return asyncio.run(fetch_sources(sources, out_dir, os.path.join(out_dir, 'manifest.json'),
+                                     retries=2, timeout=10))
+
+
+def check(condition: bool, message: str) -> None:
+    """Print whether a check passed, and stop at the first one that fails"""
+    print('{}: {}'.format('ok' if condition else 'FAILED', message))
+    if not condition:
+        sys.exit(1)
+
+
+def files_match(source_dir: str, out_dir: str, names) -> bool:
+    """Check whether the downloaded files are identical to the served ones"""
+    for name in names:
+        with open(os.path.join(source_dir, name), 'rb') as source, \
+                open(os.path.join(out_dir, name), 'rb') as downloaded:
+            if source.read() != downloaded.read():
+                return False
+    return True
+
+
+def run_check() -> None:
+    """Check that fetch_sources.py resumes, skips unchanged files, and updates changed ones"""
+    rng = np.random.default_rng(42)
+    names = ['Ensembl2Reactome_All_Levels.txt', 'ReactomePathways.txt']
+    with tempfile.TemporaryDirectory() as source_dir, tempfile.TemporaryDirectory() as out_dir:
+        for name in names:
+            with open(os.path.join(source_dir, name), 'wb') as out_file:
+                out_file.write(rng.bytes(CHECK_FILE_BYTES))
+
+        server = SourceServer(source_dir, drop_after=CHECK_DROP_AFTER)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            manifest = fetch(server, names, out_dir)
+            check(files_match(source_dir, out_dir, names),
+                  'downloads cut off after {} bytes are complete'.format(CHECK_DROP_AFTER))
+            check(server.statuses.get(206, 0) == len(names),
+                  'each cut off download was resumed with a range request')
+            check(all(manifest[name]['status'] == 'updated' for name in names),
+                  'new files are reported as updated')
+
+            mtimes = {name: os.path.getmtime(os.path.join(out_dir, name)) for name in names}
+            server.statuses.clear()
+            manifest = fetch(server, names, out_dir)
+            check(server.statuses == {304: len(names)},
+                  'unchanged files are skipped with a 304 response')
+            check(all(manifest[name]['status'] == 'unchanged' for name in names) and
+                  all(os.path.getmtime(os.path.join(out_dir, name)) == mtimes[name]
+                      for name in names),
+                  'unchanged files are left alone')
+
+            with open(os.path.join(source_dir, names[0]), 'ab') as out_file:
+                out_file.write(b'new pathways\n')
+            manifest = fetch(server, names, out_dir)
+            check(files_match(source_dir, out_dir, names) and
+                  manifest[names[0]]['status'] == 'updated' and
+                  manifest[names[1]]['status'] == 'unchanged',
+                  'changed files are downloaded again')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='Serve a directory of source files')
+    serve_parser.add_argument('directory', help='The directory of files to serve')
+    serve_parser.add_argument('--port', default=8000, type=int, help='The port to listen on')
+    serve_parser.add_argument('--drop_after', type=int,
+                              help='Cut off the first download of each file after this many '
+                                   'bytes')
+    subparsers.add_parser('check', help='Check fetch_sources.py against a local server')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = SourceServer(args.directory, args.port, args.drop_after)
+        print('Serving {} at {}'.format(args.directory, server.url))
+        server.serve_forever()
+    else:
+        run_check()
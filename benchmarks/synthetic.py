@@ -0,0 +1,262 @@
+"""
+This file generates synthetic versions of each input to the pipeline, written in the same
+formats as the real files from recount3, Reactome, BioMart, and CellMarker, so the pipeline's
+performance can be measured offline at any scale
+"""
+
+import csv
+import importlib
+import os
+import sys
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+# The fraction of genes BioMart has no symbol for
+UNMAPPED_FRACTION = .05
+# The fraction of genes EDASeq has no length for
+MISSING_LENGTH_FRACTION = .02
+# The fraction of samples that are single-cell, and so are removed by 1b_remove_scrnaseq.py
+SCRNA_FRACTION = .05
+
+
+def gene_ids(n_genes: int) -> List[str]:
+    """Make Ensembl gene ids without version numbers"""
+    return ['ENSMUSG{:011d}'.format(i) for i in range(n_genes)]
+
+
+def gene_symbols(n_genes: int) -> List[str]:
+    """Make the gene symbols matching `gene_ids`"""
+    return ['Gene{}'.format(i) for i in range(n_genes)]
+
+
+def sample_ids(n_samples: int) -> List[str]:
+    """Make SRA run ids"""
+    return ['SRR{:07d}'.format(i) for i in range(n_samples)]
+
+
+def write_ensembl_mapping(path: str, n_genes: int, rng: np.random.Generator) -> None:
+    """
+    Write a file in the format BioMart returns (see utils.get_ensembl_mappings), with a few
+    genes left unmapped and a few Ensembl genes sharing a symbol
+    """
+    symbols = np.array(gene_symbols(n_genes), dtype=object)
+    # Some Ensembl genes map to the same symbol, which 3_preprocess_expression.py deduplicates
+    duplicated = rng.random(n_genes) < .01
+    symbols[duplicated] = symbols[np.flatnonzero(duplicated) // 2]
+    mapped = rng.random(n_genes) >= UNMAPPED_FRACTION
+
+    with open(path, 'w') as out_file:
+        for i in np.flatnonzero(mapped):
+            peptide = 'ENSMUSP{:011d}'.format(i) if i % 3 else ''
+            out_file.write('ENSMUST{:011d}\t{}\tENSMUSG{:011d}\t{}\n'.format(
+                           i, symbols[i], i, peptide))
+
+
+def write_counts(path: str, n_samples: int, n_genes: int, rng: np.random.Generator,
+                 n_duplicates: int = 2) -> None:
+    """
+    Write a samples x genes count matrix the way R's write.table does: the header is quoted,
+    versioned gene ids without a field for the row names, and each row starts with a quoted
+    sample id. Samples vary in sparsity, some are duplicated, and one line has a missing value
+    like the interrupted downloads in the real data
+    """
+    header = '\t'.join('"{}.{}"'.format(gene, 1 + i % 5)
+                       for i, gene in enumerate(gene_ids(n_genes)))
+    samples = sample_ids(n_samples)
+    gene_means = rng.lognormal(mean=2, sigma=2, size=n_genes)
+    # Most samples are bulk RNA-seq with moderate sparsity, some are mostly zeros
+    sparsity = rng.beta(2, 5, size=n_samples)
+
+    block_size = max(1, 2 ** 22 // max(n_genes, 1))
+    with open(path, 'w') as out_file:
+        out_file.write(header + '\n')
+        for start in range(0, n_samples, block_size):
+            end = min(start + block_size, n_samples)
+            counts = rng.poisson(gene_means * rng.gamma(2, .5, size=(end - start, 1)))
+            counts[rng.random(counts.shape) < sparsity[start:end, None]] = 0
+
+            lines = []
+            for sample, row in zip(samples[start:end], counts):
+                lines.append('"{}"\t{}\n'.format(sample, '\t'.join(map(str, row))))
+            out_file.writelines(lines)
+            # Duplicate rows show up when samples are in multiple studies
+            if start == 0:
+                out_file.writelines(lines[:n_duplicates])
+
+        out_file.write('"{}"\t{}\t\n'.format('SRR_malformed', '\t'.join(['1'] * (n_genes - 1))))
+
+
+def write_metadata(path: str, n_samples: int, n_studies: int, rng: np.random.Generator) -> None:
+    """Write the recount metadata columns used by the pipeline"""
+    studies = ['SRP{:06d}'.format(i) for i in rng.zipf(1.5, size=n_samples) % n_studies]
+    predictions = rng.choice(['rna-seq', 'scrna-seq', ''], size=n_samples,
+                             p=[1 - SCRNA_FRACTION - .01, SCRNA_FRACTION, .01])
+    metadata = pd.DataFrame({'external_id': sample_ids(n_samples), 'study': studies,
+                             'recount_pred.pattern.predict.type': predictions})
+    metadata.to_csv(path, sep='\t', index=False)
+
+
+def write_holdout_samples(path: str, n_samples: int, n_holdout: int,
+                          rng: np.random.Generator) -> None:
+    """Write a sample list in the format of the NCBI sample selector"""
+    samples = rng.choice(sample_ids(n_samples), size=min(n_holdout, n_samples), replace=False)
+    with open(path, 'w') as out_file:
+        out_file.write('Run,Assay Type,BioProject\n')
+        for sample in samples:
+            out_file.write('{},RNA-Seq,PRJNA564299\n'.format(sample))
+
+
+def write_gene_lengths(path: str, n_genes: int, rng: np.random.Generator) -> None:
+    """Write gene lengths in the format saved by 1_get_gene_lengths.R"""
+    lengths = rng.integers(200, 20000, size=n_genes).astype(str)
+    lengths[rng.random(n_genes) < MISSING_LENGTH_FRACTION] = 'NA'
+    with open(path, 'w') as out_file:
+        out_file.write('"length"\n')
+        for gene, length in zip(gene_ids(n_genes), lengths):
+            out_file.write('"{}"\t{}\n'.format(gene, length))
+
+
+def write_reactome(out_dir: str, n_pathways: int, n_genes: int,
+                   rng: np.random.Generator) -> None:
+    """
+    Write ReactomePathways.txt, ReactomePathwaysRelation.txt, and
+    Ensembl2Reactome_All_Levels.txt with a random pathway hierarchy under the real top level
+    pathways, plus some human pathways that should be ignored
+    """
+    create_pathway_graph = importlib.import_module('2_create_pathway_graph')
+    top_level = create_pathway_graph.TOP_LEVEL_PATHWAYS
+    pathway_ids = top_level + ['R-MMU-{}'.format(1000000 + i) for i in range(n_pathways)]
+    human_ids = ['R-HSA-{}'.format(1000000 + i) for i in range(n_pathways // 10)]
+
+    with open(os.path.join(out_dir, 'ReactomePathways.txt'), 'w') as out_file:
+        for pathway_id in pathway_ids:
+            out_file.write('{}\tPathway {}\tMus musculus\n'.format(pathway_id, pathway_id))
+        for pathway_id in human_ids:
+            out_file.write('{}\tPathway {}\tHomo sapiens\n'.format(pathway_id, pathway_id))
+
+    # Each pathway's parent is a pathway listed before it, so the relations form a forest
+    # rooted at the top level pathways. The edges are shuffled since the real file isn't
+    # topologically sorted
+    parents = [pathway_ids[rng.integers(len(top_level) + i)] for i in range(n_pathways)]
+    edges = list(zip(parents, pathway_ids[len(top_level):]))
+    edges += list(zip(human_ids[1:], human_ids[:-1]))
+    order = rng.permutation(len(edges))
+    with open(os.path.join(out_dir, 'ReactomePathwaysRelation.txt'), 'w') as out_file:
+        for i in order:
+            out_file.write('{}\t{}\n'.format(*edges[i]))
+
+    genes = gene_ids(n_genes)
+    with open(os.path.join(out_dir, 'Ensembl2Reactome_All_Levels.txt'), 'w') as out_file:
+        for pathway_id in pathway_ids:
+            size = min(n_genes, int(rng.lognormal(mean=3, sigma=1)) + 1)
+            for gene_index in rng.choice(n_genes, size=size, replace=False):
+                out_file.write('{}\t{}\thttps://reactome.org/PathwayBrowser/#/{}\t'
+                               'Pathway {}\tIEA\tMus musculus\n'.format(
+                                   genes[gene_index], pathway_id, pathway_id, pathway_id))
+
+
+def write_cell_markers(path: str, n_cell_types: int, n_genes: int,
+                       rng: np.random.Generator) -> None:
+    """Write a table in the format of CellMarker's Mouse_cell_markers.txt"""
+    symbols = gene_symbols(n_genes)
+    with open(path, 'w', newline='') as out_file:
+        writer = csv.writer(out_file, delimiter='\t')
+        writer.writerow(['speciesType', 'tissueType', 'cellName', 'geneSymbol'])
+        for i in range(n_cell_types):
+            # Some rows reference cells from a single publication, some list no genes
+            cell_name = 'Cell type {}'.format(i % max(1, n_cell_types // 2))
+            if i % 17 == 0:
+                cell_name = 'Smith et al. cell {}'.format(i)
+            size = min(n_genes, int(rng.lognormal(mean=2, sigma=1)) + 1)
+            genes = ', '.join('[{}]'.format(symbols[j]) if j % 7 == 0 else symbols[j]
+                              for j in rng.choice(n_genes, size=size, replace=False))
+            if i % 23 == 0:
+                genes = ''
+            writer.writerow(['Mouse', 'Brain', cell_name, genes])
+
+
+def write_marker_genes(out_dir: str, n_genes: int, rng: np.random.Generator) -> List[str]:
+    """
+    Write the brain region marker gene lists used by 2.5_add_brain_markers.py
+
+    Returns
+    -------
+    paths: The paths of the marker files
+    """
+    symbols = np.array(gene_symbols(n_genes))
+    paths = []
+    for region in ['cerebral_cortex', 'midbrain', 'striatum']:
+        path = os.path.join(out_dir, '{}.txt'.format(region))
+        genes = rng.choice(symbols, size=min(n_genes, 50), replace=False)
+        with open(path, 'w') as out_file:
+            out_file.write('\n'.join(genes) + '\n')
+        paths.append(path)
+    return paths
+
+
+def write_pathway_matrix(path: str, n_genes: int, n_pathways: int,
+                         rng: np.random.Generator) -> List[str]:
+    """
+    Write a genes x pathways membership matrix like the one 2_create_pathway_graph.py saves
+
+    Returns
+    -------
+    genes: The gene symbols in the matrix
+    """
+    # Real pathway matrices cover most, but not all, genes
+    genes = [gene for gene in gene_symbols(n_genes) if rng.random() < .8]
+    membership = (rng.random((len(genes), n_pathways)) < .05).astype(float)
+    pathway_df = pd.DataFrame(membership, index=genes,
+                              columns=['pathway_{}'.format(i) for i in range(n_pathways)])
+    pathway_df.to_csv(path, sep='\t')
+    return genes
+
+
+def write_expression(path: str, n_samples: int, genes: List[str],
+                     rng: np.random.Generator) -> None:
+    """Write a z-scored samples x genes matrix like the one 3_preprocess_expression.py saves"""
+    block_size = max(1, 2 ** 22 // max(len(genes), 1))
+    with open(path, 'w') as out_file:
+        out_file.write('\t'.join(['sample'] + list(genes)) + '\n')
+        samples = sample_ids(n_samples)
+        for start in range(0, n_samples, block_size):
+            end = min(start + block_size, n_samples)
+            block = pd.DataFrame(rng.standard_normal((end - start, len(genes))),
+                                 index=samples[start:end])
+            block.to_csv(out_file, sep='\t', header=False)
+
+
+def write_plier_model(out_dir: str, genes: List[str], n_lvs: int,
+                      rng: np.random.Generator) -> None:
+    """Write a sparse, nonnegative Z.tsv and a lambda.txt like the ones PLIER saves"""
+    loadings = rng.exponential(size=(len(genes), n_lvs))
+    loadings[rng.random(loadings.shape) < .7] = 0
+    z_df = pd.DataFrame(loadings, index=genes,
+                        columns=['LV{}'.format(i + 1) for i in range(n_lvs)])
+    # R writes the header without a field for the row names
+    with open(os.path.join(out_dir, 'Z.tsv'), 'w') as out_file:
+        out_file.write('\t'.join('"{}"'.format(lv) for lv in z_df.columns) + '\n')
+        z_df.to_csv(out_file, sep='\t', header=False)
+
+    with open(os.path.join(out_dir, 'lambda.txt'), 'w') as out_file:
+        out_file.write('{}\n'.format(rng.uniform(1, 10)))
+
+
+def write_lv_table(path: str, n_samples: int, n_lvs: int, rng: np.random.Generator) -> None:
+    """
+    Write a samples x LVs table like the transform scripts save, with sample names in the
+    day_treatment_region_rep format of the experiment's samples
+    """
+    treatments = ['cocaine', 'saline']
+    days = ['day1', 'day28']
+    regions = ['NAc', 'PFC', 'VTA']
+    samples = ['{}_{}_{}_rep{}'.format(days[i // 2 % 2], treatments[i % 2], regions[i // 4 % 3],
+                                       i // 12 + 1) for i in range(n_samples)]
+    lv_df = pd.DataFrame(rng.standard_normal((n_samples, n_lvs)), index=samples,
+                         columns=['LV{}'.format(i + 1) for i in range(n_lvs)])
+    lv_df.index.name = 'sample'
+    lv_df.to_csv(path, sep='\t')
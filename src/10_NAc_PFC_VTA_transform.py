@@ -1,7 +1,8 @@
-import pandas as pd
 import argparse
 
-from transform import PlierTransform
+from block_pipeline import QUEUE_DEPTH
+from instrumentation import StageMetrics
+from transform import CHUNKSIZE, PlierTransform
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -9,23 +10,26 @@ if __name__ == "__main__":
     parser.add_argument('lambda_file', help="The file with lambda")
     parser.add_argument('expression_file', help="fpkm normalized expression data")
     parser.add_argument('outfile', help="The output file to save the values of latent vairable")
+    parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64',
+                        help="The float type to do the transformation in")
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE,
+                        help="The number of samples to read and transform at once")
+    parser.add_argument('--queue_depth', type=int, default=QUEUE_DEPTH,
+                        help="The number of chunks that can wait between reading, "
+                             "transforming, and writing")
     args = parser.parse_args()
 
-    ### read Z loading
-    lv_df = pd.read_csv(args.weight_file, sep='\t')
+    metrics = StageMetrics('10_NAc_PFC_VTA_transform')
 
-    ### read expression data
-    expression_df = pd.read_csv(args.expression_file, delimiter='\t', index_col=0)
+    ### transform the gene expression into latent space, a chunk of samples at a time.
+    ### Genes in the Z loading that aren't in the expression data are set to zero
+    with metrics.phase('read_model'):
+        transformer = PlierTransform(args.weight_file, args.lambda_file, dtype=args.dtype)
+    ### float32 values need 9 significant digits to round trip
+    float_format = '%.9g' if args.dtype == 'float32' else None
+    stats = transformer.transform_file(args.expression_file, args.outfile, args.chunksize,
+                                       fill_missing=True, float_format=float_format,
+                                       queue_depth=args.queue_depth)
+    metrics.pipeline('transform', stats)
 
-    ### select the genes present in Z loading
-    reformatted_expression_df = pd.DataFrame(index=expression_df.index)
-    for i in lv_df.index:
-        if i in expression_df.columns.values:
-            reformatted_expression_df[i] = expression_df[i]
-        else:
-            reformatted_expression_df[i] = [0]*expression_df.shape[0]
-
-    ### transform the gene expression into latent space
-    transformer = PlierTransform(args.weight_file, args.lambda_file)
-    transformed_df = transformer.transform(reformatted_expression_df)
-    transformed_df.to_csv(args.outfile, sep="\t")
+    metrics.close()
@@ -1,23 +1,254 @@
+"""
+This script keeps the most variable LVs from a samples x LVs table. The table is streamed
+in chunks twice: the first pass accumulates per-LV statistics, and the second writes out
+only the selected columns, so the table never needs to fit in memory
+"""
+
 import argparse
+import os
+from typing import Dict, Optional
 
+import numpy as np
 import pandas as pd
 
+from instrumentation import StageMetrics
+
+CHUNKSIZE = 10000
+
+
+class RunningMoments():
+    def __init__(self, n_columns: int):
+        """
+        Accumulate per-column means and sums of squared deviations over chunks of rows, using
+        the parallel algorithm from https://doi.org/10.1007/978-3-642-51461-6_3. NaNs are
+        ignored, matching pandas' `var`
+
+        Arguments
+        ---------
+        n_columns: The number of columns in each chunk
+        """
+        self.count = np.zeros(n_columns)
+        self.mean = np.zeros(n_columns)
+        self.M2 = np.zeros(n_columns)
+
+    def update(self, chunk: np.ndarray) -> None:
+        """
+        Merge the statistics of a chunk of rows into the running statistics
+
+        Arguments
+        ---------
+        chunk: A rows x columns array
+        """
+        not_nan = ~np.isnan(chunk)
+        chunk_count = not_nan.sum(axis=0)
+        chunk_sum = np.where(not_nan, chunk, 0).sum(axis=0)
+        chunk_mean = np.divide(chunk_sum, chunk_count, out=np.zeros_like(chunk_sum),
+                               where=chunk_count > 0)
+        chunk_M2 = np.where(not_nan, (chunk - chunk_mean) ** 2, 0).sum(axis=0)
+
+        total = self.count + chunk_count
+        delta = chunk_mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mean = np.where(total > 0, self.mean + delta * chunk_count / total, 0)
+            self.M2 = np.where(total > 0,
+                               self.M2 + chunk_M2 + delta ** 2 * self.count * chunk_count / total,
+                               0)
+        self.count = total
+
+    def variance(self, ddof: int = 1) -> np.ndarray:
+        """
+        Calculate the variance of each column, returning NaN where there are too few values
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > ddof, self.M2 / (self.count - ddof), np.nan)
+
+
+class Reservoir():
+    def __init__(self, n_columns: int, size: int, seed: int):
+        """
+        Keep a uniform random sample of rows seen so far using reservoir sampling
+        (https://en.wikipedia.org/wiki/Reservoir_sampling)
+
+        Arguments
+        ---------
+        n_columns: The number of columns in each chunk
+        size: The maximum number of rows to keep
+        seed: The seed for the random number generator
+        """
+        self.rows = np.empty((size, n_columns))
+        self.size = size
+        self.rows_seen = 0
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, chunk: np.ndarray) -> None:
+        """
+        Offer each row in a chunk to the reservoir
+        """
+        # Fill the reservoir with the first rows
+        n_to_fill = min(max(self.size - self.rows_seen, 0), len(chunk))
+        self.rows[self.rows_seen:self.rows_seen + n_to_fill] = chunk[:n_to_fill]
+
+        # Row i replaces a random slot with probability size / (i + 1)
+        row_numbers = np.arange(self.rows_seen + n_to_fill, self.rows_seen + len(chunk))
+        slots = (self.rng.random(len(row_numbers)) * (row_numbers + 1)).astype(np.int64)
+        replace = slots < self.size
+        self.rows[slots[replace]] = chunk[n_to_fill:][replace]
+
+        self.rows_seen += len(chunk)
+
+    def get_rows(self) -> np.ndarray:
+        return self.rows[:min(self.rows_seen, self.size)]
+
+
+def calculate_mad(rows: np.ndarray) -> np.ndarray:
+    """
+    Calculate the median absolute deviation of each column, ignoring NaNs
+    """
+    medians = np.nanmedian(rows, axis=0)
+    return np.nanmedian(np.abs(rows - medians), axis=0)
+
+
+def read_sample_studies(metadata_file: str, sample_column: str,
+                        study_column: str) -> Dict[str, str]:
+    """
+    Read the mapping between samples and the studies they belong to
+
+    Arguments
+    ---------
+    metadata_file: A tsv file containing information about each sample
+    sample_column: The column of the metadata file containing sample ids
+    study_column: The column of the metadata file containing study ids
+
+    Returns
+    -------
+    sample_to_study: A dict mapping sample ids to study ids
+    """
+    metadata = pd.read_csv(metadata_file, sep='\t', usecols=[sample_column, study_column],
+                           dtype=str)
+    metadata = metadata.dropna().drop_duplicates(subset=sample_column)
+    return dict(zip(metadata[sample_column], metadata[study_column]))
+
+
+def score_lvs(lv_file: str, criterion: str, chunksize: int,
+              sample_to_study: Optional[Dict[str, str]] = None,
+              reservoir_size: int = 100000, seed: int = 42) -> pd.Series:
+    """
+    Stream through a samples x LVs table and score each LV by how much it varies
+
+    Arguments
+    ---------
+    lv_file: A tsv file with a 'sample' column followed by one column per LV
+    criterion: 'variance' for the variance across all samples, 'mad' for the median absolute
+               deviation, or 'study_variance' for the mean of the variances within each study
+    chunksize: The number of samples to read at once
+    sample_to_study: A dict mapping sample ids to study ids, required for 'study_variance'
+    reservoir_size: The number of samples to keep for calculating the MAD. When the table has
+                    more samples than this the MAD is estimated from a uniform random sample
+    seed: The seed used to select samples for calculating the MAD
+
+    Returns
+    -------
+    scores: The score for each LV, indexed by LV name in the order of the input columns
+    """
+    lv_names = pd.read_csv(lv_file, sep='\t', nrows=0).columns.drop('sample')
+
+    moments = RunningMoments(len(lv_names))
+    reservoir = None
+    if criterion == 'mad':
+        reservoir = Reservoir(len(lv_names), reservoir_size, seed)
+    study_moments = {}
+
+    with pd.read_csv(lv_file, sep='\t', chunksize=chunksize) as reader:
+        for chunk in reader:
+            values = chunk[lv_names].to_numpy(dtype=np.float64)
+            moments.update(values)
+
+            if reservoir is not None:
+                reservoir.update(values)
+
+            if criterion == 'study_variance':
+                studies = chunk['sample'].map(sample_to_study).to_numpy()
+                # Samples without metadata can't be assigned to a study, so they're skipped
+                for study in pd.unique(studies[pd.notna(studies)]):
+                    if study not in study_moments:
+                        study_moments[study] = RunningMoments(len(lv_names))
+                    study_moments[study].update(values[studies == study])
+
+    if criterion == 'variance':
+        scores = moments.variance()
+    elif criterion == 'mad':
+        scores = calculate_mad(reservoir.get_rows())
+    else:
+        study_variances = np.array([study.variance() for study in study_moments.values()])
+        if len(study_variances) == 0:
+            raise ValueError('No samples in {} were found in the metadata'.format(lv_file))
+        with np.errstate(invalid='ignore'):
+            scores = np.nanmean(study_variances, axis=0)
+
+    return pd.Series(scores, index=lv_names)
+
+
+def write_selected_lvs(lv_file: str, out_file: str, top_lvs: pd.Index, chunksize: int) -> None:
+    """
+    Stream the selected LV columns from the LV table into a new file
+
+    Arguments
+    ---------
+    lv_file: A tsv file with a 'sample' column followed by one column per LV
+    out_file: The file to write the selected LVs to
+    top_lvs: The LVs to keep, in the order they should be written
+    chunksize: The number of samples to read at once
+    """
+    usecols = ['sample'] + list(top_lvs)
+    with pd.read_csv(lv_file, sep='\t', usecols=usecols, chunksize=chunksize) as reader, \
+            open(out_file, 'w') as out:
+        for i, chunk in enumerate(reader):
+            chunk = chunk.set_index('sample').loc[:, top_lvs]
+            chunk.to_csv(out, sep='\t', header=(i == 0))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('lv_file', help='File containing LVs to be filtered by variance')
     parser.add_argument('out_file', help='File to store the filtered LVs to ')
-    parser.add_argument('--n_to_keep', help='The number of lvs to keep', default=10)
+    parser.add_argument('--n_to_keep', help='The number of lvs to keep', default=10, type=int)
+    parser.add_argument('--criterion', help='The statistic used to rank LVs',
+                        choices=['variance', 'mad', 'study_variance'], default='variance')
+    parser.add_argument('--metadata_file',
+                        help='A tsv file mapping samples to studies, required for '
+                             'the study_variance criterion')
+    parser.add_argument('--sample_column', default='external_id',
+                        help='The metadata column containing sample ids')
+    parser.add_argument('--study_column', default='study',
+                        help='The metadata column containing study ids')
+    parser.add_argument('--reservoir_size', default=100000, type=int,
+                        help='The number of samples used to estimate the MAD')
+    parser.add_argument('--seed', default=42, type=int,
+                        help='The seed used to sample rows for the MAD')
+    parser.add_argument('--chunksize', default=CHUNKSIZE, type=int,
+                        help='The number of samples to read at once')
     args = parser.parse_args()
 
-    lv_df = pd.read_csv(args.lv_file, sep='\t')
-    samples = lv_df['sample']
-    lv_df = lv_df.drop('sample', axis='columns')
+    sample_to_study = None
+    if args.criterion == 'study_variance':
+        if args.metadata_file is None:
+            parser.error('--metadata_file is required for the study_variance criterion')
+
+    metrics = StageMetrics('10a_select_lvs')
+
+    if args.criterion == 'study_variance':
+        with metrics.phase('read_metadata'):
+            sample_to_study = read_sample_studies(args.metadata_file, args.sample_column,
+                                                  args.study_column)
 
-    top_lvs = lv_df.var().nlargest(args.n_to_keep).index
+    with metrics.phase('score'):
+        scores = score_lvs(args.lv_file, args.criterion, args.chunksize, sample_to_study,
+                           args.reservoir_size, args.seed)
 
-    filtered_lvs = lv_df.loc[:,top_lvs]
+    top_lvs = scores.nlargest(args.n_to_keep).index
 
-    filtered_lvs['sample'] = samples
-    filtered_lvs = filtered_lvs.set_index('sample')
+    with metrics.phase('write'):
+        write_selected_lvs(args.lv_file, args.out_file, top_lvs, args.chunksize)
 
-    filtered_lvs.to_csv(args.out_file, sep='\t')
\ No newline at end of file
+    metrics.count('bytes', os.path.getsize(args.lv_file))
+    metrics.close()
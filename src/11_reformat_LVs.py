@@ -1,29 +1,98 @@
+"""
+This script reshapes a wide samples x LVs table into a long table with one row per
+(sample, LV) pair, splitting each sample name into the experimental fields it encodes
+"""
+
 import argparse
 
+import numpy as np
+import pandas as pd
+
+from instrumentation import StageMetrics
+from storage import TableWriter
+from tsv_writer import TsvWriter
+from utils import SAMPLE_NAME_PATTERN, parse_sample_names
+
+DEFAULT_FIELDS = 'day,treatment,region'
+CHUNKSIZE = 1000
+
+
+def melt_chunk(chunk: pd.DataFrame, pattern: str, fields: list) -> pd.DataFrame:
+    """
+    Convert a chunk of the wide LV table into the long format
+
+    Arguments
+    ---------
+    chunk: A samples x LVs dataframe indexed by sample name
+    pattern: A regular expression with one named group per field in the sample names
+    fields: The fields from the sample names to include in the output
+
+    Returns
+    -------
+    long_df: A dataframe with the columns LV_ID, the requested fields, and lv_value, with one
+             row per sample and LV ordered by sample then LV
+    """
+    n_samples, n_lvs = chunk.shape
+    sample_fields = parse_sample_names(chunk.index, pattern)
+
+    long_df = pd.DataFrame({'LV_ID': np.tile(chunk.columns.to_numpy(), n_samples)})
+    for field in fields:
+        long_df[field] = np.repeat(sample_fields[field].to_numpy(), n_lvs)
+    long_df['lv_value'] = chunk.to_numpy().ravel()
+
+    return long_df
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('infile', help='the transformed values of latent variables')
     parser.add_argument('outfile', help='the reformated values of latent variables')
+    parser.add_argument('--sample_pattern', default=SAMPLE_NAME_PATTERN,
+                        help='a regular expression with named groups used to split sample '
+                             'names into fields')
+    parser.add_argument('--fields', default=DEFAULT_FIELDS,
+                        help='a comma separated list of the named groups to write')
+    parser.add_argument('--chunksize', default=CHUNKSIZE, type=int,
+                        help='the number of samples to reshape at once')
+    parser.add_argument('--binary_out',
+                        help='a directory to also store the long table in as a binary '
+                             'columnar table (see storage.py)')
     args = parser.parse_args()
 
-    outfh = open(args.outfile, 'w')
+    fields = args.fields.split(',')
+
+    metrics = StageMetrics('11_reformat_LVs')
+
+    writer = None
+    if args.binary_out is not None:
+        writer = TableWriter(args.binary_out, {'lv_value': np.float64}, ['LV_ID'] + fields)
+
+    outfh = TsvWriter(args.outfile)
     ### the header
-    outfh.write("LV_ID\tday\ttreatment\tregion\tlv_value\n")
+    outfh.write_line(['LV_ID'] + fields + ['lv_value'])
+
+    # Values are kept as strings so they're written exactly as they appear in the input
+    with pd.read_csv(args.infile, sep='\t', index_col=0, dtype=str, na_filter=False,
+                     chunksize=args.chunksize) as reader:
+        for chunk in metrics.timed(reader, 'parse'):
+            metrics.count('rows', len(chunk))
+            with metrics.phase('compute'):
+                long_df = melt_chunk(chunk, args.sample_pattern, fields)
+
+            with metrics.phase('write'):
+                outfh.write_block(long_df.to_numpy(dtype=object))
 
-    with open(args.infile) as f:
-        header = f.readline()
-        header = header.strip().split()
-        LV_count = len(header) - 1
+                if writer is not None:
+                    long_df['lv_value'] = long_df['lv_value'].astype(np.float64)
+                    writer.write(long_df)
 
-        for line in f:
-            line = line.strip().split()
-            (treatment, day, region, rep) = line[0].split('_')
+    with metrics.phase('write'):
+        outfh.close()
+        if writer is not None:
+            writer.close()
 
-            for i in range(1, LV_count + 1):
-                lv = header[i]
-                outfh.write(lv + '\t' + day + '\t' + treatment + '\t' + region + '\t' + str(line[i]) + '\n')
+    metrics.close()
 
-    outfh.close()
 
 if __name__ == "__main__":
     main()
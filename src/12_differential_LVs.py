@@ -0,0 +1,55 @@
+"""
+This script tests every LV for differences between treatment groups in every stratum
+(by default each day x region combination) and BH adjusts the p-values. The default
+one-way ANOVA reproduces the tests run by 12_differential_LVs.R
+"""
+
+import argparse
+import csv
+
+import pandas as pd
+
+from differential import METHODS, differential_lvs
+from utils import SAMPLE_NAME_PATTERN, parse_sample_names
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('lv_file', help='A samples x LVs tsv produced by a transform script')
+    parser.add_argument('out_file', help='The csv file to save the test results to')
+    parser.add_argument('--design_file',
+                        help='A tsv with a sample column and the group and strata columns. '
+                             'If omitted, the design is parsed from the sample names')
+    parser.add_argument('--sample_pattern', default=SAMPLE_NAME_PATTERN,
+                        help='A regular expression with named groups used to parse the '
+                             'design from sample names')
+    parser.add_argument('--group_column', default='treatment',
+                        help='The design column containing the experimental groups')
+    parser.add_argument('--strata', default='day,region',
+                        help='A comma separated list of design columns to stratify tests by')
+    parser.add_argument('--method', default='anova', choices=METHODS,
+                        help='The statistical test to run')
+    parser.add_argument('--control', default='saline',
+                        help='The control group for the two-group methods')
+    parser.add_argument('--n_permutations', default=10000, type=int,
+                        help='The number of permutations for the permutation method')
+    parser.add_argument('--seed', default=42, type=int,
+                        help='The seed for the permutation method')
+    args = parser.parse_args()
+
+    lv_df = pd.read_csv(args.lv_file, sep='\t', index_col=0)
+
+    if args.design_file is not None:
+        design = pd.read_csv(args.design_file, sep='\t', index_col=0, dtype=str)
+    else:
+        design = parse_sample_names(lv_df.index, args.sample_pattern)
+
+    strata = [column for column in args.strata.split(',') if len(column) > 0]
+
+    results = differential_lvs(lv_df, design, args.group_column, strata, args.method,
+                               args.control, args.n_permutations, args.seed)
+
+    if args.method == 'anova':
+        # Match the columns written by 12_differential_LVs.R
+        results = results.drop(columns='statistic')
+
+    results.to_csv(args.out_file, index=False, quoting=csv.QUOTE_NONNUMERIC)
@@ -6,29 +6,43 @@ sc-RNAseq data from the recount compendium
 import argparse
 
 import pandas as pd
-import tqdm
+
+from compressed_io import open_output
+from instrumentation import StageMetrics
+from metadata_table import MetadataTable
+from sharding import read_header, shard_lines, shard_offsets, write_samples
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('count_file', help='The file containing the count matrix generated by '
-                                           'download_recount3.R')
-    parser.add_argument('metadata_file', help='The file with info about samples')
-    parser.add_argument('out_file', help='The file to save the normalized results to')
+                                           'download_recount3.R. It can be gzip, BGZF, or zstd '
+                                           'compressed')
+    parser.add_argument('metadata_file',
+                        help='The table with info about samples created by metadata_table.py, '
+                             'or the metadata tsv it was created from')
+    parser.add_argument('out_file', help='The file to save the normalized results to. It is '
+                                         'compressed if it ends in .gz, .bgz, or .zst')
+    parser.add_argument('--shard', type=int, default=0,
+                        help='Which shard of the samples to process, from 0 to n_shards - 1')
+    parser.add_argument('--n_shards', type=int, default=1,
+                        help='The number of shards the samples are split into')
+    parser.add_argument('--seen_file',
+                        help='A file to save the samples seen by this shard to, so the shard '
+                             'outputs can be merged with sharding.py')
     args = parser.parse_args()
 
-    metadata = pd.read_csv(args.metadata_file, sep='\t')
-    # Drop rows without sample ids and duplicate rows
-    metadata = metadata[metadata['external_id'].notna()]
-    metadata = metadata.drop_duplicates(subset=['external_id', 'study'])
-    # Set the index to the sample id for faster access
-    metadata = metadata.set_index('external_id')
+    metrics = StageMetrics('1b_remove_scrnaseq')
 
-    LINES_IN_FILE = 317259
+    with metrics.phase('read_metadata'):
+        # Only the prediction is needed, and samples are found with the external_id index
+        metadata = MetadataTable(args.metadata_file,
+                                 columns=['recount_pred.pattern.predict.type'])
+        predictions = metadata.df['recount_pred.pattern.predict.type']
 
-    with open(args.count_file, 'r') as count_file:
-        out_file = open(args.out_file, 'w')
+    start, end = shard_offsets(args.count_file, args.n_shards)[args.shard]
 
-        header = count_file.readline()
+    with open_output(args.out_file) as out_file:
+        header = read_header(args.count_file)
         out_file.write(header)
         header = header.replace('"', '')
         header_genes = header.strip().split('\t')
@@ -38,44 +52,52 @@ if __name__ == '__main__':
 
         total_genes = len(header_genes)
 
-        for i, line in tqdm.tqdm(enumerate(count_file), total=LINES_IN_FILE):
-            parsed_line = line.replace('"', '')
-            parsed_line = parsed_line.strip().split('\t')
-            sample = parsed_line[0]
+        lines = shard_lines(args.count_file, start, end)
+        for line in metrics.lines(lines, args.count_file, start=start, end=end):
+            with metrics.phase('parse'):
+                parsed_line = line.replace('"', '')
+                parsed_line = parsed_line.strip().split('\t')
+                sample = parsed_line[0]
 
             if sample in samples_seen:
+                metrics.count('duplicate')
                 continue
             samples_seen.add(sample)
 
-            counts = parsed_line[1:]
-            try:
-                counts = [float(count) for count in counts]
-            except ValueError:
-                continue
+            with metrics.phase('parse'):
+                counts = parsed_line[1:]
+                try:
+                    counts = [float(count) for count in counts]
+                except ValueError:
+                    metrics.count('malformed')
+                    continue
 
-            # This works for int zeros and float zeros
-            zero_count = counts.count(0)
-            sparsity = zero_count / total_genes
-            try:
-                sample_metadata = metadata.loc[sample, :]
-            except KeyError:
-                # print(e)
+            with metrics.phase('compute'):
+                # This works for int zeros and float zeros
+                zero_count = counts.count(0)
+                sparsity = zero_count / total_genes
+            # Samples listed more than once in the metadata use their first row
+            row = metadata.rows([sample])[0]
+            if row < 0:
+                metrics.count('no_metadata')
                 continue
 
-            recount_pred = sample_metadata['recount_pred.pattern.predict.type']
+            recount_pred = predictions.iat[row]
 
-            try:
-                if len(recount_pred) == 0:
-                    recount_pred = None
-            # Skip malformed lines
-            except TypeError:
+            # Skip samples without a prediction
+            if pd.isna(recount_pred):
+                metrics.count('malformed')
                 continue
 
-            try:
-                if sparsity > .7 or recount_pred == 'scrna-seq':
-                    continue
-                else:
+            if sparsity > .7 or recount_pred == 'scrna-seq':
+                metrics.count('skipped')
+                continue
+            else:
+                with metrics.phase('write'):
                     out_file.write(line)
-            except ValueError as e:
-                print(recount_pred)
-                raise(e)
+                metrics.count('written')
+
+    if args.seen_file is not None:
+        write_samples(args.seen_file, samples_seen)
+
+    metrics.close()
@@ -1,5 +1,8 @@
 import argparse
 
+from compressed_io import open_input, open_output
+from instrumentation import StageMetrics
+
 
 def parse_sample_files(file_paths):
     """
@@ -18,23 +21,31 @@ def parse_sample_files(file_paths):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('compendium_counts', help='Recount3 compendium in count format')
-    parser.add_argument('out_file', help='Path to save the results to')
+    parser.add_argument('compendium_counts', help='Recount3 compendium in count format. It can '
+                                                  'be gzip, BGZF, or zstd compressed')
+    parser.add_argument('out_file', help='Path to save the results to. It is compressed if it '
+                                         'ends in .gz, .bgz, or .zst')
     parser.add_argument('sample_files',
                         help='Metadata files from NCBI sample selector containing '
                              'samples to remove from compendium',
                         nargs='+')
     args = parser.parse_args()
 
+    metrics = StageMetrics('1c_remove_test_studies')
+
     holdout_samples = parse_sample_files(args.sample_files)
 
-    out_file = open(args.out_file, 'w')
-    with open(args.compendium_counts) as in_file:
+    out_file = open_output(args.out_file)
+    with open_input(args.compendium_counts) as in_file:
         header = in_file.readline()
         out_file.write(header)
-        for line in in_file:
+        for line in metrics.lines(in_file, args.compendium_counts, start=len(header)):
             sample = line.split('\t')[0]
             sample = sample.strip('"')
             if sample not in holdout_samples:
                 out_file.write(line)
-    out_file.close()
\ No newline at end of file
+            else:
+                metrics.count('skipped')
+    out_file.close()
+
+    metrics.close()
\ No newline at end of file
@@ -285,6 +285,10 @@ if __name__ == '__main__':
     parser.add_argument('--out_file',
                         help='The file to store the selected pathways for use in PLIER',
                         default='data/plier_pathways.tsv')
+    parser.add_argument('--min_marker_genes', type=int, default=5,
+                        help='Cell types with fewer marker genes than this are left out')
+    parser.add_argument('--min_pathway_genes', type=int, default=5,
+                        help='Pathways need more genes than this to be kept')
     args = parser.parse_args()
 
     # Read all pathways, store the mouse pathways
@@ -335,7 +339,7 @@ if __name__ == '__main__':
 
     for name, genes in name_to_genes.items():
         # Remove pathways that are too small
-        if len(genes) < 5:
+        if len(genes) < args.min_marker_genes:
             continue
 
         pathway = Pathway(id=name, name=name, genes=list(set(genes)))
@@ -349,7 +353,7 @@ if __name__ == '__main__':
     pathway_df = create_matrix(unique_leaves)
 
     # Remove pathways with too few genes
-    pathway_df = pathway_df.loc[:, pathway_df.sum(axis=0) > 5]
+    pathway_df = pathway_df.loc[:, pathway_df.sum(axis=0) > args.min_pathway_genes]
 
     # Remove genes that no longer correspond to pathways
     pathway_df = pathway_df[pathway_df.sum(axis=1) > 0]
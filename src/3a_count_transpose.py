@@ -1,12 +1,160 @@
-import pandas as pd
+"""
+This script transposes a genes x samples count matrix into a samples x genes matrix.
+The counts are copied into a memory-mapped intermediate file one block of rows at a time,
+then written back out one stripe of sample columns at a time, so arbitrarily large
+matrices can be transposed within a fixed memory budget
+"""
+
 import argparse
+import os
+import tempfile
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from compressed_io import open_input
+from storage import create_matrix
+
+BYTES_PER_MB = 2 ** 20
+# Parsing and formatting text with pandas makes a few temporary copies of each block,
+# so each block only gets a fraction of the memory budget
+COPIES_PER_BLOCK = 4
+
+
+def count_data_lines(count_file: str) -> int:
+    """
+    Count the number of lines after the header in a file without parsing them
+
+    Arguments
+    ---------
+    count_file: The path to the genes x samples count matrix
+
+    Returns
+    -------
+    line_count: The number of lines following the header
+    """
+    line_count = 0
+    with open_input(count_file, 'rb') as in_file:
+        in_file.readline()
+        for _ in in_file:
+            line_count += 1
+    return line_count
+
+
+def read_samples(count_file: str) -> List[str]:
+    """
+    Read the sample names from the header of the count matrix
+
+    Arguments
+    ---------
+    count_file: The path to the genes x samples count matrix
+
+    Returns
+    -------
+    samples: The names of the samples in the order they appear in the file
+    """
+    with open_input(count_file) as in_file:
+        header_df = pd.read_csv(in_file, sep='\t', index_col=0, header=0, nrows=0)
+    return list(header_df.columns)
+
+
+def get_block_size(memory_mb: int, row_length: int) -> int:
+    """
+    Calculate how many rows of a given length can be processed at once in the memory budget
+
+    Arguments
+    ---------
+    memory_mb: The memory budget in megabytes
+    row_length: The number of eight-byte values in each row
+
+    Returns
+    -------
+    block_size: The number of rows to process at once
+    """
+    block_bytes = memory_mb * BYTES_PER_MB // COPIES_PER_BLOCK
+    return max(1, block_bytes // (row_length * np.dtype(np.float64).itemsize))
+
+
+def copy_to_memmap(count_file: str, memmap: np.memmap,
+                   memory_mb: int) -> Tuple[List[str], bool]:
+    """
+    Parse the count matrix in blocks of rows and store them in a genes x samples memmap
+
+    Arguments
+    ---------
+    count_file: The path to the genes x samples count matrix
+    memmap: A genes x samples array with at least as many rows as the count file
+    memory_mb: The memory budget in megabytes
+
+    Returns
+    -------
+    genes: The names of the genes in the order they appear in the file
+    integer_valued: True if every block of the count matrix was parsed as integers
+    """
+    rows_per_block = get_block_size(memory_mb, memmap.shape[1])
+
+    genes = []
+    integer_valued = True
+    with open_input(count_file) as in_file, \
+            pd.read_csv(in_file, sep='\t', index_col=0, header=0,
+                        chunksize=rows_per_block) as reader:
+        for chunk in reader:
+            start = len(genes)
+            memmap[start:start + len(chunk)] = chunk.to_numpy(dtype=np.float64)
+            genes.extend(chunk.index)
+
+            if not all(pd.api.types.is_integer_dtype(dtype) for dtype in chunk.dtypes):
+                integer_valued = False
+
+    memmap.flush()
+    return genes, integer_valued
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('original_count', help="original count file")
     parser.add_argument('transposed_count', help="transposed count file")
+    parser.add_argument('--memory_mb', type=int, default=1024,
+                        help="The approximate amount of memory to use for each block of the "
+                             "transpose, in megabytes")
+    parser.add_argument('--tmp_dir', default=None,
+                        help="The directory to store the memory-mapped intermediate in. "
+                             "Defaults to the directory of the transposed count file")
+    parser.add_argument('--binary', action='store_true',
+                        help="Store the transposed matrix as a binary matrix directory "
+                             "(see storage.py) instead of a tsv")
     args = parser.parse_args()
 
-    counts = pd.read_csv(args.original_count, header=0, sep='\t', index_col=0)
-    counts_T = counts.T
-    counts_T.to_csv(args.transposed_count, sep='\t')
+    samples = read_samples(args.original_count)
+    max_genes = count_data_lines(args.original_count)
+
+    tmp_dir = args.tmp_dir
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(args.transposed_count))
+
+    with tempfile.NamedTemporaryFile(dir=tmp_dir, suffix='.dat') as tmp_file:
+        counts = np.memmap(tmp_file.name, dtype=np.float64, mode='w+',
+                           shape=(max(max_genes, 1), len(samples)))
+        genes, integer_valued = copy_to_memmap(args.original_count, counts, args.memory_mb)
+        counts = counts[:len(genes)]
+
+        out_dtype = np.int64 if integer_valued else np.float64
+        samples_per_block = get_block_size(args.memory_mb, len(genes))
+
+        if args.binary:
+            counts_T = create_matrix(args.transposed_count, (len(samples), len(genes)),
+                                     out_dtype, samples, genes)
+            for start in range(0, len(samples), samples_per_block):
+                end = start + samples_per_block
+                counts_T[start:end] = counts[:, start:end].T
+            counts_T.flush()
+        else:
+            with open(args.transposed_count, 'w') as out_file:
+                for start in range(0, len(samples), samples_per_block):
+                    end = start + samples_per_block
+                    # Reading a stripe of columns from the memmap gives a block of output rows
+                    block = counts[:, start:end].T.astype(out_dtype)
+                    block_df = pd.DataFrame(block, index=samples[start:end], columns=genes)
+                    block_df.to_csv(out_file, sep='\t', header=(start == 0))
+        del counts
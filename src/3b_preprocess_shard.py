@@ -0,0 +1,354 @@
+"""
+This script runs 3_preprocess_expression.py as a set of jobs that can run in parallel.
+Each step saves its results to a shared working directory:
+
+genes: Chooses the genes to keep and looks up their symbols, once for all shards
+statistics: RPKM normalizes one shard of the samples and saves their per-gene means and sums of
+            squared differences, along with a quantile sketch of them if --sketch is given
+merge_statistics: Combines the shards' statistics into per-gene means and standard deviations,
+                  or medians and median absolute deviations, then removes low variance or low
+                  expression genes
+normalize: Z-scores or robustly scales one shard of the samples using the merged statistics
+
+The normalized shards are then merged with sharding.py. The shards' means and variances are
+combined with Chan et al.'s parallel algorithm, so they match 3_preprocess_expression.py's up
+to rounding error. 3_preprocess_expression.py weights each sample's update by its line number,
+so when lines are skipped its statistics drift from the exact ones these are. The shards'
+quantile sketches add up to exactly the sketch of the whole file
+"""
+
+import argparse
+import json
+import os
+from typing import Dict, Iterator, Set, Tuple
+
+import numpy as np
+
+from block_pipeline import QUEUE_DEPTH, BlockPool, run_pipeline
+from instrumentation import StageMetrics
+from preprocessing import (BLOCK_SIZE, EXPRESSION_PERCENTILE, EXPRESSION_QUANTILE, FILTER_MODES,
+                           SCALING_MODES, VARIANCE_PERCENTILE, CountBlock, CountBlockReader,
+                           block_statistics, calculate_rpkm, combine_statistics, filter_and_scale,
+                           get_pathway_genes, needs_sketch, output_genes, parse_gene_lengths,
+                           parse_line, remove_indices, remove_sample, select_genes,
+                           write_normalized)
+from quantile_sketch import SKETCH_MB, QuantileSketch
+from sharding import read_header, read_samples, shard_lines, shard_offsets, write_samples
+from tsv_writer import TsvWriter, precision_format
+from utils import get_ensembl_mappings
+
+GENES_FILE = 'genes.json'
+STATISTICS_FILE = 'statistics.npz'
+HEADER_FILE = 'header.json'
+SHARD_STATISTICS_FILE = 'statistics.{}.npz'
+SKETCH_FILE = 'statistics.{}.sketch.npz'
+
+
+def shard_path(work_dir: str, name: str, shard: int) -> str:
+    """Get the path of a file saved by one shard"""
+    return os.path.join(work_dir, name.format(shard))
+
+
+def load_genes(work_dir: str) -> Dict:
+    """Load the genes chosen by the genes step"""
+    with open(os.path.join(work_dir, GENES_FILE)) as in_file:
+        genes = json.load(in_file)
+    genes['gene_lengths'] = np.array(genes['gene_lengths'])
+    return genes
+
+
+def save_genes(args: argparse.Namespace, metrics: StageMetrics) -> None:
+    """Choose which genes to keep and save them along with their lengths and symbols"""
+    with metrics.phase('read_annotations'):
+        ensembl_to_genesymbol = get_ensembl_mappings()
+        gene_to_len = parse_gene_lengths(args.gene_file)
+        pathway_genes = get_pathway_genes(args.pathway_file)
+
+    header = read_header(args.count_file)
+    header_genes, bad_indices, gene_length_arr = select_genes(header, ensembl_to_genesymbol,
+                                                              gene_to_len, pathway_genes)
+
+    # Only save the symbols of the genes in the compendium
+    symbols = {gene: ensembl_to_genesymbol[gene] for gene in header_genes
+               if gene in ensembl_to_genesymbol}
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    with open(os.path.join(args.work_dir, GENES_FILE), 'w') as out_file:
+        json.dump({'header_genes': header_genes,
+                   'bad_indices': bad_indices,
+                   'gene_lengths': gene_length_arr.tolist(),
+                   'symbols': symbols},
+                  out_file)
+
+
+def save_statistics_shard(args: argparse.Namespace, metrics: StageMetrics) -> None:
+    """RPKM normalize the samples in a shard and save their statistics for merge_statistics"""
+    genes = load_genes(args.work_dir)
+    dtype = np.dtype(args.dtype)
+    n_genes = len(genes['gene_lengths'])
+    start, end = shard_offsets(args.count_file, args.n_shards)[args.shard]
+    sketch = None
+    if args.sketch:
+        sketch = QuantileSketch(n_genes, args.sketch_mb)
+
+    # Each stage can hold a block while queue_depth more wait between the stages
+    count_pool = BlockPool(args.queue_depth + 2, (BLOCK_SIZE, n_genes), dtype)
+    indices = []
+    samples = []
+    n, means, M2 = 0, np.zeros(n_genes), np.zeros(n_genes)
+    lines = metrics.lines(shard_lines(args.count_file, start, end), args.count_file,
+                          'Calculating statistics', start, end)
+    # Duplicates of samples in earlier shards are removed by merge_statistics
+    reader = CountBlockReader(lines, [genes['bad_indices']], count_pool, metrics)
+
+    def accumulate(block: CountBlock) -> None:
+        nonlocal n, means, M2
+        rpkm, block_samples, line_numbers = reader.rpkm(block, genes['gene_lengths'])
+        if len(rpkm) == 0:
+            return
+        indices.extend(line_numbers)
+        samples.extend(block_samples)
+        with metrics.phase('compute'):
+            n, means, M2 = combine_statistics(n, means, M2, *block_statistics(rpkm))
+            if sketch is not None:
+                sketch.update(rpkm)
+        metrics.count('rows', len(rpkm))
+
+    metrics.pipeline('statistics', run_pipeline(reader, accumulate,
+                                                queue_depth=args.queue_depth))
+
+    np.savez(shard_path(args.work_dir, SHARD_STATISTICS_FILE, args.shard),
+             n=n, means=means, M2=M2)
+    write_samples(shard_path(args.work_dir, 'seen.{}.txt', args.shard), reader.samples_seen)
+    if sketch is not None:
+        sketch.save(shard_path(args.work_dir, SKETCH_FILE, args.shard))
+    with open(shard_path(args.work_dir, 'statistics.{}.json', args.shard), 'w') as out_file:
+        json.dump({'n_lines': reader.n_lines, 'indices': indices, 'samples': samples}, out_file)
+
+
+def read_rpkm_rows(count_file: str, offsets: Tuple[int, int], line_numbers: Set[int],
+                   genes: Dict, dtype: np.dtype, metrics: StageMetrics) -> Iterator[np.ndarray]:
+    """
+    RPKM normalize a few lines of a shard again, the same way the statistics step did
+
+    Arguments
+    ---------
+    count_file: The file containing the count matrix
+    offsets: The (start, end) byte offsets of the shard
+    line_numbers: The line numbers of the lines to normalize within the shard
+    genes: The genes chosen by the genes step
+    dtype: The float type the statistics step normalized the data in
+    metrics: The metrics to record the parse time in
+
+    Yields
+    ------
+    rpkm: The RPKM values of each line, in the order of the lines
+    """
+    last_line = max(line_numbers)
+    for i, line in enumerate(shard_lines(count_file, *offsets)):
+        if i in line_numbers:
+            with metrics.phase('parse'):
+                _, counts = parse_line(line)
+                remove_indices(counts, genes['bad_indices'])
+                counts = np.array(counts, dtype=dtype)[None, :]
+                rpkm = calculate_rpkm(counts, genes['gene_lengths'], dtype)[0]
+            yield rpkm
+        if i == last_line:
+            return
+
+
+def merge_statistics(args: argparse.Namespace, metrics: StageMetrics) -> None:
+    """Calculate the per-gene statistics from every shard and remove low variance or low
+    expression genes"""
+    genes = load_genes(args.work_dir)
+    dtype = np.dtype(args.dtype)
+    n_genes = len(genes['gene_lengths'])
+
+    sketch = None
+    if needs_sketch(args.filter, args.scaling):
+        for shard in range(args.n_shards):
+            path = shard_path(args.work_dir, SKETCH_FILE, shard)
+            if not os.path.exists(path):
+                raise FileNotFoundError('{} filtering and {} scaling need the quantile sketch {}, '
+                                        'run the statistics step with '
+                                        '--sketch'.format(args.filter, args.scaling, path))
+            with metrics.phase('read'):
+                shard_sketch = QuantileSketch.load(path)
+            if sketch is None:
+                sketch = shard_sketch
+            else:
+                sketch.merge(shard_sketch)
+            # Free the shard's sketch before loading the next one, so only two are held at once
+            del shard_sketch
+
+    offsets = shard_offsets(args.count_file, args.n_shards)
+    n, means, M2 = 0, np.zeros(n_genes), np.zeros(n_genes)
+    samples_seen = set()
+    # The number of lines in the whole count file
+    n_lines = 0
+    for shard in range(args.n_shards):
+        with open(shard_path(args.work_dir, 'statistics.{}.json', shard)) as in_file:
+            shard_info = json.load(in_file)
+        with metrics.phase('read'):
+            statistics = np.load(shard_path(args.work_dir, SHARD_STATISTICS_FILE, shard))
+            shard_n, shard_means, shard_M2 = (int(statistics['n']), statistics['means'],
+                                              statistics['M2'])
+
+        # Samples already seen in an earlier shard are normalized again and taken back out of
+        # the shard's statistics. Each shard's sketch counted them too, so they're removed from
+        # the sketch as well
+        duplicates = {index for index, sample in zip(shard_info['indices'],
+                                                     shard_info['samples'])
+                      if sample in samples_seen}
+        if len(duplicates) > 0:
+            for rpkm in read_rpkm_rows(args.count_file, offsets[shard], duplicates, genes,
+                                       dtype, metrics):
+                metrics.count('duplicate')
+                with metrics.phase('compute'):
+                    shard_n, shard_means, shard_M2 = remove_sample(shard_n, shard_means,
+                                                                   shard_M2, rpkm)
+                    if sketch is not None:
+                        sketch.remove(rpkm[None, :])
+
+        with metrics.phase('compute'):
+            n, means, M2 = combine_statistics(n, means, M2, shard_n, shard_means, shard_M2)
+        metrics.count('rows', shard_n)
+
+        samples_seen.update(read_samples(shard_path(args.work_dir, 'seen.{}.txt', shard)))
+        n_lines += shard_info['n_lines']
+
+    with metrics.phase('compute'):
+        low_variance_indices, gene_length_arr, filtered_means, stds = filter_and_scale(
+            means, M2, n_lines - 1, genes['gene_lengths'], dtype, args.variance_percentile,
+            args.filter, args.scaling, sketch, args.expression_quantile,
+            args.expression_percentile)
+
+    print(filtered_means.shape)
+    print(stds.shape)
+
+    header = output_genes(genes['header_genes'], genes['symbols'], genes['bad_indices'],
+                          low_variance_indices)
+
+    # With robust scaling, means and stds hold the medians and scaled median absolute deviations
+    np.savez(os.path.join(args.work_dir, STATISTICS_FILE),
+             low_variance_indices=low_variance_indices,
+             gene_lengths=gene_length_arr,
+             means=filtered_means,
+             stds=stds)
+    with open(os.path.join(args.work_dir, HEADER_FILE), 'w') as out_file:
+        json.dump(header, out_file)
+
+
+def normalize_shard(args: argparse.Namespace, metrics: StageMetrics) -> None:
+    """Z-score or robustly scale the samples in a shard and write them with a header"""
+    genes = load_genes(args.work_dir)
+    dtype = np.dtype(args.dtype)
+    statistics = np.load(os.path.join(args.work_dir, STATISTICS_FILE))
+    low_variance_indices = statistics['low_variance_indices']
+    gene_length_arr = statistics['gene_lengths']
+    filtered_means = statistics['means']
+    stds = statistics['stds']
+    with open(os.path.join(args.work_dir, HEADER_FILE)) as in_file:
+        header = json.load(in_file)
+
+    start, end = shard_offsets(args.count_file, args.n_shards)[args.shard]
+
+    out_file = TsvWriter(args.out_file, float_format=precision_format(args.precision, dtype))
+    out_file.write_line(['sample'] + header)
+
+    lines = metrics.lines(shard_lines(args.count_file, start, end), args.count_file,
+                          'Normalizing', start, end)
+    metrics.pipeline('normalize', write_normalized(lines, genes['bad_indices'],
+                                                   low_variance_indices, gene_length_arr,
+                                                   filtered_means, stds, out_file, metrics,
+                                                   args.queue_depth))
+
+    with metrics.phase('write'):
+        out_file.close()
+
+
+STEPS = {'genes': save_genes,
+         'statistics': save_statistics_shard,
+         'merge_statistics': merge_statistics,
+         'normalize': normalize_shard,
+         }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='step', required=True)
+
+    genes_parser = subparsers.add_parser('genes', help='Choose the genes to keep')
+    genes_parser.add_argument('count_file', help='The file containing the count matrix '
+                                                 'generated by remove_scrnaseq.py. It can be '
+                                                 'gzip, BGZF, or zstd compressed')
+    genes_parser.add_argument('gene_file',
+                              help='The file with gene lengths from get_gene_lengths.R')
+    genes_parser.add_argument('pathway_file', help='The file mapping genes to pathways')
+    genes_parser.add_argument('work_dir', help='The directory to save intermediate results to')
+
+    statistics_parser = subparsers.add_parser('statistics',
+                                              help='Calculate the per-gene statistics of one '
+                                                   'shard of the samples')
+    statistics_parser.add_argument('count_file', help='The file containing the count matrix')
+    statistics_parser.add_argument('work_dir', help='The directory with the genes step results')
+    statistics_parser.add_argument('--sketch', action='store_true',
+                                   help='Also save a quantile sketch of the shard, which '
+                                        'merge_statistics needs for --filter expression and '
+                                        '--scaling robust')
+    statistics_parser.add_argument('--sketch_mb', type=float, default=SKETCH_MB,
+                                   help='The memory to use for the quantile sketch, in '
+                                        'megabytes. Every shard must use the same amount')
+
+    merge_parser = subparsers.add_parser('merge_statistics',
+                                         help='Combine the statistics of every shard')
+    merge_parser.add_argument('count_file', help='The file containing the count matrix. Samples '
+                                                 'in more than one shard are read from it again')
+    merge_parser.add_argument('work_dir', help='The directory with the statistics results')
+    merge_parser.add_argument('--variance_percentile', type=float, default=VARIANCE_PERCENTILE,
+                              help='Genes whose variance is below this percentile are removed')
+    merge_parser.add_argument('--filter', choices=FILTER_MODES, default='variance',
+                              help='Whether to remove the genes with the lowest variance or the '
+                                   'lowest expression')
+    merge_parser.add_argument('--expression_quantile', type=float, default=EXPRESSION_QUANTILE,
+                              help='With --filter expression, the quantile of each gene\'s RPKM '
+                                   'values to compare')
+    merge_parser.add_argument('--expression_percentile', type=float,
+                              default=EXPRESSION_PERCENTILE,
+                              help='With --filter expression, genes whose quantile is below this '
+                                   'percentile are removed')
+    merge_parser.add_argument('--scaling', choices=SCALING_MODES, default='zscore',
+                              help='Whether to scale genes by their means and standard deviations '
+                                   'or by their medians and median absolute deviations')
+
+    normalize_parser = subparsers.add_parser('normalize',
+                                             help='Z-score or robustly scale one shard of the '
+                                                  'samples')
+    normalize_parser.add_argument('count_file', help='The file containing the count matrix')
+    normalize_parser.add_argument('work_dir',
+                                  help='The directory with the merge_statistics results')
+    normalize_parser.add_argument('out_file', help='The file to save the normalized shard to. '
+                                                   'Files ending in .gz or .zst are compressed')
+    normalize_parser.add_argument('--precision', type=int, default=None,
+                                  help='The number of significant digits to write. By default '
+                                       'values are written exactly')
+
+    for step_parser in (statistics_parser, merge_parser, normalize_parser):
+        step_parser.add_argument('--n_shards', type=int, required=True,
+                                 help='The number of shards the samples are split into')
+        step_parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64',
+                                 help='The float type used to normalize the data. Means and '
+                                      'variances are always accumulated in float64')
+    for step_parser in (statistics_parser, normalize_parser):
+        step_parser.add_argument('--shard', type=int, required=True,
+                                 help='Which shard of the samples to process, from 0 to '
+                                      'n_shards - 1')
+        step_parser.add_argument('--queue_depth', type=int, default=QUEUE_DEPTH,
+                                 help='The number of blocks of samples that can wait between '
+                                      'reading, normalizing, and writing')
+
+    args = parser.parse_args()
+
+    metrics = StageMetrics('3b_preprocess_{}'.format(args.step))
+    STEPS[args.step](args, metrics)
+    metrics.close()
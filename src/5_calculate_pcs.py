@@ -5,13 +5,64 @@ incremental PCA to calculate PCs to use as a starting point without running out
 
 import argparse
 import os
+from typing import Iterator, Tuple
 
 import numpy as np
 import pandas as pd
-from sklearn.decomposition import IncrementalPCA
 from tqdm import tqdm
 
-FILE_LINES = 190000
+from block_pipeline import QUEUE_DEPTH, run_pipeline
+from instrumentation import StageMetrics
+from tsv_writer import TsvWriter, precision_format
+
+# The format np.savetxt uses by default
+SAVETXT_FORMAT = '%.18e'
+# The number of samples to read at once
+CHUNKSIZE = 1000
+
+
+def save_matrix(path: str, matrix: np.ndarray, float_format: str) -> None:
+    """
+    Write a matrix as a headerless tsv in the same layout as np.savetxt
+
+    Arguments
+    ---------
+    path: The file to write to
+    matrix: The 1-D or 2-D array to write
+    float_format: The printf-style format used for each value
+    """
+    with TsvWriter(path, float_format=float_format) as out_file:
+        out_file.write_block(matrix)
+
+
+def read_chunks(expression_file: str, dtype: np.dtype, metrics: StageMetrics,
+                desc: str) -> Iterator[np.ndarray]:
+    """
+    Read the expression data in chunks of samples, without the sample column
+
+    Arguments
+    ---------
+    expression_file: The expression file produced by 3_preprocess_expression.py
+    dtype: The float type to read the data as
+    metrics: The metrics to record the parse time and rows in
+    desc: The description to show in the progress bar
+
+    Returns
+    -------
+    chunks: An iterator over samples x genes arrays
+    """
+    columns_to_skip = 'sample'
+    with pd.read_csv(expression_file,
+                     chunksize=CHUNKSIZE,
+                     delimiter='\t',
+                     usecols=lambda x: x not in columns_to_skip,
+                     dtype=dtype) as reader:
+        for chunk in tqdm(metrics.timed(reader, 'parse'), desc=desc, unit='chunks'):
+            metrics.count('rows', len(chunk))
+            with metrics.phase('parse'):
+                data = chunk.to_numpy(dtype=dtype)
+            yield data
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -23,43 +74,67 @@ if __name__ == '__main__':
     parser.add_argument('--n_components',
                         help='The number of components to return from PCA',
                         default=200, type=int)
+    parser.add_argument('--precision',
+                        help='The number of significant digits to write. Defaults to the '
+                             'full precision written by np.savetxt',
+                        default=None, type=int)
+    parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64',
+                        help='The float type to read the expression data and run PCA in')
+    parser.add_argument('--queue_depth', type=int, default=QUEUE_DEPTH,
+                        help='The number of chunks that can be read ahead of the PCA')
     args = parser.parse_args()
+    dtype = np.dtype(args.dtype)
 
-    pca = IncrementalPCA(n_components=args.n_components)
+    # sklearn takes longer to import than anything else in the pipeline, so only import it
+    # once the arguments are known to be valid
+    from sklearn.decomposition import IncrementalPCA
 
-    columns_to_skip = 'sample'
+    metrics = StageMetrics('5_calculate_pcs')
 
-    CHUNKSIZE = 1000
+    pca = IncrementalPCA(n_components=args.n_components)
 
-    with pd.read_csv(args.expression_file,
-                     chunksize=CHUNKSIZE,
-                     delimiter='\t',
-                     usecols=lambda x: x not in columns_to_skip) as reader:
-        for chunk in tqdm(reader, total=FILE_LINES // CHUNKSIZE):
-            data = chunk.to_numpy()
-            if len(chunk) < args.n_components:
-                continue
+    chunk_sizes = []
+
+    def fit(data: np.ndarray) -> None:
+        chunk_sizes.append(len(data))
+        if len(data) < args.n_components:
+            metrics.count('skipped', len(data))
+            return
+        with metrics.phase('compute'):
             pca.partial_fit(data)
 
-    d = pca.singular_values_
-    U = pca.components_.T
+    # Read the next chunk while the PCA is fit on the current one
+    chunks = read_chunks(args.expression_file, dtype, metrics, 'Fitting')
+    metrics.pipeline('fit', run_pipeline(chunks, fit, queue_depth=args.queue_depth))
 
-    transformed_chunks = []
+    d = pca.singular_values_
+    U = pca.components_.T.astype(dtype, copy=False)
 
-    with pd.read_csv(args.expression_file,
-                     chunksize=CHUNKSIZE,
-                     delimiter='\t',
-                     usecols=lambda x: x not in columns_to_skip) as reader:
-        for i, chunk in tqdm(enumerate(reader), total=FILE_LINES // CHUNKSIZE):
-            arr = chunk.to_numpy()
+    # The samples x LVs projection of every sample, filled in one chunk at a time
+    offsets = np.concatenate([[0], np.cumsum(chunk_sizes)])
+    transformed = np.empty((offsets[-1], U.shape[1]), dtype=dtype)
 
+    def project(indexed_chunk: Tuple[int, np.ndarray]) -> None:
+        chunk_index, data = indexed_chunk
+        start, end = offsets[chunk_index], offsets[chunk_index + 1]
+        with metrics.phase('compute'):
             # [samples x genes] x [genes x LVs] = [samples x LVs]
-            transformed_chunk = arr @ U
-            transformed_chunks.append(transformed_chunk)
+            np.matmul(data, U, out=transformed[start:end])
 
-    V = np.concatenate(transformed_chunks).T
+    chunks = read_chunks(args.expression_file, dtype, metrics, 'Projecting')
+    metrics.pipeline('project', run_pipeline(enumerate(chunks), project,
+                                             queue_depth=args.queue_depth))
+
+    V = transformed.T
 
     # Store results
-    np.savetxt(os.path.join(args.out_dir, 'd.tsv'), d, delimiter='\t')
-    np.savetxt(os.path.join(args.out_dir, 'U.tsv'), U, delimiter='\t')
-    np.savetxt(os.path.join(args.out_dir, 'V.tsv'), V, delimiter='\t')
+    float_format = SAVETXT_FORMAT
+    if args.precision is not None or dtype != np.float64:
+        float_format = precision_format(args.precision, dtype)
+
+    with metrics.phase('write'):
+        save_matrix(os.path.join(args.out_dir, 'd.tsv'), d, float_format)
+        save_matrix(os.path.join(args.out_dir, 'U.tsv'), U, float_format)
+        save_matrix(os.path.join(args.out_dir, 'V.tsv'), V, float_format)
+
+    metrics.close()
@@ -1,12 +1,17 @@
 """
 This script is used to reformat the count output from featureCount: i.e., combine
-count from different samples
+count from different samples. Any number of count tables can be combined, and they are
+read one at a time so large cohorts don't need to fit in memory together
 """
 
 
+import numpy as np
 import pandas as pd
 import argparse
 
+from storage import create_matrix
+from tsv_writer import TsvWriter
+
 def get_name_map(infile):
     """
     Map bam files to their corresponding sample ids
@@ -28,6 +33,97 @@ def get_name_map(infile):
     return name_map
 
 
+def read_genes(count_file):
+    """
+    Read the gene ids from a featureCounts table without loading its counts
+    Arguments
+    ---------
+    count_file: str
+        the path to a genes x samples count table
+    Returns
+    -------
+    genes: pandas.Index
+        the gene ids in the order they appear in the table
+    """
+    gene_df = pd.read_csv(count_file, header=0, sep='\t', index_col=0, usecols=[0])
+    return gene_df.index
+
+
+def get_output_genes(count_files, join):
+    """
+    Decide which genes to write based on the genes present in each count table
+    Arguments
+    ---------
+    count_files: list of str
+        the paths to the genes x samples count tables
+    join: str
+        'exact' to require every table to contain the same genes, 'inner' to keep the genes
+        present in every table, or 'outer' to keep the genes present in any table
+    Returns
+    -------
+    genes: pandas.Index
+        the genes to write, in the order they appear in the first table
+    """
+    genes = read_genes(count_files[0])
+    for count_file in count_files[1:]:
+        current_genes = read_genes(count_file)
+        if join == 'exact':
+            if set(current_genes) != set(genes):
+                raise ValueError('{} and {} contain different genes; use --join inner or '
+                                 '--join outer to merge them anyway'.format(count_files[0],
+                                                                              count_file))
+        elif join == 'inner':
+            genes = genes[genes.isin(current_genes)]
+        else:
+            genes = genes.append(current_genes[~current_genes.isin(genes)])
+    return genes
+
+
+def map_sample_ids(bams, name_map):
+    """
+    Look up the sample id of each bam file
+    Arguments
+    ---------
+    bams: list of str
+        the bam file names from the header of a count table
+    name_map: dict
+        the map from bam file to sample ID
+    Returns
+    -------
+    samples: list of str
+        the sample ids of the bam files
+    """
+    missing_bams = [bam for bam in bams if bam not in name_map]
+    if len(missing_bams) > 0:
+        raise KeyError('No sample id found in the name map for {}'.format(missing_bams))
+    return [name_map[bam] for bam in bams]
+
+
+def read_counts(count_file, genes, name_map):
+    """
+    Read a featureCounts table and reshape it into a samples x genes table
+    Arguments
+    ---------
+    count_file: str
+        the path to a genes x samples count table
+    genes: pandas.Index
+        the genes to keep, in output order. Genes missing from the table get a count of zero
+    name_map: dict
+        the map from bam file to sample ID
+    Returns
+    -------
+    counts: pandas.DataFrame
+        the counts with sample ids as rows and genes as columns
+    """
+    counts = pd.read_csv(count_file, header=0, sep='\t', index_col=0)
+    ### transpose so that rows are samples, and columns are genes
+    counts = counts.reindex(genes, fill_value=0).T
+
+    counts.index = map_sample_ids(list(counts.index), name_map)
+
+    return counts
+
+
 def parse_arguments():
     """
     parse the command line argument
@@ -39,55 +135,48 @@ def parse_arguments():
     a parser
     """
     parser = argparse.ArgumentParser()
-    parser.add_argument("day1_count", help="the count input for day1 abstinence")
-    parser.add_argument("day28_count", help="the count input for day28 abstinence")
+    parser.add_argument("count_files", nargs='+',
+                        help="the count inputs to combine, e.g. for day1 and day28 abstinence")
     parser.add_argument("name_info", help="the map from bam file to sample ID")
     parser.add_argument("outfile", help="output file")
+    parser.add_argument("--join", choices=['exact', 'inner', 'outer'], default='exact',
+                        help="how to combine tables that contain different genes")
+    parser.add_argument("--binary", action='store_true',
+                        help="store the output as a binary matrix directory (see storage.py)")
 
     return parser
 
+
 def main():
     parser = parse_arguments()
     args = parser.parse_args()
-    day1_counts = pd.read_csv(args.day1_count, header = 0, sep='\t', index_col = 0)
-    day2_counts = pd.read_csv(args.day28_count, header = 0, sep='\t', index_col = 0)
-    ### transpose so that rows are samples, and columns are genes
-    day1_counts_tranposed = day1_counts.T
-    day2_counts_tranposed = day2_counts.T
     name_map = get_name_map(args.name_info)
-    outfh = open(args.outfile, 'w')
+    genes = get_output_genes(args.count_files, args.join)
 
-    if list(day1_counts_tranposed.columns.values) == list(day2_counts_tranposed.columns.values):
+    if args.binary:
+        # Read the sample names up front to allocate the matrix, then fill it one table at a time
+        samples = []
+        for count_file in args.count_files:
+            header_df = pd.read_csv(count_file, header=0, sep='\t', index_col=0, nrows=0)
+            samples.extend(map_sample_ids(list(header_df.columns), name_map))
+        merged_counts = create_matrix(args.outfile, (len(samples), len(genes)), np.float64,
+                                      samples, genes)
+        row = 0
+        for count_file in args.count_files:
+            counts = read_counts(count_file, genes, name_map)
+            merged_counts[row:row + len(counts)] = counts.to_numpy(dtype=np.float64)
+            row += len(counts)
+        merged_counts.flush()
+        return
+
+    with TsvWriter(args.outfile) as outfh:
         # write header
-        temp_line = ''
-        for gene in list(day1_counts_tranposed.columns.values):
-            temp_line += gene + '\t'
-        temp_line = temp_line.strip() + '\n'
-        outfh.write(temp_line)
-
-        ### write for day1 samples
-        for index, row in day1_counts_tranposed.iterrows():
-            # write the sample
-            outfh.write(name_map[index] + '\t')
-            # write count
-            temp_line = ''
-            for c in row:
-                temp_line += str(c) + '\t'
-            temp_line = temp_line.strip() + '\n'
-            outfh.write(temp_line)
-
-        ### write for day28 samples
-        for index, row in day2_counts_tranposed.iterrows():
-            # write the sample
-            outfh.write(name_map[index] + '\t')
-            # write count
-            temp_line = ''
-            for c in row:
-                temp_line += str(c) + '\t'
-            temp_line = temp_line.strip() + '\n'
-            outfh.write(temp_line)
-
-    outfh.close()
+        outfh.write_line(genes)
+
+        ### write one table at a time so only one table is in memory
+        for count_file in args.count_files:
+            counts = read_counts(count_file, genes, name_map)
+            outfh.write_block(counts.to_numpy(), list(counts.index))
 
 
 if __name__ == "__main__":
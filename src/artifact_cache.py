@@ -0,0 +1,455 @@
+"""
+This file implements a local, content-addressed cache of pipeline outputs. A stage's outputs
+are stored under a key made from the hashes of its inputs, the hashes of its code, and its
+command line, which holds its parameters. Rerunning a stage with a configuration that was
+already computed, e.g. switching a cutoff back to its old value, finds the key and links the
+cached outputs into place instead of recomputing them.
+
+Each output is stored once per unique content as a hard link, so caching costs no extra disk
+space while the output still exists. Outputs that are deleted after they're used, such as
+Snakemake temp() files, would only exist in the cache, so they shouldn't be cached. Since
+outputs share their storage with the cache, cached outputs are checked against their hashes
+before they're reused, in case an output was edited in place. The least recently used entries
+are evicted once the cache grows past a size limit.
+
+Usage: `python src/artifact_cache.py run --stage NAME --inputs IN... --outputs OUT... --
+COMMAND...` runs COMMAND only if its outputs aren't in the cache
+"""
+
+import argparse
+import ast
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from fetch_sources import file_sha256
+
+# The directory to keep the cache in, unless one is passed explicitly
+CACHE_DIR_VARIABLE = 'MOUSIPLIER_CACHE_DIR'
+DEFAULT_CACHE_DIR = '.cache/artifacts'
+# The size the cache is trimmed to after storing new outputs
+DEFAULT_MAX_SIZE_GB = 200
+# File extensions of scripts whose content is part of a stage's key
+CODE_EXTENSIONS = ('.py', '.R')
+
+
+def _save_json(path: str, data: Dict) -> None:
+    """Save json, replacing the old file only once the new one is completely written"""
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as out_file:
+        json.dump(data, out_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _signature(path: str) -> List[int]:
+    """Get the size, modification time, and inode of a file, which change when it's rewritten"""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def local_imports(script: str) -> List[str]:
+    """
+    Find the modules in a script's directory that it imports, directly or through other
+    local modules
+
+    Arguments
+    ---------
+    script: The path to a Python file
+
+    Returns
+    -------
+    paths: The paths of the imported local modules
+    """
+    directory = os.path.dirname(script)
+    found = []
+    to_scan = [script]
+    while len(to_scan) > 0:
+        with open(to_scan.pop()) as in_file:
+            tree = ast.parse(in_file.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module is not None:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                path = os.path.join(directory, name.split('.')[0] + '.py')
+                if os.path.exists(path) and path != script and path not in found:
+                    found.append(path)
+                    to_scan.append(path)
+    return found
+
+
+def command_code(command: Sequence[str]) -> List[str]:
+    """
+    Find the scripts a command runs, along with the local modules the Python scripts import
+
+    Arguments
+    ---------
+    command: The command and its arguments
+
+    Returns
+    -------
+    paths: The sorted paths of the code files
+    """
+    paths = set()
+    for arg in command:
+        if arg.endswith(CODE_EXTENSIONS) and os.path.isfile(arg):
+            paths.add(arg)
+            if arg.endswith('.py'):
+                paths.update(local_imports(arg))
+    return sorted(paths)
+
+
+class ArtifactCache():
+    def __init__(self, cache_dir: Optional[str] = None,
+                 max_size_gb: float = DEFAULT_MAX_SIZE_GB):
+        """
+        Open a cache, creating it if it doesn't exist
+
+        Arguments
+        ---------
+        cache_dir: The directory to keep the cache in. Defaults to the MOUSIPLIER_CACHE_DIR
+                   environment variable, or .cache/artifacts
+        max_size_gb: The size in GB the cache is trimmed to after new outputs are stored
+        """
+        if cache_dir is None:
+            cache_dir = os.environ.get(CACHE_DIR_VARIABLE, DEFAULT_CACHE_DIR)
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 2 ** 30)
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.entries_dir = os.path.join(cache_dir, 'entries')
+        # Hashes of files outside the cache, so unchanged inputs are only hashed once
+        self.hashes_dir = os.path.join(cache_dir, 'hashes')
+        for directory in (self.objects_dir, self.entries_dir, self.hashes_dir):
+            os.makedirs(directory, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _lock(self, exclusive: bool) -> Iterator[None]:
+        """Keep other processes from evicting outputs while they're being linked or stored"""
+        with open(os.path.join(self.cache_dir, 'lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _object_path(self, sha256: str) -> str:
+        return os.path.join(self.objects_dir, sha256[:2], sha256[2:])
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.entries_dir, key + '.json')
+
+    def file_hash(self, path: str) -> str:
+        """
+        Get the SHA-256 hash of a file, reusing the saved hash if the file hasn't been modified
+        since it was last hashed
+
+        Arguments
+        ---------
+        path: The file to hash
+
+        Returns
+        -------
+        sha256: The hex digest of the file's contents
+        """
+        record_path = self._hash_record_path(path)
+        if os.path.exists(record_path):
+            with open(record_path) as in_file:
+                record = json.load(in_file)
+            if record['signature'] == _signature(path):
+                return record['sha256']
+
+        sha256 = file_sha256(path)
+        self._save_hash(path, sha256)
+        return sha256
+
+    def _hash_record_path(self, path: str) -> str:
+        path_hash = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()
+        return os.path.join(self.hashes_dir, path_hash + '.json')
+
+    def _save_hash(self, path: str, sha256: str) -> None:
+        _save_json(self._hash_record_path(path), {'path': os.path.abspath(path),
+                                                  'signature': _signature(path),
+                                                  'sha256': sha256})
+
+    def key(self, stage: str, command: Sequence[str], inputs: Sequence[str],
+            code: Sequence[str] = ()) -> str:
+        """
+        Calculate the key the outputs of a stage are cached under
+
+        Arguments
+        ---------
+        stage: The name of the stage
+        command: The command that runs the stage, including all of its parameters
+        inputs: The files the stage reads
+        code: Additional code files the stage depends on. The scripts in the command and the
+              local modules they import are always included
+
+        Returns
+        -------
+        key: The hex digest identifying this configuration of the stage
+        """
+        code_files = sorted(set(command_code(command)) | set(code))
+        description = {'stage': stage,
+                       'command': list(command),
+                       'inputs': {path: self.file_hash(path) for path in inputs},
+                       'code': {path: self.file_hash(path) for path in code_files}}
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def _load_entry(self, key: str) -> Optional[Dict]:
+        """
+        Load an entry if it exists and all of its outputs are still in the cache, unchanged.
+        Stored outputs whose contents no longer match their hashes are removed
+        """
+        entry_path = self._entry_path(key)
+        if not os.path.exists(entry_path):
+            return None
+        with open(entry_path) as in_file:
+            entry = json.load(in_file)
+        for output in entry['outputs'].values():
+            object_path = self._object_path(output['sha256'])
+            if not os.path.exists(object_path):
+                return None
+            # An output linked to the object may have been edited in place. The saved hash is
+            # reused unless the object has been modified since it was hashed
+            if os.path.getsize(object_path) != output['size'] or \
+                    self.file_hash(object_path) != output['sha256']:
+                os.remove(object_path)
+                return None
+        return entry
+
+    def _link(self, source: str, destination: str) -> None:
+        """Hard link a file, copying it instead if the two paths are on different devices"""
+        if os.path.exists(destination):
+            os.remove(destination)
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copyfile(source, destination)
+
+    def materialize(self, key: str, outputs: Sequence[str]) -> bool:
+        """
+        Link the cached outputs of a stage into place
+
+        Arguments
+        ---------
+        key: The key of the stage's configuration
+        outputs: The paths to link the outputs to
+
+        Returns
+        -------
+        hit: True if the outputs were in the cache and have been linked
+        """
+        with self._lock(exclusive=False):
+            entry = self._load_entry(key)
+            if entry is None or sorted(entry['outputs']) != sorted(outputs):
+                return False
+
+            for path in outputs:
+                sha256 = entry['outputs'][path]['sha256']
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                object_path = self._object_path(sha256)
+                self._link(object_path, path)
+                # Make the output newer than its inputs, so Snakemake considers it up to date
+                os.utime(path)
+                # Save the output's hash, so stages that read it don't need to hash it. The
+                # object shares the output's modification time, so its hash is saved again too
+                self._save_hash(path, sha256)
+                self._save_hash(object_path, sha256)
+
+            entry['last_used'] = time.time()
+            _save_json(self._entry_path(key), entry)
+        return True
+
+    def store(self, key: str, stage: str, outputs: Sequence[str],
+              command: Sequence[str] = ()) -> None:
+        """
+        Add the outputs of a stage to the cache, then evict old entries if the cache is too big
+
+        Arguments
+        ---------
+        key: The key of the stage's configuration
+        stage: The name of the stage
+        outputs: The paths of the outputs the stage wrote
+        command: The command that ran the stage, saved to make the cache easier to inspect
+        """
+        with self._lock(exclusive=True):
+            entry_outputs = {}
+            for path in outputs:
+                sha256 = self.file_hash(path)
+                object_path = self._object_path(sha256)
+                # Replace stored outputs that were edited in place since they were stored
+                if not os.path.exists(object_path) or self.file_hash(object_path) != sha256:
+                    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                    tmp_path = '{}.{}.tmp'.format(object_path, os.getpid())
+                    self._link(path, tmp_path)
+                    os.replace(tmp_path, object_path)
+                    self._save_hash(object_path, sha256)
+                entry_outputs[path] = {'sha256': sha256, 'size': os.path.getsize(path)}
+
+            now = time.time()
+            _save_json(self._entry_path(key), {'stage': stage,
+                                               'command': list(command),
+                                               'outputs': entry_outputs,
+                                               'created': now,
+                                               'last_used': now})
+            self._evict(keep=key)
+
+    def entries(self) -> Dict[str, Dict]:
+        """Load every entry in the cache, keyed by their keys"""
+        entries = {}
+        for name in os.listdir(self.entries_dir):
+            if name.endswith('.json'):
+                with open(os.path.join(self.entries_dir, name)) as in_file:
+                    entries[name[:-len('.json')]] = json.load(in_file)
+        return entries
+
+    def size(self) -> int:
+        """Get the number of bytes of outputs stored in the cache"""
+        return sum(self._object_sizes().values())
+
+    def _object_sizes(self) -> Dict[str, int]:
+        """Get the size of every stored output, keyed by its hash"""
+        sizes = {}
+        for directory, _, names in os.walk(self.objects_dir):
+            for name in names:
+                if not name.endswith('.tmp'):
+                    sizes[os.path.basename(directory) + name] = \
+                        os.path.getsize(os.path.join(directory, name))
+        return sizes
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        """
+        Remove the least recently used entries until the cache fits in its size limit, along
+        with the stored outputs no remaining entry uses. Must be called while holding the
+        exclusive lock
+
+        Arguments
+        ---------
+        keep: A key that shouldn't be evicted, such as the one that was just stored
+        """
+        entries = self.entries()
+        object_sizes = self._object_sizes()
+        size = sum(object_sizes.values())
+        for key in sorted(entries, key=lambda key: entries[key]['last_used']):
+            if size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            os.remove(self._entry_path(key))
+            del entries[key]
+
+            # Outputs can be shared between entries, so only remove the unused ones
+            used = {output['sha256'] for entry in entries.values()
+                    for output in entry['outputs'].values()}
+            for sha256 in list(object_sizes):
+                if sha256 not in used:
+                    os.remove(self._object_path(sha256))
+                    size -= object_sizes.pop(sha256)
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits in its size limit"""
+        with self._lock(exclusive=True):
+            self._evict()
+
+
+def run_cached(cache: ArtifactCache, stage: str, command: List[str], inputs: Sequence[str],
+               outputs: Sequence[str], code: Sequence[str] = ()) -> int:
+    """
+    Link a stage's outputs from the cache, or run it and cache its outputs if they aren't there
+
+    Arguments
+    ---------
+    cache: The cache to use
+    stage: The name of the stage
+    command: The command that runs the stage
+    inputs: The files the stage reads
+    outputs: The files the stage writes
+    code: Additional code files the stage depends on
+
+    Returns
+    -------
+    exit_code: The command's exit code, or 0 if the outputs came from the cache
+    """
+    key = cache.key(stage, command, inputs, code)
+    if cache.materialize(key, outputs):
+        print('{}: using cached outputs {}'.format(stage, key[:12]), file=sys.stderr)
+        return 0
+
+    # Remove old outputs, so the command writes new files instead of overwriting files
+    # that may be linked into the cache
+    for path in outputs:
+        if os.path.exists(path):
+            os.remove(path)
+
+    exit_code = subprocess.call(command)
+    if exit_code != 0:
+        return exit_code
+
+    missing = [path for path in outputs if not os.path.exists(path)]
+    if len(missing) > 0:
+        print('{}: not caching, missing outputs {}'.format(stage, ', '.join(missing)),
+              file=sys.stderr)
+        return exit_code
+    cache.store(key, stage, outputs, command)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cache pipeline outputs by the hashes of '
+                                                 'their inputs, code, and parameters')
+    parser.add_argument('--cache_dir',
+                        help='The directory to keep the cache in. Defaults to the {} '
+                             'environment variable or {}'.format(CACHE_DIR_VARIABLE,
+                                                                 DEFAULT_CACHE_DIR))
+    parser.add_argument('--max_size_gb', type=float, default=DEFAULT_MAX_SIZE_GB,
+                        help='The size the cache is trimmed to, evicting the least '
+                             'recently used outputs first')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run a command unless its outputs are cached')
+    run_parser.add_argument('--stage', required=True, help='The name of the stage')
+    run_parser.add_argument('--inputs', nargs='*', default=[],
+                            help='The files the command reads')
+    run_parser.add_argument('--outputs', nargs='+', required=True,
+                            help='The files the command writes')
+    run_parser.add_argument('--code', nargs='*', default=[],
+                            help='Code the command depends on besides the scripts in the '
+                                 'command and the modules they import')
+    run_parser.add_argument('command', nargs=argparse.REMAINDER,
+                            help='The command to run, after --')
+
+    subparsers.add_parser('list', help='List the cached stages')
+    subparsers.add_parser('evict', help='Trim the cache to --max_size_gb')
+    args = parser.parse_args()
+
+    cache = ArtifactCache(args.cache_dir, args.max_size_gb)
+    if args.action == 'run':
+        command = args.command[1:] if args.command[:1] == ['--'] else args.command
+        if len(command) == 0:
+            parser.error('run needs a command to run after --')
+        sys.exit(run_cached(cache, args.stage, command, args.inputs, args.outputs, args.code))
+    elif args.action == 'list':
+        entries = cache.entries()
+        for key in sorted(entries, key=lambda key: entries[key]['last_used'], reverse=True):
+            entry = entries[key]
+            size = sum(output['size'] for output in entry['outputs'].values())
+            last_used = datetime.datetime.fromtimestamp(entry['last_used'])
+            print('{}\t{}\t{:.1f} MB\tlast used {:%Y-%m-%d %H:%M}\t{}'.format(
+                  key[:12], entry['stage'], size / 2 ** 20, last_used,
+                  ' '.join(entry['command'])))
+        print('Total: {:.1f} MB'.format(cache.size() / 2 ** 20))
+    else:
+        cache.evict()
@@ -0,0 +1,206 @@
+"""
+This file implements a fast way to find LVs that split studies into two clusters.
+In one dimension the optimal two-cluster k-means solution is a split point in the sorted
+values, so every split can be scored at once with prefix sums instead of fitting KMeans.
+The silhouette score of the split can likewise be calculated from prefix sums in
+O(n log n) time instead of the O(n^2) pairwise distances used by sklearn
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+def best_splits(sorted_values: np.ndarray) -> np.ndarray:
+    """
+    Find the split of each column that minimizes the within-cluster sum of squares
+
+    Arguments
+    ---------
+    sorted_values: A samples x LVs array where each column is sorted in ascending order
+
+    Returns
+    -------
+    splits: For each column, the number of samples in the low cluster
+    """
+    n_samples = sorted_values.shape[0]
+    # Centering the columns keeps the prefix sums of squares from losing precision
+    centered = sorted_values - sorted_values.mean(axis=0)
+
+    prefix = np.cumsum(centered, axis=0)
+    prefix_sq = np.cumsum(centered ** 2, axis=0)
+    total = prefix[-1]
+    total_sq = prefix_sq[-1]
+
+    # Row k - 1 corresponds to putting the first k samples in the low cluster
+    left_sizes = np.arange(1, n_samples)[:, None]
+    left_sum = prefix[:-1]
+    left_sq = prefix_sq[:-1]
+    left_sse = left_sq - left_sum ** 2 / left_sizes
+    right_sse = (total_sq - left_sq) - (total - left_sum) ** 2 / (n_samples - left_sizes)
+
+    return np.argmin(left_sse + right_sse, axis=0) + 1
+
+
+def split_silhouettes(sorted_values: np.ndarray, splits: np.ndarray) -> np.ndarray:
+    """
+    Calculate the mean silhouette coefficient of splitting each sorted column in two
+
+    Arguments
+    ---------
+    sorted_values: A samples x LVs array where each column is sorted in ascending order
+    splits: For each column, the number of samples in the low cluster
+
+    Returns
+    -------
+    silhouettes: The mean silhouette coefficient for each column, matching
+                 `sklearn.metrics.silhouette_score`
+    """
+    n_samples = sorted_values.shape[0]
+    x = sorted_values - sorted_values.mean(axis=0)
+
+    # prefix[i] is the sum of the first i values
+    prefix = np.concatenate([np.zeros((1, x.shape[1])), np.cumsum(x, axis=0)])
+    total = prefix[-1]
+
+    index = np.arange(n_samples)[:, None]
+    k = splits[None, :]
+    split_sum = np.take_along_axis(prefix, k, axis=0)
+    in_low = index < k
+
+    # The summed distance from each point to every point below and above it in the column
+    below = index * x - prefix[:-1]
+    above = (total - prefix[1:]) - (n_samples - 1 - index) * x
+
+    # For the low cluster the points above but in the same cluster are those before the split,
+    # and for the high cluster the points below but in the same cluster are those after it
+    split_above = (split_sum - prefix[1:]) - (k - 1 - index) * x
+    split_below = (index - k) * x - (prefix[:-1] - split_sum)
+
+    low_size = k
+    high_size = n_samples - k
+    with np.errstate(invalid='ignore', divide='ignore'):
+        low_within = (below + split_above) / (low_size - 1)
+        low_other = (above - split_above) / high_size
+        high_within = (split_below + above) / (high_size - 1)
+        high_other = (below - split_below) / low_size
+
+        a = np.where(in_low, low_within, high_within)
+        b = np.where(in_low, low_other, high_other)
+        silhouettes = (b - a) / np.maximum(a, b)
+
+    # sklearn assigns zero to points in singleton clusters and to points where a == b == 0
+    singleton = np.where(in_low, low_size == 1, high_size == 1)
+    silhouettes = np.where(singleton | ~np.isfinite(silhouettes), 0, silhouettes)
+
+    return silhouettes.mean(axis=0)
+
+
+def score_bimodality(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Split each column of values into two clusters and score how well separated they are
+
+    Arguments
+    ---------
+    values: A samples x LVs array
+
+    Returns
+    -------
+    scores: The silhouette score of the best two-cluster split of each LV. LVs whose values
+            can't be split into two clusters (fewer than three samples or a constant column)
+            get a score of NaN
+    thresholds: The midpoint between the two clusters of each LV
+    low_counts: The number of samples in the low cluster of each LV
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n_samples, n_lvs = values.shape
+    if n_samples < 3:
+        nan_array = np.full(n_lvs, np.nan)
+        return nan_array, nan_array, np.zeros(n_lvs, dtype=np.int64)
+
+    sorted_values = np.sort(values, axis=0)
+    splits = best_splits(sorted_values)
+    scores = split_silhouettes(sorted_values, splits)
+
+    columns = np.arange(n_lvs)
+    thresholds = (sorted_values[splits - 1, columns] + sorted_values[splits, columns]) / 2
+
+    constant = sorted_values[0] == sorted_values[-1]
+    scores[constant] = np.nan
+    thresholds[constant] = np.nan
+
+    return scores, thresholds, splits
+
+
+def _score_lv_block(values: np.ndarray, study_starts: np.ndarray,
+                    min_samples: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Score a block of LV columns in every study, where samples are sorted by study"""
+    n_studies = len(study_starts) - 1
+    n_lvs = values.shape[1]
+    scores = np.full((n_studies, n_lvs), np.nan)
+    thresholds = np.full((n_studies, n_lvs), np.nan)
+    low_counts = np.zeros((n_studies, n_lvs), dtype=np.int64)
+
+    for i in range(n_studies):
+        start, end = study_starts[i], study_starts[i + 1]
+        if end - start < min_samples:
+            continue
+        scores[i], thresholds[i], low_counts[i] = score_bimodality(values[start:end])
+
+    return scores, thresholds, low_counts
+
+
+def score_studies(lv_df: pd.DataFrame, studies: Sequence[str], min_samples: int = 3,
+                  n_jobs: int = 1, block_size: int = 64) -> pd.DataFrame:
+    """
+    Score how bimodal every LV is within every study
+
+    Arguments
+    ---------
+    lv_df: A samples x LVs dataframe
+    studies: The study each sample in lv_df belongs to
+    min_samples: Studies with fewer samples than this are skipped. Must be at least three
+    n_jobs: The number of threads to score blocks of LVs in
+    block_size: The number of LVs each thread scores at a time
+
+    Returns
+    -------
+    results: A dataframe with one row per (lv, study) pair containing the columns lv, study,
+             n_samples, score, threshold, and n_low
+    """
+    min_samples = max(min_samples, 3)
+    studies = np.asarray(studies)
+    study_codes, study_names = pd.factorize(studies)
+
+    # Sort samples by study once so each study is a contiguous slice
+    order = np.argsort(study_codes, kind='stable')
+    values = lv_df.to_numpy(dtype=np.float64)[order]
+    study_sizes = np.bincount(study_codes, minlength=len(study_names))
+    study_starts = np.concatenate([[0], np.cumsum(study_sizes)])
+
+    n_lvs = values.shape[1]
+    blocks = [slice(start, start + block_size) for start in range(0, n_lvs, block_size)]
+
+    def score_block(block):
+        return _score_lv_block(values[:, block], study_starts, min_samples)
+
+    # numpy releases the GIL while sorting and summing, so threads can score blocks in parallel
+    with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
+        block_results = list(executor.map(score_block, blocks))
+
+    scores = np.concatenate([result[0] for result in block_results], axis=1)
+    thresholds = np.concatenate([result[1] for result in block_results], axis=1)
+    low_counts = np.concatenate([result[2] for result in block_results], axis=1)
+
+    n_studies = len(study_names)
+    results = pd.DataFrame({'lv': np.repeat(np.asarray(lv_df.columns), n_studies),
+                            'study': np.tile(np.asarray(study_names), n_lvs),
+                            'n_samples': np.tile(study_sizes, n_lvs),
+                            'score': scores.T.ravel(),
+                            'threshold': thresholds.T.ravel(),
+                            'n_low': low_counts.T.ravel()})
+    results = results[results['n_samples'] >= min_samples].reset_index(drop=True)
+
+    return results
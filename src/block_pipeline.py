@@ -0,0 +1,201 @@
+"""
+This file implements a three stage pipeline for streaming stages. A reader thread reads and
+parses blocks of rows, the calling thread computes on them, and a writer thread writes the
+results, so reading, computing, and writing overlap instead of taking turns. The stages are
+connected by bounded queues, which limits how far ahead of the slowest stage the others get.
+
+Blocks come from pools of preallocated arrays that are reused once a block is written, so
+streaming a large file doesn't allocate a new array for every chunk. The time each stage
+spends waiting on the others is recorded to show which stage limits throughput
+"""
+
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+# The number of blocks that can wait between two stages
+QUEUE_DEPTH = 2
+# How often blocked stages check whether another stage failed, in seconds
+POLL_INTERVAL = .1
+
+
+class _Finished():
+    """Marks the end of a stream of items"""
+
+
+class BlockPool():
+    def __init__(self, n_blocks: int, shape: Tuple[int, ...], dtype: np.dtype = np.float64):
+        """
+        A fixed set of preallocated arrays that are handed out and returned to be reused
+
+        Arguments
+        ---------
+        n_blocks: The number of arrays to allocate. Acquiring a block waits if all of them are
+                  in use, so this also bounds how many blocks can be in flight
+        shape: The shape of each array
+        dtype: The dtype of each array
+        """
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.free = queue.Queue()
+        for _ in range(n_blocks):
+            self.free.put(np.empty(shape, dtype=self.dtype))
+
+    def acquire(self) -> np.ndarray:
+        """Get an unused block, waiting for one to be released if necessary"""
+        return self.free.get()
+
+    def release(self, block: np.ndarray) -> None:
+        """Return a block to the pool once nothing uses it anymore"""
+        self.free.put(block)
+
+
+class _StageTimer():
+    def __init__(self):
+        self.busy = 0.0
+        self.waiting_for_input = 0.0
+        self.waiting_for_output = 0.0
+
+    def report(self) -> Dict[str, float]:
+        return {'busy_seconds': self.busy,
+                'waiting_for_input_seconds': self.waiting_for_input,
+                'waiting_for_output_seconds': self.waiting_for_output}
+
+
+def _put(item_queue: queue.Queue, item: Any, failed: threading.Event) -> None:
+    """Add an item to a queue, giving up if another stage failed"""
+    while not failed.is_set():
+        try:
+            item_queue.put(item, timeout=POLL_INTERVAL)
+            return
+        except queue.Full:
+            pass
+    raise RuntimeError('Another pipeline stage failed')
+
+
+def _get(item_queue: queue.Queue, failed: threading.Event) -> Any:
+    """Take an item from a queue, giving up if another stage failed"""
+    while not failed.is_set():
+        try:
+            return item_queue.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    raise RuntimeError('Another pipeline stage failed')
+
+
+def run_pipeline(source: Iterable, compute: Callable[[Any], Any],
+                 sink: Optional[Callable[[Any], None]] = None,
+                 queue_depth: int = QUEUE_DEPTH) -> Dict[str, Dict[str, float]]:
+    """
+    Run a reader, compute, and writer stage at the same time
+
+    Arguments
+    ---------
+    source: An iterable that reads the input one block at a time. It is iterated over in a
+            reader thread
+    compute: A function called on each block from the source in the calling thread, in order.
+             It returns the result to pass to the sink, or None if there is nothing to write
+    sink: A function called on each result in a writer thread, in order. If it is None,
+          compute's results are discarded
+    queue_depth: The number of blocks that can wait between two stages
+
+    Returns
+    -------
+    stats: The seconds each stage ('read', 'compute', and 'write') spent working, waiting for
+           input, and waiting for the next stage to accept its output
+    """
+    read_timer = _StageTimer()
+    compute_timer = _StageTimer()
+    write_timer = _StageTimer()
+    read_queue = queue.Queue(maxsize=queue_depth)
+    write_queue = queue.Queue(maxsize=queue_depth)
+    failed = threading.Event()
+    errors = []
+
+    def read():
+        try:
+            iterator = iter(source)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    read_timer.busy += time.perf_counter() - start
+                start = time.perf_counter()
+                _put(read_queue, item, failed)
+                read_timer.waiting_for_output += time.perf_counter() - start
+            _put(read_queue, _Finished, failed)
+        except BaseException as e:
+            # Errors caused by another stage failing first aren't worth reporting
+            if not failed.is_set():
+                errors.append(e)
+            failed.set()
+
+    def write():
+        try:
+            while True:
+                start = time.perf_counter()
+                result = _get(write_queue, failed)
+                write_timer.waiting_for_input += time.perf_counter() - start
+                if result is _Finished:
+                    return
+                start = time.perf_counter()
+                sink(result)
+                write_timer.busy += time.perf_counter() - start
+        except BaseException as e:
+            # Errors caused by another stage failing first aren't worth reporting
+            if not failed.is_set():
+                errors.append(e)
+            failed.set()
+
+    reader = threading.Thread(target=read, daemon=True)
+    writer = threading.Thread(target=write, daemon=True)
+    reader.start()
+    if sink is not None:
+        writer.start()
+
+    try:
+        while True:
+            start = time.perf_counter()
+            item = _get(read_queue, failed)
+            compute_timer.waiting_for_input += time.perf_counter() - start
+            if item is _Finished:
+                break
+
+            start = time.perf_counter()
+            result = compute(item)
+            compute_timer.busy += time.perf_counter() - start
+
+            if result is not None and sink is not None:
+                start = time.perf_counter()
+                _put(write_queue, result, failed)
+                compute_timer.waiting_for_output += time.perf_counter() - start
+
+        if sink is not None:
+            _put(write_queue, _Finished, failed)
+    except BaseException:
+        first_failure = not failed.is_set()
+        failed.set()
+        # If another stage failed first, its error is raised below instead
+        if first_failure:
+            raise
+    finally:
+        # After a failure the reader may be waiting on a block that will never be released,
+        # so don't wait on it forever
+        timeout = 10 * POLL_INTERVAL if failed.is_set() else None
+        reader.join(timeout)
+        if sink is not None:
+            writer.join(timeout)
+
+    if len(errors) > 0:
+        raise errors[0]
+
+    stats = {'read': read_timer.report(), 'compute': compute_timer.report()}
+    if sink is not None:
+        stats['write'] = write_timer.report()
+    return stats
@@ -0,0 +1,518 @@
+"""
+This file contains functions for reading and writing gzip, BGZF, and zstd compressed text
+files as streams, so the pipeline can work on compressed inputs directly instead of needing
+a decompressed copy on disk.
+
+Decompression runs in background threads (or a zstd process), so it overlaps with parsing.
+BGZF files, which bgzip writes and which any gzip reader can also read, are made of
+independent blocks of at most 64 KB. They are decompressed and compressed several blocks at
+a time in parallel, and can be split into shards at block boundaries. Other gzip and zstd
+files have to be decompressed from the start in one stream
+"""
+
+import argparse
+import gzip
+import io
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Iterator, List, Optional, Tuple
+
+# The number of threads used to decompress or compress BGZF blocks
+THREADS = min(4, os.cpu_count() or 1)
+# The number of BGZF blocks each thread decompresses or compresses at once
+BLOCKS_PER_TASK = 16
+# The number of decompressed bytes to read from a stream at once
+CHUNK_SIZE = 2 ** 20
+# The number of chunks a background decompression thread can get ahead of the reader
+QUEUE_DEPTH = 8
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# A BGZF block starts with a gzip header with the FEXTRA flag set, and its extra field holds
+# a 'BC' subfield with the size of the block
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BGZF_HEADER_SIZE = 18
+# The most uncompressed data bgzip puts in a block, which keeps every compressed block
+# under the 64 KB limit even if the data doesn't compress
+BGZF_BLOCK_DATA_SIZE = 65280
+# The empty block that marks the end of a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+MAX_BGZF_BLOCK_SIZE = 2 ** 16
+
+
+def detect_compression(path: str) -> Optional[str]:
+    """
+    Find the compression format of a file from its first bytes
+
+    Arguments
+    ---------
+    path: The path to the file
+
+    Returns
+    -------
+    compression: 'bgzip', 'gzip', 'zstd', or None for uncompressed files
+    """
+    with open(path, 'rb') as in_file:
+        start = in_file.read(BGZF_HEADER_SIZE)
+    if start.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    if not start.startswith(GZIP_MAGIC):
+        return None
+    if _bgzf_block_size(start) is not None:
+        return 'bgzip'
+    return 'gzip'
+
+
+def infer_compression(path: str) -> Optional[str]:
+    """
+    Choose the compression format to write a file in from its extension. gzip files are
+    written as BGZF, which gzip tools read like any other gzip file
+
+    Arguments
+    ---------
+    path: The path to the file
+
+    Returns
+    -------
+    compression: 'bgzip', 'zstd', or None for uncompressed files
+    """
+    if path.endswith('.gz') or path.endswith('.bgz'):
+        return 'bgzip'
+    if path.endswith('.zst'):
+        return 'zstd'
+    return None
+
+
+def _bgzf_block_size(header: bytes) -> Optional[int]:
+    """Get the total size of a BGZF block from its header, or None if it isn't one"""
+    if len(header) < BGZF_HEADER_SIZE or not header.startswith(BGZF_MAGIC):
+        return None
+    extra_length = struct.unpack('<H', header[10:12])[0]
+    extra = header[12:12 + extra_length]
+    # Look through the extra subfields for the block size
+    position = 0
+    while position + 4 <= len(extra):
+        field_id = extra[position:position + 2]
+        field_length = struct.unpack('<H', extra[position + 2:position + 4])[0]
+        if field_id == b'BC' and field_length == 2 and position + 6 <= len(extra):
+            return struct.unpack('<H', extra[position + 4:position + 6])[0] + 1
+        position += 4 + field_length
+    return None
+
+
+def next_bgzf_block(path: str, offset: int) -> int:
+    """
+    Find the first BGZF block that starts at or after an offset
+
+    Arguments
+    ---------
+    path: The BGZF file
+    offset: The byte offset to start looking from
+
+    Returns
+    -------
+    block_offset: The offset of the block, or the file's size if no block starts after offset
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as in_file:
+        in_file.seek(offset)
+        # A block starts within 64 KB of any offset, and the block after it is read too to
+        # make sure the match isn't compressed data that happens to look like a header
+        window = in_file.read(2 * MAX_BGZF_BLOCK_SIZE + BGZF_HEADER_SIZE)
+
+    position = window.find(BGZF_MAGIC)
+    while position >= 0:
+        block_size = _bgzf_block_size(window[position:position + BGZF_HEADER_SIZE])
+        if block_size is not None:
+            next_position = position + block_size
+            if offset + next_position == size or \
+                    _bgzf_block_size(window[next_position:next_position + BGZF_HEADER_SIZE]):
+                return offset + position
+        position = window.find(BGZF_MAGIC, position + 1)
+    return size
+
+
+def _split_bgzf_blocks(data: bytes) -> Tuple[List[Tuple[int, int]], int]:
+    """Find the (start, end) of each complete block in a buffer, and where the rest starts"""
+    blocks = []
+    position = 0
+    while position + BGZF_HEADER_SIZE <= len(data):
+        block_size = _bgzf_block_size(data[position:position + BGZF_HEADER_SIZE])
+        if block_size is None:
+            raise ValueError('Invalid BGZF block header')
+        if position + block_size > len(data):
+            break
+        blocks.append((position, position + block_size))
+        position += block_size
+    return blocks, position
+
+
+def _inflate_blocks(data: bytes, blocks: List[Tuple[int, int]]) -> List[bytes]:
+    """Decompress BGZF blocks and check their lengths and checksums"""
+    decompressed = []
+    for start, end in blocks:
+        header_size = 12 + struct.unpack('<H', data[start + 10:start + 12])[0]
+        block = zlib.decompress(data[start + header_size:end - 8], -zlib.MAX_WBITS)
+        crc, size = struct.unpack('<II', data[end - 8:end])
+        if len(block) != size or zlib.crc32(block) != crc:
+            raise ValueError('Corrupt BGZF block')
+        decompressed.append(block)
+    return decompressed
+
+
+def read_bgzf_blocks(path: str, start: int = 0,
+                     threads: int = THREADS) -> Iterator[Tuple[int, bytes]]:
+    """
+    Decompress the blocks of a BGZF file in parallel, in order
+
+    Arguments
+    ---------
+    path: The BGZF file
+    start: The offset of the block to start at
+    threads: The number of threads to decompress blocks with
+
+    Returns
+    -------
+    blocks: The offset of each block in the file and its decompressed data
+    """
+    read_size = BLOCKS_PER_TASK * MAX_BGZF_BLOCK_SIZE
+    with open(path, 'rb') as in_file, ThreadPoolExecutor(max_workers=threads) as executor:
+        in_file.seek(start)
+        pending = deque()
+        data = b''
+        data_offset = start
+        at_end = False
+        while not at_end or len(pending) > 0:
+            # Keep every thread busy, plus one task waiting for each
+            while not at_end and len(pending) < 2 * threads:
+                new_data = in_file.read(read_size)
+                at_end = len(new_data) == 0
+                data += new_data
+                blocks, used = _split_bgzf_blocks(data)
+                if at_end and used < len(data):
+                    raise ValueError('{} ends with an incomplete BGZF block'.format(path))
+                if len(blocks) > 0:
+                    offsets = [data_offset + block_start for block_start, _ in blocks]
+                    pending.append((offsets, executor.submit(_inflate_blocks, data, blocks)))
+                data = data[used:]
+                data_offset += used
+
+            if len(pending) > 0:
+                offsets, future = pending.popleft()
+                yield from zip(offsets, future.result())
+
+
+def _background_chunks(read, close=None, depth: int = QUEUE_DEPTH) -> Iterator[bytes]:
+    """
+    Call a read function in a background thread until it returns no data, passing the
+    chunks it returns back through a bounded queue
+
+    Arguments
+    ---------
+    read: A function that returns the next chunk of data, or b'' at the end
+    close: A function to call in the thread once reading stops
+    depth: The number of chunks the thread can get ahead
+    """
+    chunks = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(item) -> None:
+        while not stopped.is_set():
+            try:
+                chunks.put(item, timeout=.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        try:
+            while not stopped.is_set():
+                chunk = read()
+                put(chunk)
+                if len(chunk) == 0:
+                    return
+        except BaseException as e:
+            put(e)
+        finally:
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, BaseException):
+                raise chunk
+            if len(chunk) == 0:
+                return
+            yield chunk
+    finally:
+        # Stop the thread if the reader stops early
+        stopped.set()
+
+
+class _ChunkReader(io.RawIOBase):
+    def __init__(self, chunks: Iterator[bytes]):
+        """A readable binary stream of the data in an iterator of chunks"""
+        self.chunks = chunks
+        self.chunk = b''
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while self.position == len(self.chunk):
+            self.chunk = next(self.chunks, b'')
+            self.position = 0
+            if len(self.chunk) == 0:
+                return 0
+        n_bytes = min(len(buffer), len(self.chunk) - self.position)
+        buffer[:n_bytes] = self.chunk[self.position:self.position + n_bytes]
+        self.position += n_bytes
+        return n_bytes
+
+    def close(self) -> None:
+        if not self.closed and hasattr(self.chunks, 'close'):
+            self.chunks.close()
+        super().close()
+
+
+def _zstd_chunks(path: str) -> Iterator[bytes]:
+    """Decompress a zstd file with the zstandard package, or a zstd process without it"""
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+
+    if zstandard is not None:
+        raw_file = open(path, 'rb')
+        reader = zstandard.ZstdDecompressor().stream_reader(raw_file, read_size=CHUNK_SIZE,
+                                                            closefd=True)
+        return _background_chunks(lambda: reader.read(CHUNK_SIZE), reader.close)
+
+    if shutil.which('zstd') is None:
+        raise ImportError('Reading zstd files requires the zstandard package or the zstd '
+                          'command')
+    process = subprocess.Popen(['zstd', '-d', '-c', '-q', path], stdout=subprocess.PIPE)
+
+    def close():
+        process.stdout.close()
+        if process.wait() not in (0, -13):
+            print('zstd exited with code {}'.format(process.returncode), file=sys.stderr)
+
+    return _background_chunks(lambda: process.stdout.read(CHUNK_SIZE), close)
+
+
+def open_input(path: str, mode: str = 'r', compression: Optional[str] = 'detect',
+               threads: int = THREADS) -> IO:
+    """
+    Open a file that may be compressed for reading, decompressing it in the background
+
+    Arguments
+    ---------
+    path: The file to read
+    mode: 'r' to read text or 'rb' to read bytes
+    compression: 'bgzip', 'gzip', 'zstd', None, or 'detect' to choose from the file's
+                 first bytes
+    threads: The number of threads to decompress BGZF blocks with
+
+    Returns
+    -------
+    in_file: An open file object
+    """
+    if mode not in ('r', 'rb'):
+        raise ValueError('Unsupported mode {}'.format(mode))
+    if compression == 'detect':
+        compression = detect_compression(path)
+
+    if compression is None:
+        return open(path, mode)
+    if compression == 'bgzip':
+        # Empty blocks mark the end of a file, but several files can be concatenated
+        chunks = (data for _, data in read_bgzf_blocks(path, threads=threads) if len(data) > 0)
+    elif compression == 'gzip':
+        gzip_file = gzip.open(path, 'rb')
+        chunks = _background_chunks(lambda: gzip_file.read(CHUNK_SIZE), gzip_file.close)
+    elif compression == 'zstd':
+        chunks = _zstd_chunks(path)
+    else:
+        raise ValueError('Unknown compression {}'.format(compression))
+
+    in_file = io.BufferedReader(_ChunkReader(chunks), buffer_size=CHUNK_SIZE)
+    if mode == 'r':
+        return io.TextIOWrapper(in_file)
+    return in_file
+
+
+def _deflate_blocks(data: bytes, compresslevel: int) -> bytes:
+    """Compress data into BGZF blocks"""
+    blocks = []
+    for start in range(0, len(data), BGZF_BLOCK_DATA_SIZE):
+        block = data[start:start + BGZF_BLOCK_DATA_SIZE]
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = compressor.compress(block) + compressor.flush()
+        header = BGZF_MAGIC + b'\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + \
+            struct.pack('<H', len(compressed) + BGZF_HEADER_SIZE + 8 - 1)
+        blocks.append(header + compressed + struct.pack('<II', zlib.crc32(block), len(block)))
+    return b''.join(blocks)
+
+
+class BgzfWriter(io.RawIOBase):
+    def __init__(self, path: str, compresslevel: int = 6, threads: int = THREADS):
+        """
+        A binary file that compresses data into BGZF blocks in parallel as it's written
+
+        Arguments
+        ---------
+        path: The file to write to
+        compresslevel: The zlib compression level to use
+        threads: The number of threads to compress blocks with
+        """
+        self.out_file = open(path, 'wb')
+        self.compresslevel = compresslevel
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.pending = deque()
+
+    def writable(self) -> bool:
+        return True
+
+    def _submit(self, data: bytes) -> None:
+        self.pending.append(self.executor.submit(_deflate_blocks, data, self.compresslevel))
+        # Write finished blocks once enough are in flight to keep every thread busy
+        while len(self.pending) > 2 * self.threads:
+            self.out_file.write(self.pending.popleft().result())
+
+    def write(self, data) -> int:
+        self.buffer.append(bytes(data))
+        self.buffered_bytes += len(data)
+        task_size = BLOCKS_PER_TASK * BGZF_BLOCK_DATA_SIZE
+        if self.buffered_bytes >= task_size:
+            buffered = b''.join(self.buffer)
+            # Only whole blocks are compressed until the file is closed
+            n_tasks = len(buffered) // task_size
+            for task in range(n_tasks):
+                self._submit(buffered[task * task_size:(task + 1) * task_size])
+            self.buffer = [buffered[n_tasks * task_size:]]
+            self.buffered_bytes = len(self.buffer[0])
+        return len(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if self.buffered_bytes > 0:
+                self._submit(b''.join(self.buffer))
+            while len(self.pending) > 0:
+                self.out_file.write(self.pending.popleft().result())
+            self.out_file.write(BGZF_EOF)
+        finally:
+            self.executor.shutdown()
+            self.out_file.close()
+            super().close()
+
+
+class _ProcessWriter(io.RawIOBase):
+    def __init__(self, command: List[str], path: str):
+        """A binary file that pipes data to a compression process writing to path"""
+        self.out_file = open(path, 'wb')
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self.out_file)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.process.stdin.write(data)
+        return len(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.process.stdin.close()
+        exit_code = self.process.wait()
+        self.out_file.close()
+        super().close()
+        if exit_code != 0:
+            raise OSError('{} exited with code {}'.format(self.process.args[0], exit_code))
+
+
+def open_output(path: str, mode: str = 'w', compression: Optional[str] = 'infer',
+                compresslevel: int = 3, threads: int = THREADS) -> IO:
+    """
+    Open a file for writing, compressing it as it's written
+
+    Arguments
+    ---------
+    path: The file to write
+    mode: 'w' to write text or 'wb' to write bytes
+    compression: 'bgzip', 'gzip', 'zstd', None, or 'infer' to choose from the extension
+    compresslevel: The compression level to use
+    threads: The number of threads to compress with
+
+    Returns
+    -------
+    out_file: An open file object
+    """
+    if mode not in ('w', 'wb'):
+        raise ValueError('Unsupported mode {}'.format(mode))
+    if compression == 'infer':
+        compression = infer_compression(path)
+
+    if compression is None:
+        return open(path, mode)
+    if compression == 'bgzip':
+        out_file = io.BufferedWriter(BgzfWriter(path, compresslevel, threads),
+                                     buffer_size=CHUNK_SIZE)
+    elif compression == 'gzip':
+        out_file = gzip.open(path, 'wb', compresslevel=compresslevel)
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            zstandard = None
+        if zstandard is not None:
+            compressor = zstandard.ZstdCompressor(level=compresslevel, threads=threads)
+            out_file = compressor.stream_writer(open(path, 'wb'), closefd=True)
+        elif shutil.which('zstd') is not None:
+            command = ['zstd', '-q', '-c', '-{}'.format(compresslevel), '-T{}'.format(threads)]
+            out_file = io.BufferedWriter(_ProcessWriter(command, path), buffer_size=CHUNK_SIZE)
+        else:
+            raise ImportError('Writing zstd files requires the zstandard package or the zstd '
+                              'command')
+    else:
+        raise ValueError('Unknown compression {}'.format(compression))
+
+    if mode == 'w':
+        return io.TextIOWrapper(out_file)
+    return out_file
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Recompress a file, e.g. a gzip count matrix into BGZF so it can be '
+                    'decompressed in parallel and split into shards')
+    parser.add_argument('in_file', help='The file to read. Its compression is detected')
+    parser.add_argument('out_file', help='The file to write. Its compression is chosen from '
+                                         'its extension: .gz or .bgz for BGZF, .zst for zstd')
+    parser.add_argument('--compresslevel', type=int, default=3,
+                        help='The compression level to use')
+    parser.add_argument('--threads', type=int, default=THREADS,
+                        help='The number of threads to decompress and compress with')
+    args = parser.parse_args()
+
+    with open_input(args.in_file, 'rb', threads=args.threads) as in_file, \
+            open_output(args.out_file, 'wb', compresslevel=args.compresslevel,
+                        threads=args.threads) as out_file:
+        shutil.copyfileobj(in_file, out_file, CHUNK_SIZE)
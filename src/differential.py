@@ -0,0 +1,437 @@
+"""
+This file implements vectorized tests for differences in LV values between experimental groups.
+Every test is computed for all LVs and all strata (e.g. each day x region combination) at once
+from per-group sums, instead of fitting one model per LV per stratum
+"""
+
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse, stats
+
+METHODS = ['anova', 'student', 'welch', 'rank_sum', 'permutation']
+
+
+def benjamini_hochberg(pvalues: np.ndarray) -> np.ndarray:
+    """
+    Adjust p-values for multiple testing with the Benjamini-Hochberg procedure. This matches
+    R's `p.adjust(pvalues, 'BH')`, including ignoring NaNs when counting the number of tests
+
+    Arguments
+    ---------
+    pvalues: The p-values to adjust
+
+    Returns
+    -------
+    adjusted: The adjusted p-values in the same order as the input
+    """
+    pvalues = np.asarray(pvalues, dtype=float)
+    adjusted = np.full(pvalues.shape, np.nan)
+
+    present = ~np.isnan(pvalues)
+    p = pvalues[present]
+    n_tests = len(p)
+    if n_tests == 0:
+        return adjusted
+
+    # Walk from the largest p-value to the smallest, keeping the running minimum
+    order = np.argsort(p)[::-1]
+    ranks = np.arange(n_tests, 0, -1)
+    scaled = np.minimum.accumulate(p[order] * n_tests / ranks)
+
+    result = np.empty(n_tests)
+    result[order] = np.minimum(scaled, 1)
+    adjusted[present] = result
+
+    return adjusted
+
+
+def encode_columns(design: pd.DataFrame, columns: Sequence[str]) -> Tuple[np.ndarray,
+                                                                         pd.DataFrame]:
+    """
+    Assign an integer code to each unique combination of values in the given columns
+
+    Arguments
+    ---------
+    design: A dataframe with one row per sample
+    columns: The columns whose combinations define the codes. If empty, every sample gets
+             the same code
+
+    Returns
+    -------
+    codes: The code for each sample
+    levels: A dataframe whose i-th row holds the column values for code i, sorted
+    """
+    if len(columns) == 0:
+        return np.zeros(len(design), dtype=np.int64), pd.DataFrame(index=[0])
+
+    codes, uniques = pd.MultiIndex.from_frame(design[list(columns)]).factorize(sort=True)
+    levels = uniques.to_frame(index=False)
+    levels.columns = list(columns)
+    return codes, levels
+
+
+def _indicator(codes: np.ndarray, n_codes: int) -> sparse.csr_matrix:
+    """Create a sparse codes x samples matrix with a one where each sample has each code"""
+    n_samples = len(codes)
+    return sparse.csr_matrix((np.ones(n_samples), (codes, np.arange(n_samples))),
+                             shape=(n_codes, n_samples))
+
+
+def cell_moments(values: np.ndarray, cells: np.ndarray,
+                 n_cells: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Calculate the size, mean, and sum of squared deviations of every cell for every column
+
+    Arguments
+    ---------
+    values: A samples x LVs array
+    cells: The cell each sample belongs to
+    n_cells: The total number of cells
+
+    Returns
+    -------
+    counts: The number of samples in each cell
+    means: A cells x LVs array of means
+    M2: A cells x LVs array of sums of squared deviations from the cell means
+    """
+    indicator = _indicator(cells, n_cells)
+    counts = np.asarray(indicator.sum(axis=1)).ravel()
+
+    sums = indicator @ values
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts[:, None]
+    means[counts == 0] = 0
+
+    # Centering before squaring avoids the cancellation in sum(x^2) - sum(x)^2 / n
+    centered = values - means[cells]
+    M2 = indicator @ (centered ** 2)
+
+    return counts, means, M2
+
+
+def one_way_anova(values: np.ndarray, strata: np.ndarray, groups: np.ndarray,
+                  n_strata: int, n_groups: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Run a one-way ANOVA comparing the groups within each stratum, for every LV at once.
+    With two groups this is equivalent to Student's t-test
+
+    Arguments
+    ---------
+    values: A samples x LVs array
+    strata: The stratum code for each sample
+    groups: The group code for each sample
+    n_strata: The number of strata
+    n_groups: The number of groups
+
+    Returns
+    -------
+    f_stats: A strata x LVs array of F statistics
+    pvalues: A strata x LVs array of p-values
+    """
+    cells = strata * n_groups + groups
+    counts, means, M2 = cell_moments(values, cells, n_strata * n_groups)
+
+    counts = counts.reshape(n_strata, n_groups)
+    means = means.reshape(n_strata, n_groups, -1)
+    M2 = M2.reshape(n_strata, n_groups, -1)
+
+    stratum_counts = counts.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        grand_means = (counts[:, :, None] * means).sum(axis=1) / stratum_counts[:, None]
+
+        ss_between = (counts[:, :, None] * (means - grand_means[:, None, :]) ** 2).sum(axis=1)
+        ss_within = M2.sum(axis=1)
+
+        groups_present = (counts > 0).sum(axis=1)
+        df_between = (groups_present - 1)[:, None]
+        df_within = (stratum_counts - groups_present)[:, None]
+
+        f_stats = (ss_between / df_between) / (ss_within / df_within)
+        pvalues = stats.f.sf(f_stats, df_between, df_within)
+
+    invalid = (df_between < 1) | (df_within < 1)
+    f_stats = np.where(invalid, np.nan, f_stats)
+    pvalues = np.where(invalid, np.nan, pvalues)
+
+    return f_stats, pvalues
+
+
+def two_group_t_test(values: np.ndarray, cells: np.ndarray, n_cells: int,
+                     control_cells: np.ndarray, treatment_cells: np.ndarray,
+                     equal_var: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compare pairs of cells with a t-test, for every LV at once
+
+    Arguments
+    ---------
+    values: A samples x LVs array
+    cells: The cell each sample belongs to
+    n_cells: The total number of cells
+    control_cells: The control cell of each comparison
+    treatment_cells: The treatment cell of each comparison
+    equal_var: True for Student's t-test, False for Welch's t-test
+
+    Returns
+    -------
+    t_stats: A comparisons x LVs array of t statistics (positive when treatment > control)
+    pvalues: A comparisons x LVs array of two-sided p-values
+    """
+    counts, means, M2 = cell_moments(values, cells, n_cells)
+
+    n_c = counts[control_cells][:, None]
+    n_t = counts[treatment_cells][:, None]
+    diff = means[treatment_cells] - means[control_cells]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if equal_var:
+            dof = n_c + n_t - 2
+            pooled_var = (M2[control_cells] + M2[treatment_cells]) / dof
+            se = np.sqrt(pooled_var * (1 / n_c + 1 / n_t))
+            dof = np.broadcast_to(dof, diff.shape)
+        else:
+            var_c = M2[control_cells] / (n_c - 1) / n_c
+            var_t = M2[treatment_cells] / (n_t - 1) / n_t
+            se = np.sqrt(var_c + var_t)
+            dof = (var_c + var_t) ** 2 / (var_c ** 2 / (n_c - 1) + var_t ** 2 / (n_t - 1))
+
+        t_stats = diff / se
+        pvalues = 2 * stats.t.sf(np.abs(t_stats), dof)
+
+    return t_stats, pvalues
+
+
+def rank_within_strata(values: np.ndarray, strata: np.ndarray,
+                       method: str = 'average') -> np.ndarray:
+    """
+    Rank each column of values separately within each stratum
+
+    Arguments
+    ---------
+    values: A samples x LVs array
+    strata: The stratum code for each sample
+    method: The tie handling method passed to `scipy.stats.rankdata`
+
+    Returns
+    -------
+    ranks: A samples x LVs array of ranks starting at one within each stratum
+    """
+    # Global ranks are at most n, so offsetting them by stratum * (n + 1) sorts samples by
+    # stratum first while keeping the order and ties within each stratum
+    n_samples = len(values)
+    global_ranks = stats.rankdata(values, method='average', axis=0)
+    keys = global_ranks + (strata * (n_samples + 1))[:, None]
+    ranks = stats.rankdata(keys, method=method, axis=0)
+
+    # Subtract the number of samples in earlier strata
+    stratum_sizes = np.bincount(strata)
+    stratum_starts = np.concatenate([[0], np.cumsum(stratum_sizes)[:-1]])
+    return ranks - stratum_starts[strata][:, None]
+
+
+def rank_sum_test(values: np.ndarray, strata: np.ndarray, is_treatment: np.ndarray,
+                  n_strata: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Run a Mann-Whitney U test in each stratum for every LV at once, using the normal
+    approximation with tie and continuity corrections (as in R's `wilcox.test(exact=FALSE)`)
+
+    Arguments
+    ---------
+    values: A samples x LVs array containing only control and treatment samples
+    strata: The stratum code for each sample
+    is_treatment: True for treatment samples and False for control samples
+    n_strata: The number of strata
+
+    Returns
+    -------
+    u_stats: A strata x LVs array of U statistics for the treatment group
+    pvalues: A strata x LVs array of two-sided p-values
+    """
+    ranks = rank_within_strata(values, strata)
+    # Every sample in a group of t tied values has max - min + 1 == t
+    tie_sizes = (rank_within_strata(values, strata, 'max')
+                 - rank_within_strata(values, strata, 'min') + 1)
+
+    cells = strata * 2 + is_treatment.astype(np.int64)
+    indicator = _indicator(cells, n_strata * 2)
+    counts = np.asarray(indicator.sum(axis=1)).ravel().reshape(n_strata, 2)
+    rank_sums = (indicator @ ranks).reshape(n_strata, 2, -1)
+
+    # Each tie group contributes t^3 - t, which is the sum of t^2 - 1 over its members
+    tie_term = _indicator(strata, n_strata) @ (tie_sizes ** 2 - 1)
+
+    n_c = counts[:, 0][:, None]
+    n_t = counts[:, 1][:, None]
+    n = n_c + n_t
+
+    u_stats = rank_sums[:, 1] - n_t * (n_t + 1) / 2
+    mean_u = n_c * n_t / 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var_u = n_c * n_t / 12 * ((n + 1) - tie_term / (n * (n - 1)))
+        deviation = np.abs(u_stats - mean_u) - 0.5
+        z = np.maximum(deviation, 0) / np.sqrt(var_u)
+        pvalues = np.minimum(2 * stats.norm.sf(z), 1)
+
+    invalid = (n_c == 0) | (n_t == 0) | (var_u <= 0)
+    pvalues = np.where(invalid, np.nan, pvalues)
+
+    return u_stats, pvalues
+
+
+def permutation_test(values: np.ndarray, is_treatment: np.ndarray, n_permutations: int,
+                     rng: np.random.Generator,
+                     batch_size: int = 1000) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Test for a difference in means between two groups by permuting the group labels. Each
+    batch of permutations is evaluated for every LV with one matrix product
+
+    Arguments
+    ---------
+    values: A samples x LVs array containing only control and treatment samples
+    is_treatment: True for treatment samples and False for control samples
+    n_permutations: The number of label permutations to evaluate
+    rng: The random number generator used to draw permutations
+    batch_size: The number of permutations to evaluate at once
+
+    Returns
+    -------
+    diffs: The difference between treatment and control means for each LV
+    pvalues: The two-sided permutation p-value for each LV
+    """
+    n_samples = len(values)
+    n_t = is_treatment.sum()
+    n_c = n_samples - n_t
+    if n_t == 0 or n_c == 0:
+        nan_array = np.full(values.shape[1], np.nan)
+        return nan_array, nan_array
+
+    # mean_t - mean_c == sum_t * (1 / n_t + 1 / n_c) - total / n_c
+    totals = values.sum(axis=0)
+    scale = 1 / n_t + 1 / n_c
+    diffs = values[is_treatment].sum(axis=0) * scale - totals / n_c
+    # Allow for floating point error when permutations reproduce the observed statistic
+    threshold = np.abs(diffs) * (1 - 1e-12)
+
+    exceed_counts = np.zeros(values.shape[1])
+    for start in range(0, n_permutations, batch_size):
+        current_batch = min(batch_size, n_permutations - start)
+        # Marking the n_t smallest of a set of random numbers picks a uniform random subset
+        random_order = rng.random((current_batch, n_samples)).argsort(axis=1).argsort(axis=1)
+        permuted_labels = (random_order < n_t).astype(values.dtype)
+
+        permuted_diffs = (permuted_labels @ values) * scale - totals / n_c
+        exceed_counts += (np.abs(permuted_diffs) >= threshold).sum(axis=0)
+
+    pvalues = (exceed_counts + 1) / (n_permutations + 1)
+    return diffs, pvalues
+
+
+def differential_lvs(lv_df: pd.DataFrame, design: pd.DataFrame, group_column: str,
+                     strata_columns: Sequence[str] = (), method: str = 'anova',
+                     control: Optional[str] = None, n_permutations: int = 10000,
+                     seed: int = 42) -> pd.DataFrame:
+    """
+    Test every LV for differences between groups within every stratum
+
+    Arguments
+    ---------
+    lv_df: A samples x LVs dataframe
+    design: A dataframe indexed by sample containing the group and strata columns
+    group_column: The design column containing the experimental group of each sample
+    strata_columns: The design columns that define separate strata to test in
+    method: 'anova' to test for any difference between groups, or 'student', 'welch',
+            'rank_sum', or 'permutation' to compare each group to the control group
+    control: The control group, required for all methods except 'anova'
+    n_permutations: The number of permutations used by the 'permutation' method
+    seed: The seed for the permutation method's random number generator
+
+    Returns
+    -------
+    results: A dataframe with the LV_ID, strata columns, the treatment group for two-group
+             methods, and the statistic, pvalue and adjusted_p (BH adjusted over all tests)
+             of each test. Rows are ordered by LV, then stratum, then treatment
+    """
+    if method not in METHODS:
+        raise ValueError('Unknown method {}, expected one of {}'.format(method, METHODS))
+
+    missing = lv_df.index.difference(design.index)
+    if len(missing) > 0:
+        raise KeyError('Samples {} are missing from the design'.format(list(missing)))
+    design = design.loc[lv_df.index]
+
+    values = lv_df.to_numpy(dtype=np.float64)
+    lv_names = np.asarray(lv_df.columns)
+    strata, strata_levels = encode_columns(design, strata_columns)
+    n_strata = len(strata_levels)
+    groups, group_levels = pd.factorize(design[group_column], sort=True)
+    group_levels = list(group_levels)
+
+    # Each block is a comparisons x LVs array along with a dataframe describing the comparisons
+    blocks: List[Tuple[pd.DataFrame, np.ndarray, np.ndarray]] = []
+
+    if method == 'anova':
+        statistic, pvalues = one_way_anova(values, strata, groups, n_strata, len(group_levels))
+        blocks.append((strata_levels, statistic, pvalues))
+    else:
+        if control not in group_levels:
+            raise ValueError('Control group {} not found in {}, which contains {}'.format(
+                             control, group_column, group_levels))
+        control_code = group_levels.index(control)
+        treatment_codes = [code for code in range(len(group_levels)) if code != control_code]
+
+        rng = np.random.default_rng(seed)
+        for treatment_code in treatment_codes:
+            comparisons = strata_levels.copy()
+            comparisons[group_column] = group_levels[treatment_code]
+            stratum_codes = np.arange(n_strata)
+
+            if method in ('student', 'welch'):
+                n_groups = len(group_levels)
+                cells = strata * n_groups + groups
+                statistic, pvalues = two_group_t_test(
+                    values, cells, n_strata * n_groups,
+                    stratum_codes * n_groups + control_code,
+                    stratum_codes * n_groups + treatment_code,
+                    equal_var=(method == 'student'))
+            else:
+                in_pair = (groups == control_code) | (groups == treatment_code)
+                pair_values = values[in_pair]
+                pair_strata = strata[in_pair]
+                is_treatment = groups[in_pair] == treatment_code
+
+                if method == 'rank_sum':
+                    statistic, pvalues = rank_sum_test(pair_values, pair_strata, is_treatment,
+                                                       n_strata)
+                else:
+                    statistic = np.full((n_strata, len(lv_names)), np.nan)
+                    pvalues = np.full((n_strata, len(lv_names)), np.nan)
+                    for stratum in range(n_strata):
+                        in_stratum = pair_strata == stratum
+                        statistic[stratum], pvalues[stratum] = permutation_test(
+                            pair_values[in_stratum], is_treatment[in_stratum], n_permutations,
+                            rng)
+
+            blocks.append((comparisons, statistic, pvalues))
+
+    result_dfs = []
+    for comparisons, statistic, pvalues in blocks:
+        n_comparisons = len(comparisons)
+        block_df = comparisons.iloc[np.tile(np.arange(n_comparisons), len(lv_names))]
+        block_df = block_df.reset_index(drop=True)
+        block_df.insert(0, 'LV_ID', np.repeat(lv_names, n_comparisons))
+        block_df['lv_order'] = np.repeat(np.arange(len(lv_names)), n_comparisons)
+        block_df['comparison_order'] = np.tile(np.arange(n_comparisons), len(lv_names))
+        # Arrays are comparisons x LVs, transpose so LVs vary slowest
+        block_df['statistic'] = statistic.T.ravel()
+        block_df['pvalue'] = pvalues.T.ravel()
+        result_dfs.append(block_df)
+
+    results = pd.concat(result_dfs, ignore_index=True)
+    # Blocks are added in treatment order, so a stable sort leaves treatments ordered last
+    results = results.sort_values(['lv_order', 'comparison_order'], kind='stable')
+    results = results.drop(columns=['lv_order', 'comparison_order'])
+    results = results.reset_index(drop=True)
+    results['adjusted_p'] = benjamini_hochberg(results['pvalue'].to_numpy())
+
+    return results
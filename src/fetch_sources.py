@@ -0,0 +1,349 @@
+"""
+This script downloads the Reactome pathway and CellMarker files used to build the pathway
+matrix. The files are downloaded concurrently, interrupted downloads are resumed where they
+left off, and files that haven't changed on the server aren't downloaded again.
+
+The URL, ETag, Last-Modified date, size, and SHA-256 hash of every file are saved in a
+manifest. A file is only replaced when its content changes, so rerunning this script
+doesn't update the modification times that Snakemake uses to decide what to rerun
+"""
+
+import argparse
+import asyncio
+import datetime
+import hashlib
+import http.client
+import json
+import os
+import shutil
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+SOURCES = {
+    'Ensembl2Reactome_All_Levels.txt':
+        'https://reactome.org/download/current/Ensembl2Reactome_All_Levels.txt',
+    'ReactomePathways.txt': 'https://reactome.org/download/current/ReactomePathways.txt',
+    'ReactomePathwaysRelation.txt':
+        'https://reactome.org/download/current/ReactomePathwaysRelation.txt',
+    'Mouse_cell_markers.txt':
+        'http://biocc.hrbmu.edu.cn/CellMarker/download/Mouse_cell_markers.txt',
+}
+MANIFEST_FILE = 'sources_manifest.json'
+# The number of bytes to read from the network and hash at once
+CHUNK_SIZE = 2 ** 20
+
+
+class IncompleteDownload(Exception):
+    pass
+
+
+def file_sha256(path: str) -> str:
+    """Calculate the SHA-256 hash of a file's contents"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def load_manifest(path: str) -> Dict[str, Dict]:
+    """Load the manifest saved by an earlier run, or an empty one if there isn't one"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as in_file:
+        return json.load(in_file)
+
+
+def save_manifest(path: str, manifest: Dict[str, Dict]) -> None:
+    """Save the manifest, replacing the old one only once the new one is completely written"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as out_file:
+        json.dump(manifest, out_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def is_intact(path: str, entry: Optional[Dict], verify: bool) -> bool:
+    """
+    Check whether a downloaded file still matches its manifest entry
+
+    Arguments
+    ---------
+    path: The downloaded file
+    entry: The file's manifest entry, if it has one
+    verify: Whether to check the file's hash as well as its size
+
+    Returns
+    -------
+    intact: True if the file exists and matches the entry
+    """
+    if entry is None or not os.path.exists(path):
+        return False
+    if os.path.getsize(path) != entry['size']:
+        return False
+    return not verify or file_sha256(path) == entry['sha256']
+
+
+def content_range_start_and_total(content_range: str) -> Tuple[int, Optional[int]]:
+    """Parse the first byte and total size from a header like 'bytes 100-199/200'"""
+    byte_range, total = content_range.split(' ', 1)[1].split('/')
+    start = int(byte_range.split('-')[0])
+    return start, None if total == '*' else int(total)
+
+
+def download_once(url: str, path: str, entry: Optional[Dict], verify: bool,
+                  timeout: float) -> Dict:
+    """
+    Make one attempt to download a file, resuming a partial download if there is one
+
+    Arguments
+    ---------
+    url: The URL to download
+    path: The file to save the download to
+    entry: The file's entry in the manifest, if it has one
+    verify: Whether to check the hash of the existing file before trusting it
+    timeout: The number of seconds to wait for the server before giving up
+
+    Returns
+    -------
+    entry: The file's new manifest entry
+    """
+    part_path = path + '.part'
+    # The validators of the version of the file the partial download came from
+    part_info_path = part_path + '.json'
+
+    headers = {}
+    intact = is_intact(path, entry, verify)
+    if intact:
+        # Ask the server to skip the download if the file hasn't changed
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    offset = 0
+    if os.path.exists(part_path) and os.path.exists(part_info_path):
+        with open(part_info_path) as in_file:
+            part_info = json.load(in_file)
+        validator = part_info.get('etag') or part_info.get('last_modified')
+        if validator is not None:
+            offset = os.path.getsize(part_path)
+            headers['Range'] = 'bytes={}-'.format(offset)
+            # The server sends the whole file instead if it changed since the partial download
+            headers['If-Range'] = validator
+
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            for stale_path in (part_path, part_info_path):
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+            return dict(entry, url=url, status='unchanged')
+        if e.code == 416:
+            # The partial download can't be resumed, so start over
+            os.remove(part_path)
+            os.remove(part_info_path)
+            raise IncompleteDownload('Could not resume {}'.format(url))
+        raise
+
+    with response:
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        with open(part_info_path, 'w') as out_file:
+            json.dump({'etag': etag, 'last_modified': last_modified}, out_file)
+
+        if response.status == 206:
+            start, expected_size = content_range_start_and_total(
+                response.headers['Content-Range'])
+            if start != offset:
+                raise IncompleteDownload('{} resumed at byte {} instead of {}'.format(
+                                         url, start, offset))
+            mode = 'ab'
+        else:
+            offset = 0
+            content_length = response.headers.get('Content-Length')
+            expected_size = None if content_length is None else int(content_length)
+            mode = 'wb'
+
+        with open(part_path, mode) as out_file:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                out_file.write(chunk)
+
+    size = os.path.getsize(part_path)
+    if expected_size is not None and size != expected_size:
+        raise IncompleteDownload('Got {} of {} bytes of {}'.format(size, expected_size, url))
+
+    sha256 = file_sha256(part_path)
+    old_sha256 = entry['sha256'] if intact else None
+    if old_sha256 is None and os.path.exists(path):
+        old_sha256 = file_sha256(path)
+
+    if sha256 == old_sha256:
+        # Leave the old file alone so its modification time doesn't change
+        os.remove(part_path)
+        status = 'unchanged'
+    else:
+        os.replace(part_path, path)
+        status = 'updated'
+    os.remove(part_info_path)
+
+    return {'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'size': size,
+            'sha256': sha256,
+            'status': status}
+
+
+def download(url: str, path: str, entry: Optional[Dict], verify: bool = False,
+             retries: int = 3, timeout: float = 60) -> Dict:
+    """
+    Download a file, retrying and resuming if the connection fails
+
+    Arguments
+    ---------
+    url: The URL to download
+    path: The file to save the download to
+    entry: The file's entry in the manifest, if it has one
+    verify: Whether to check the hash of the existing file before trusting it
+    retries: The number of times to retry after a failure
+    timeout: The number of seconds to wait for the server before giving up
+
+    Returns
+    -------
+    entry: The file's new manifest entry
+    """
+    for attempt in range(retries + 1):
+        try:
+            new_entry = download_once(url, path, entry, verify, timeout)
+        except urllib.error.HTTPError as e:
+            # Retrying won't fix client errors like a missing file
+            if e.code < 500 or attempt == retries:
+                raise
+        except (urllib.error.URLError, http.client.HTTPException, OSError,
+                IncompleteDownload) as e:
+            if attempt == retries:
+                raise
+            print('Retrying {} after error: {}'.format(url, e))
+        else:
+            new_entry['checked'] = datetime.datetime.now().isoformat()
+            return new_entry
+        time.sleep(2 ** attempt)
+
+
+async def fetch_sources(sources: Dict[str, str], out_dir: str, manifest_path: str,
+                        max_concurrent: int = 4, verify: bool = False, retries: int = 3,
+                        timeout: float = 60) -> Dict[str, Dict]:
+    """
+    Download several files concurrently and save their manifest
+
+    Arguments
+    ---------
+    sources: A dict mapping file names to the URLs to download them from
+    out_dir: The directory to save the files in
+    manifest_path: The manifest file to read the old entries from and save the new ones to
+    max_concurrent: The maximum number of files to download at once
+    verify: Whether to check the hashes of existing files before trusting them
+    retries: The number of times to retry each file after a failure
+    timeout: The number of seconds to wait for the server before giving up
+
+    Returns
+    -------
+    manifest: The new manifest. Entries for files that failed to download are unchanged
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = load_manifest(manifest_path)
+    loop = asyncio.get_running_loop()
+
+    # urllib blocks, so the downloads run in threads that the event loop waits on
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        names = list(sources)
+        tasks = [loop.run_in_executor(executor, download, sources[name],
+                                      os.path.join(out_dir, name), manifest.get(name), verify,
+                                      retries, timeout)
+                 for name in names]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    errors = []
+    for name, result in zip(names, results):
+        if isinstance(result, Exception):
+            errors.append('{}: {}'.format(name, result))
+            continue
+        manifest[name] = result
+        print('{}: {} ({} bytes)'.format(name, result['status'], result['size']))
+    save_manifest(manifest_path, manifest)
+
+    if len(errors) > 0:
+        raise RuntimeError('Failed to download:\n' + '\n'.join(errors))
+    return manifest
+
+
+def link_sources(names, out_dir: str, link_dir: str) -> None:
+    """
+    Hard link downloaded files into another directory. Links that already point to the current
+    files are left alone, so their modification times don't change
+
+    Arguments
+    ---------
+    names: The names of the files to link
+    out_dir: The directory the files were downloaded to
+    link_dir: The directory to link them into
+    """
+    os.makedirs(link_dir, exist_ok=True)
+    for name in names:
+        source = os.path.join(out_dir, name)
+        destination = os.path.join(link_dir, name)
+        if os.path.exists(destination):
+            if os.path.samefile(source, destination):
+                continue
+            os.remove(destination)
+        try:
+            os.link(source, destination)
+        except OSError:
+            # Hard links can't cross devices, so copy the file and its modification time
+            shutil.copy2(source, destination)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('out_dir', help='The directory to save the downloaded files to')
+    parser.add_argument('--manifest',
+                        help='The manifest file to save the files\' hashes and validators to. '
+                             'Defaults to {} in out_dir'.format(MANIFEST_FILE))
+    parser.add_argument('--files', nargs='+', choices=list(SOURCES),
+                        help='The files to download. Defaults to all of them')
+    parser.add_argument('--base_url',
+                        help='Download every file from this URL instead of its usual source, '
+                             'e.g. a mirror or a local test server')
+    parser.add_argument('--max_concurrent', default=4, type=int,
+                        help='The maximum number of files to download at once')
+    parser.add_argument('--verify', action='store_true',
+                        help='Check the hashes of existing files against the manifest, and '
+                             'download them again if they don\'t match')
+    parser.add_argument('--retries', default=3, type=int,
+                        help='The number of times to retry a file after a failure')
+    parser.add_argument('--timeout', default=60, type=float,
+                        help='The number of seconds to wait for a server to respond')
+    parser.add_argument('--link_dir',
+                        help='Hard link the downloaded files into this directory as well. This '
+                             'keeps the manifest and partial downloads in out_dir when a '
+                             'workflow deletes the files in link_dir before rerunning')
+    args = parser.parse_args()
+
+    names = args.files if args.files is not None else list(SOURCES)
+    if args.base_url is not None:
+        sources = {name: args.base_url.rstrip('/') + '/' + name for name in names}
+    else:
+        sources = {name: SOURCES[name] for name in names}
+    manifest_path = args.manifest
+    if manifest_path is None:
+        manifest_path = os.path.join(args.out_dir, MANIFEST_FILE)
+
+    asyncio.run(fetch_sources(sources, args.out_dir, manifest_path, args.max_concurrent,
+                              args.verify, args.retries, args.timeout))
+    if args.link_dir is not None:
+        link_sources(names, args.out_dir, args.link_dir)
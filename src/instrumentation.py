@@ -0,0 +1,269 @@
+"""
+This file implements lightweight instrumentation for pipeline stages. A stage records the wall
+and CPU time spent in each phase (e.g. parse, compute, write), counts of rows, bytes, and
+skipped lines, and its peak memory, then saves them as a json report. Setting
+MOUSIPLIER_PROFILE also profiles the stage with cProfile or a sampling profiler
+"""
+
+import collections
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from typing import Dict, Iterable, Iterator, Optional
+
+# The directory to save reports to. Reports aren't saved if this isn't set
+METRICS_DIR_VARIABLE = 'MOUSIPLIER_METRICS_DIR'
+# 'cprofile' or 'sample' to profile stages. Profiles are saved next to the reports
+PROFILE_VARIABLE = 'MOUSIPLIER_PROFILE'
+# The number of seconds between samples taken by the sampling profiler
+SAMPLE_INTERVAL = .01
+
+
+def peak_rss_mb() -> float:
+    """Get the peak resident memory of this process in MB"""
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 1024
+
+
+class SamplingProfiler():
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        """
+        Periodically record the call stack of the main thread from a background thread.
+        This has much less overhead than cProfile for stages that make many small calls
+
+        Arguments
+        ---------
+        interval: The number of seconds between samples
+        """
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.thread_id = threading.main_thread().ident
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample_loop, daemon=True)
+
+    def _sample_loop(self) -> None:
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+    def save(self, path: str) -> None:
+        """Save the stacks in the collapsed format used by flame graph tools"""
+        with open(path, 'w') as out_file:
+            for stack, count in self.stacks.most_common():
+                out_file.write('{} {}\n'.format(stack, count))
+
+
+class StageMetrics():
+    def __init__(self, stage: str, report_dir: Optional[str] = None):
+        """
+        Start recording metrics for a pipeline stage
+
+        Arguments
+        ---------
+        stage: The name of the stage, used to name the report
+        report_dir: The directory to save the report to. Defaults to the directory in the
+                    MOUSIPLIER_METRICS_DIR environment variable, if it is set
+        """
+        self.stage = stage
+        if report_dir is None:
+            report_dir = os.environ.get(METRICS_DIR_VARIABLE)
+        self.report_dir = report_dir
+
+        self.phase_wall: Dict[str, float] = collections.defaultdict(float)
+        self.phase_cpu: Dict[str, float] = collections.defaultdict(float)
+        self.counts: Dict[str, int] = collections.Counter()
+        self.pipelines: Dict[str, Dict] = {}
+
+        self.profile_mode = os.environ.get(PROFILE_VARIABLE)
+        self.profiler = None
+        if self.profile_mode == 'cprofile':
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.profile_mode == 'sample':
+            self.profiler = SamplingProfiler()
+            self.profiler.start()
+        elif self.profile_mode:
+            raise ValueError('{} must be cprofile or sample, not {}'.format(PROFILE_VARIABLE,
+                                                                           self.profile_mode))
+
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Add the time spent in a block of code to a phase. Phases can be entered any number of
+        times, e.g. once per line
+
+        Arguments
+        ---------
+        name: The name of the phase, such as parse, compute, or write
+        """
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.phase_wall[name] += time.perf_counter() - start_wall
+            self.phase_cpu[name] += time.process_time() - start_cpu
+
+    def count(self, name: str, n: int = 1) -> None:
+        """
+        Add to a counter, such as rows, bytes, skipped, malformed, or duplicate
+
+        Arguments
+        ---------
+        name: The counter to add to
+        n: The amount to add
+        """
+        self.counts[name] += n
+
+    def timed(self, iterable: Iterable, name: str) -> Iterator:
+        """
+        Iterate over an iterable, such as a chunked pandas reader, adding the time spent
+        producing each item to a phase
+
+        Arguments
+        ---------
+        iterable: The iterable to time
+        name: The phase to add the time to
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def lines(self, in_file: Iterable[str], path: str, desc: Optional[str] = None,
+              start: int = 0, end: Optional[int] = None) -> Iterator[str]:
+        """
+        Iterate over the lines of a file, counting them and their bytes and showing progress
+        through the file's size, so no line count needs to be known ahead of time
+
+        Arguments
+        ---------
+        in_file: The open file to iterate over
+        path: The path of the file, used to get its size
+        desc: The description to show in the progress bar
+        start: The number of bytes already read from the file, e.g. by reading the header
+        end: The offset the lines end at, if only part of the file is read. Defaults to the
+             file's size
+        """
+        # tqdm takes a while to import, so stages that don't show progress don't load it
+        import tqdm
+
+        from compressed_io import detect_compression
+
+        if detect_compression(path) is not None:
+            # The lines are decompressed, so their bytes can't be compared to the file's size
+            start, end = 0, None
+        elif end is None:
+            end = os.path.getsize(path)
+        with tqdm.tqdm(total=end, initial=start, unit='B', unit_scale=True,
+                       desc=desc) as progress:
+            for line in in_file:
+                n_bytes = len(line)
+                progress.update(n_bytes)
+                self.counts['rows'] += 1
+                self.counts['bytes'] += n_bytes
+                yield line
+
+    def pipeline(self, name: str, stats: Dict[str, Dict[str, float]]) -> None:
+        """
+        Record how long each stage of a block_pipeline spent working and stalled
+
+        Arguments
+        ---------
+        name: The name of the pipeline, e.g. the pass through the data it ran
+        stats: The stats returned by block_pipeline.run_pipeline
+        """
+        self.pipelines[name] = stats
+        for stage, stage_stats in stats.items():
+            stalled = stage_stats['waiting_for_input_seconds'] + \
+                stage_stats['waiting_for_output_seconds']
+            print('{} {}: {:.1f}s busy, {:.1f}s stalled'.format(
+                  name, stage, stage_stats['busy_seconds'], stalled), file=sys.stderr)
+
+    def report(self) -> Dict:
+        """
+        Summarize the metrics recorded so far
+
+        Returns
+        -------
+        report: A dict with the stage's wall and CPU time, the time in each phase, the
+                counters, the rows and bytes processed per second, the peak memory, and the
+                stall times of any pipelines
+        """
+        wall_seconds = time.perf_counter() - self.start_wall
+        report = {'stage': self.stage,
+                  'wall_seconds': wall_seconds,
+                  'cpu_seconds': time.process_time() - self.start_cpu,
+                  'phases': {name: {'wall_seconds': self.phase_wall[name],
+                                    'cpu_seconds': self.phase_cpu[name]}
+                             for name in self.phase_wall},
+                  'counts': dict(self.counts),
+                  'peak_rss_mb': peak_rss_mb()}
+        if len(self.pipelines) > 0:
+            report['pipelines'] = self.pipelines
+        if wall_seconds > 0:
+            report['rows_per_second'] = self.counts['rows'] / wall_seconds
+            report['bytes_per_second'] = self.counts['bytes'] / wall_seconds
+        return report
+
+    def close(self) -> None:
+        """Stop any profiler and save the report and profile if a report directory is set"""
+        if self.profiler is not None:
+            if self.profile_mode == 'cprofile':
+                self.profiler.disable()
+            else:
+                self.profiler.stop()
+
+        report = self.report()
+        print('{}: {:.1f}s wall, {:.1f}s CPU, {:.0f} MB peak'.format(
+              self.stage, report['wall_seconds'], report['cpu_seconds'], report['peak_rss_mb']),
+              file=sys.stderr)
+
+        if self.report_dir is None:
+            return
+        os.makedirs(self.report_dir, exist_ok=True)
+        with open(os.path.join(self.report_dir, '{}.json'.format(self.stage)), 'w') as out_file:
+            json.dump(report, out_file, indent=2)
+
+        if self.profile_mode == 'cprofile':
+            self.profiler.dump_stats(os.path.join(self.report_dir, '{}.prof'.format(self.stage)))
+        elif self.profile_mode == 'sample':
+            self.profiler.save(os.path.join(self.report_dir, '{}.stacks'.format(self.stage)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
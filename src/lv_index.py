@@ -0,0 +1,248 @@
+"""
+This file implements a precomputed index for interpreting PLIER LVs. The top genes of every LV
+(from Z) and the nonzero pathway associations of every LV (from U) are stored as compressed
+sparse rows in both directions, so lookups by LV, gene, or pathway only read one slice
+"""
+
+import argparse
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from storage import save_names
+
+
+def _to_csr(row_indices: np.ndarray, n_rows: int,
+            *columns: np.ndarray) -> Tuple[np.ndarray, List[np.ndarray]]:
+    """
+    Group parallel arrays of entries by row
+
+    Arguments
+    ---------
+    row_indices: The row each entry belongs to
+    n_rows: The total number of rows
+    columns: Arrays holding the data for each entry
+
+    Returns
+    -------
+    offsets: Entries for row i are stored between offsets[i] and offsets[i + 1]
+    sorted_columns: The input arrays reordered by row, keeping the input order within a row
+    """
+    order = np.argsort(row_indices, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(row_indices, minlength=n_rows))])
+    return offsets, [column[order] for column in columns]
+
+
+def top_genes(z_matrix: np.ndarray, top_n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the genes with the largest weights in each LV
+
+    Arguments
+    ---------
+    z_matrix: A genes x LVs array of PLIER loadings
+    top_n: The number of genes to keep for each LV
+
+    Returns
+    -------
+    gene_indices: An LVs x top_n array of gene indices, ordered from the largest weight down
+    weights: An LVs x top_n array of the corresponding weights
+    """
+    top_n = min(top_n, z_matrix.shape[0])
+    if top_n == 0:
+        empty = np.empty((z_matrix.shape[1], 0))
+        return empty.astype(np.int32), empty.astype(np.float32)
+
+    # argpartition finds the top genes in linear time, then only those genes are sorted
+    gene_indices = np.argpartition(-z_matrix, top_n - 1, axis=0)[:top_n]
+    weights = np.take_along_axis(z_matrix, gene_indices, axis=0)
+    order = np.argsort(-weights, axis=0, kind='stable')
+    gene_indices = np.take_along_axis(gene_indices, order, axis=0)
+    weights = np.take_along_axis(weights, order, axis=0)
+
+    return gene_indices.T.astype(np.int32), weights.T.astype(np.float32)
+
+
+class LVIndex():
+    def __init__(self, path: str):
+        """
+        Open an index created by `LVIndex.build`. The index arrays are memory-mapped, so only
+        the slices touched by lookups are read from disk
+
+        Arguments
+        ---------
+        path: The directory the index was built in
+        """
+        self.path = path
+        self.lvs = np.load(os.path.join(path, 'lvs.npy'))
+        self.genes = np.load(os.path.join(path, 'genes.npy'))
+        self.pathways = np.load(os.path.join(path, 'pathways.npy'))
+
+        self.lv_to_index = {lv: i for i, lv in enumerate(self.lvs)}
+        self.gene_to_index = {gene: i for i, gene in enumerate(self.genes)}
+        self.pathway_to_index = {pathway: i for i, pathway in enumerate(self.pathways)}
+
+        self.arrays: Dict[str, np.ndarray] = {}
+        for file_name in os.listdir(path):
+            name, extension = os.path.splitext(file_name)
+            if extension == '.npy' and name not in ('lvs', 'genes', 'pathways'):
+                self.arrays[name] = np.load(os.path.join(path, file_name), mmap_mode='r')
+
+    @staticmethod
+    def build(path: str, z_df: pd.DataFrame, u_df: pd.DataFrame, top_n: int = 100) -> 'LVIndex':
+        """
+        Precompute the top genes and pathway associations of every LV
+
+        Arguments
+        ---------
+        path: The directory to build the index in
+        z_df: The genes x LVs loadings (Z.tsv) indexed by gene
+        u_df: The pathways x LVs associations (U.tsv) indexed by pathway
+        top_n: The number of top genes to keep for each LV
+
+        Returns
+        -------
+        index: The newly built index
+        """
+        if z_df.shape[1] != u_df.shape[1]:
+            raise ValueError('Z has {} LVs but U has {}'.format(z_df.shape[1], u_df.shape[1]))
+        os.makedirs(path, exist_ok=True)
+
+        n_lvs = z_df.shape[1]
+        # Match the LV names used by PlierTransform
+        lvs = ['LV{}'.format(i + 1) for i in range(n_lvs)]
+        save_names(os.path.join(path, 'lvs.npy'), lvs)
+        save_names(os.path.join(path, 'genes.npy'), z_df.index)
+        save_names(os.path.join(path, 'pathways.npy'), u_df.index)
+
+        # LV -> genes
+        gene_indices, weights = top_genes(z_df.to_numpy(dtype=np.float64), top_n)
+        np.save(os.path.join(path, 'lv_gene_indices.npy'), gene_indices)
+        np.save(os.path.join(path, 'lv_gene_weights.npy'), weights)
+
+        # Gene -> LVs, for the genes that are in the top genes of at least one LV
+        n_kept = gene_indices.shape[1]
+        entry_lvs = np.repeat(np.arange(n_lvs, dtype=np.int32), n_kept)
+        entry_ranks = np.tile(np.arange(1, n_kept + 1, dtype=np.int32), n_lvs)
+        offsets, (gene_lvs, gene_weights, gene_ranks) = _to_csr(
+            gene_indices.ravel(), len(z_df), entry_lvs, weights.ravel(), entry_ranks)
+        np.save(os.path.join(path, 'gene_offsets.npy'), offsets)
+        np.save(os.path.join(path, 'gene_lvs.npy'), gene_lvs)
+        np.save(os.path.join(path, 'gene_weights.npy'), gene_weights)
+        np.save(os.path.join(path, 'gene_ranks.npy'), gene_ranks)
+
+        # LV <-> pathways, for every nonzero entry of U
+        u_matrix = u_df.to_numpy(dtype=np.float64)
+        pathway_indices, lv_indices = np.nonzero(u_matrix)
+        values = u_matrix[pathway_indices, lv_indices].astype(np.float32)
+
+        # Within each LV, list the strongest associations first
+        by_strength = np.argsort(-values, kind='stable')
+        offsets, (lv_pathways, lv_pathway_values) = _to_csr(
+            lv_indices[by_strength], n_lvs, pathway_indices[by_strength].astype(np.int32),
+            values[by_strength])
+        np.save(os.path.join(path, 'lv_pathway_offsets.npy'), offsets)
+        np.save(os.path.join(path, 'lv_pathways.npy'), lv_pathways)
+        np.save(os.path.join(path, 'lv_pathway_values.npy'), lv_pathway_values)
+
+        offsets, (pathway_lvs, pathway_lv_values) = _to_csr(
+            pathway_indices[by_strength], len(u_df), lv_indices[by_strength].astype(np.int32),
+            values[by_strength])
+        np.save(os.path.join(path, 'pathway_offsets.npy'), offsets)
+        np.save(os.path.join(path, 'pathway_lvs.npy'), pathway_lvs)
+        np.save(os.path.join(path, 'pathway_lv_values.npy'), pathway_lv_values)
+
+        return LVIndex(path)
+
+    def _lookup(self, name: str, name_to_index: Dict[str, int], kind: str) -> int:
+        if name not in name_to_index:
+            raise KeyError('{} {} is not in the index'.format(kind, name))
+        return name_to_index[name]
+
+    def _row(self, prefix: str, i: int) -> slice:
+        offsets = self.arrays[prefix + '_offsets']
+        return slice(int(offsets[i]), int(offsets[i + 1]))
+
+    def genes_for_lv(self, lv: str, n: int = None) -> pd.DataFrame:
+        """
+        Get the genes with the largest weights in an LV
+
+        Arguments
+        ---------
+        lv: The LV to look up
+        n: The number of genes to return. Defaults to all the genes stored in the index
+
+        Returns
+        -------
+        genes_df: A dataframe with the gene and weight of each top gene, largest weight first
+        """
+        i = self._lookup(lv, self.lv_to_index, 'LV')
+        gene_indices = np.asarray(self.arrays['lv_gene_indices'][i, :n])
+        weights = np.asarray(self.arrays['lv_gene_weights'][i, :n])
+        return pd.DataFrame({'gene': self.genes[gene_indices], 'weight': weights})
+
+    def lvs_for_gene(self, gene: str) -> pd.DataFrame:
+        """
+        Get the LVs that have a gene among their top genes
+
+        Arguments
+        ---------
+        gene: The gene to look up
+
+        Returns
+        -------
+        lvs_df: A dataframe with the LV, the gene's weight, and the gene's rank within the LV
+        """
+        row = self._row('gene', self._lookup(gene, self.gene_to_index, 'Gene'))
+        return pd.DataFrame({'lv': self.lvs[np.asarray(self.arrays['gene_lvs'][row])],
+                             'weight': np.asarray(self.arrays['gene_weights'][row]),
+                             'rank': np.asarray(self.arrays['gene_ranks'][row])})
+
+    def pathways_for_lv(self, lv: str) -> pd.DataFrame:
+        """
+        Get the pathways with nonzero associations to an LV, strongest first
+
+        Arguments
+        ---------
+        lv: The LV to look up
+
+        Returns
+        -------
+        pathways_df: A dataframe with the pathway and the value of its association in U
+        """
+        row = self._row('lv_pathway', self._lookup(lv, self.lv_to_index, 'LV'))
+        pathway_indices = np.asarray(self.arrays['lv_pathways'][row])
+        return pd.DataFrame({'pathway': self.pathways[pathway_indices],
+                             'value': np.asarray(self.arrays['lv_pathway_values'][row])})
+
+    def lvs_for_pathway(self, pathway: str) -> pd.DataFrame:
+        """
+        Get the LVs with nonzero associations to a pathway, strongest first
+
+        Arguments
+        ---------
+        pathway: The pathway to look up
+
+        Returns
+        -------
+        lvs_df: A dataframe with the LV and the value of its association in U
+        """
+        row = self._row('pathway', self._lookup(pathway, self.pathway_to_index, 'Pathway'))
+        return pd.DataFrame({'lv': self.lvs[np.asarray(self.arrays['pathway_lvs'][row])],
+                             'value': np.asarray(self.arrays['pathway_lv_values'][row])})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('z_file', help='The genes x LVs loadings saved by PLIER (Z.tsv)')
+    parser.add_argument('u_file', help='The pathways x LVs associations saved by PLIER (U.tsv)')
+    parser.add_argument('out_dir', help='The directory to build the index in')
+    parser.add_argument('--top_n', default=100, type=int,
+                        help='The number of top genes to keep for each LV')
+    args = parser.parse_args()
+
+    z_df = pd.read_csv(args.z_file, sep='\t')
+    u_df = pd.read_csv(args.u_file, sep='\t')
+
+    LVIndex.build(args.out_dir, z_df, u_df, args.top_n)
@@ -0,0 +1,319 @@
+"""
+This file implements a persistent store for LV scores across the compendium. Samples are
+grouped by study so each study is a contiguous block of rows, and indexes for looking up
+samples, top-scoring samples, and per-study summaries are computed once when the store is built
+"""
+
+import argparse
+import os
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from storage import create_matrix, load_matrix, load_table, save_table
+
+SUMMARY_STATS = ['count', 'mean', 'std', 'min', 'max']
+# The number of rows of scores summarized at once when a store is built
+SUMMARY_BLOCK_ROWS = 65536
+
+
+class LVStore():
+    def __init__(self, path: str):
+        """
+        Open an LV store created by `LVStore.build`. The scores are memory-mapped, so opening
+        a store is fast regardless of how many samples it contains
+
+        Arguments
+        ---------
+        path: The directory the store was built in
+        """
+        self.path = path
+        self.scores, self.samples, self.lvs = load_matrix(os.path.join(path, 'scores'))
+        self.samples = np.array(self.samples)
+        self.lv_to_index = {lv: i for i, lv in enumerate(self.lvs)}
+
+        self.studies = np.load(os.path.join(path, 'studies.npy'))
+        self.study_offsets = np.load(os.path.join(path, 'study_offsets.npy'))
+        self.study_to_index = {study: i for i, study in enumerate(self.studies)}
+
+        self.sample_order = np.load(os.path.join(path, 'sample_order.npy'))
+        self.sorted_samples = self.samples[self.sample_order]
+        self.top_sample_rows = np.load(os.path.join(path, 'top_samples.npy'), mmap_mode='r')
+        self.summaries = np.load(os.path.join(path, 'study_summary.npy'), mmap_mode='r')
+
+    @staticmethod
+    def build(path: str, lv_df: pd.DataFrame, metadata: pd.DataFrame,
+              study_column: str = 'study', metadata_columns: Optional[Sequence[str]] = None,
+              top_n: int = 1000) -> 'LVStore':
+        """
+        Create an LV store from a samples x LVs dataframe and the sample metadata
+
+        Arguments
+        ---------
+        path: The directory to build the store in
+        lv_df: A samples x LVs dataframe indexed by sample id
+        metadata: A dataframe indexed by sample id. Samples without metadata are left out of
+                  the store, matching an inner merge on sample id
+        study_column: The metadata column containing the study of each sample
+        metadata_columns: The metadata columns to keep in the store, in addition to the study
+                          column. Defaults to all columns
+        top_n: The number of top-scoring samples to index for each LV
+
+        Returns
+        -------
+        store: The newly built store
+        """
+        metadata = metadata[~metadata.index.duplicated()]
+        metadata = metadata[metadata[study_column].notna()]
+        lv_df = lv_df[lv_df.index.isin(metadata.index)]
+        if metadata_columns is None:
+            metadata_columns = [column for column in metadata.columns if column != study_column]
+        sample_metadata = metadata.loc[lv_df.index, [study_column] + list(metadata_columns)]
+
+        # Group the rows by study so each study can be read as one slice
+        study_codes, studies = pd.factorize(sample_metadata[study_column], sort=True)
+        order = np.argsort(study_codes, kind='stable')
+        study_sizes = np.bincount(study_codes, minlength=len(studies))
+        study_offsets = np.concatenate([[0], np.cumsum(study_sizes)])
+
+        samples = np.asarray(lv_df.index)[order]
+        lvs = list(lv_df.columns)
+        values = lv_df.to_numpy(dtype=np.float32)[order]
+
+        scores = create_matrix(os.path.join(path, 'scores'), values.shape, np.float32,
+                               samples, lvs)
+        scores[:] = values
+        scores.flush()
+
+        sample_metadata = sample_metadata.iloc[order].reset_index(drop=True)
+        save_table(os.path.join(path, 'metadata'), sample_metadata.rename(
+                   columns={study_column: 'study'}))
+
+        np.save(os.path.join(path, 'studies.npy'), np.asarray(studies, dtype=str))
+        np.save(os.path.join(path, 'study_offsets.npy'), study_offsets)
+        np.save(os.path.join(path, 'sample_order.npy'),
+                np.argsort(samples.astype(str), kind='stable'))
+
+        # Store the rows of the highest scoring samples for each LV, highest first
+        top_n = min(top_n, len(samples))
+        if top_n > 0:
+            top_rows = np.argpartition(-values, top_n - 1, axis=0)[:top_n]
+            top_values = np.take_along_axis(values, top_rows, axis=0)
+            top_rows = np.take_along_axis(top_rows, np.argsort(-top_values, axis=0), axis=0)
+        else:
+            top_rows = np.empty((0, len(lvs)), dtype=np.int64)
+        np.save(os.path.join(path, 'top_samples.npy'), top_rows.T.astype(np.int64))
+
+        np.save(os.path.join(path, 'study_summary.npy'),
+                summarize_groups(values, study_offsets))
+
+        return LVStore(path)
+
+    def _lv_index(self, lv: str) -> int:
+        if lv not in self.lv_to_index:
+            raise KeyError('LV {} is not in the store'.format(lv))
+        return self.lv_to_index[lv]
+
+    def study_samples(self, study: str, lvs: Optional[Sequence[str]] = None,
+                      metadata_columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+        """
+        Get the LV scores and metadata for all the samples in a study
+
+        Arguments
+        ---------
+        study: The study to get samples from
+        lvs: The LVs to return. Defaults to all LVs
+        metadata_columns: The metadata columns to return. Defaults to all columns
+
+        Returns
+        -------
+        study_df: A dataframe indexed by sample with the LV scores followed by the metadata
+        """
+        if study not in self.study_to_index:
+            raise KeyError('Study {} is not in the store'.format(study))
+        i = self.study_to_index[study]
+        rows = slice(self.study_offsets[i], self.study_offsets[i + 1])
+
+        if lvs is None:
+            lvs = self.lvs
+        lv_indices = [self._lv_index(lv) for lv in lvs]
+
+        study_df = pd.DataFrame(self.scores[rows][:, lv_indices], columns=lvs,
+                                index=pd.Index(self.samples[rows], name='sample'))
+        metadata = load_table(os.path.join(self.path, 'metadata'), metadata_columns, rows=rows)
+        metadata.index = study_df.index
+
+        return pd.concat([study_df, metadata], axis='columns')
+
+    def sample_scores(self, samples: Sequence[str]) -> pd.DataFrame:
+        """
+        Get the LV scores of specific samples by binary searching the sample index
+
+        Arguments
+        ---------
+        samples: The ids of the samples to look up
+
+        Returns
+        -------
+        scores_df: A samples x LVs dataframe in the order the samples were requested
+        """
+        samples = np.asarray(samples, dtype=str)
+        positions = np.searchsorted(self.sorted_samples, samples)
+        positions = np.minimum(positions, len(self.sorted_samples) - 1)
+
+        found = self.sorted_samples[positions] == samples
+        if not found.all():
+            raise KeyError('Samples {} are not in the store'.format(list(samples[~found])))
+
+        rows = self.sample_order[positions]
+        return pd.DataFrame(self.scores[rows], columns=self.lvs,
+                            index=pd.Index(samples, name='sample'))
+
+    def top_samples(self, lv: str, n: int = 10) -> pd.DataFrame:
+        """
+        Get the samples with the highest scores for an LV
+
+        Arguments
+        ---------
+        lv: The LV to rank samples by
+        n: The number of samples to return
+
+        Returns
+        -------
+        top_df: A dataframe with the sample, study, and score of the top samples, highest first
+        """
+        lv_index = self._lv_index(lv)
+
+        if n <= self.top_sample_rows.shape[1]:
+            rows = np.asarray(self.top_sample_rows[lv_index, :n])
+        else:
+            # Requests beyond the precomputed index fall back to partitioning the column
+            column = np.asarray(self.scores[:, lv_index])
+            n = min(n, len(column))
+            rows = np.argpartition(-column, n - 1)[:n]
+            rows = rows[np.argsort(-column[rows], kind='stable')]
+
+        study_indices = np.searchsorted(self.study_offsets, rows, side='right') - 1
+        return pd.DataFrame({'sample': self.samples[rows],
+                             'study': self.studies[study_indices],
+                             'score': self.scores[rows, lv_index]})
+
+    def study_summary(self, lv: str) -> pd.DataFrame:
+        """
+        Get the count, mean, standard deviation, minimum and maximum of an LV in every study
+
+        Arguments
+        ---------
+        lv: The LV to summarize
+
+        Returns
+        -------
+        summary_df: A dataframe indexed by study with one column per summary statistic
+        """
+        lv_index = self._lv_index(lv)
+        summary = np.asarray(self.summaries[:, lv_index, :])
+        return pd.DataFrame(summary, columns=SUMMARY_STATS,
+                            index=pd.Index(self.studies, name='study'))
+
+
+def _group_blocks(offsets: np.ndarray, n_rows: int, block_rows: int):
+    """
+    Split contiguous groups of rows into blocks of at most block_rows rows
+
+    Yields
+    ------
+    start: The first row of the block
+    end: One past the last row of the block
+    groups: The indices of the nonempty groups in the block
+    local_starts: The first row of each of those groups within the block
+    """
+    for start in range(0, n_rows, block_rows):
+        end = min(start + block_rows, n_rows)
+        groups = np.where((offsets[:-1] < end) & (offsets[1:] > start))[0]
+        local_starts = np.maximum(offsets[groups], start) - start
+        yield start, end, groups, local_starts
+
+
+def summarize_groups(values: np.ndarray, offsets: np.ndarray,
+                     block_rows: int = SUMMARY_BLOCK_ROWS) -> np.ndarray:
+    """
+    Calculate summary statistics for each contiguous group of rows. The rows are read in
+    blocks, so only a block at a time is converted to float64
+
+    Arguments
+    ---------
+    values: A samples x LVs array whose rows are sorted by group
+    offsets: The first row of each group, followed by the total number of rows
+    block_rows: The number of rows to process at once
+
+    Returns
+    -------
+    summary: A groups x LVs x stats array with the statistics in the order of SUMMARY_STATS
+    """
+    counts = np.diff(offsets)
+    n_groups = len(counts)
+    n_lvs = values.shape[1]
+    summary = np.full((n_groups, n_lvs, len(SUMMARY_STATS)), np.nan, dtype=np.float32)
+    summary[:, :, 0] = counts[:, None]
+
+    sums = np.zeros((n_groups, n_lvs))
+    minimums = np.full((n_groups, n_lvs), np.inf)
+    maximums = np.full((n_groups, n_lvs), -np.inf)
+    for start, end, groups, local_starts in _group_blocks(offsets, len(values), block_rows):
+        block = np.asarray(values[start:end], dtype=np.float64)
+        sums[groups] += np.add.reduceat(block, local_starts, axis=0)
+        minimums[groups] = np.minimum(minimums[groups],
+                                      np.minimum.reduceat(block, local_starts, axis=0))
+        maximums[groups] = np.maximum(maximums[groups],
+                                      np.maximum.reduceat(block, local_starts, axis=0))
+
+    present = counts > 0
+    if not present.any():
+        return summary
+    sizes = counts[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / sizes
+
+    # The squared differences from the means are summed in a second pass over the blocks
+    M2 = np.zeros((n_groups, n_lvs))
+    for start, end, groups, local_starts in _group_blocks(offsets, len(values), block_rows):
+        block = np.asarray(values[start:end], dtype=np.float64)
+        group_codes = np.repeat(groups, np.diff(np.append(local_starts, end - start)))
+        block -= means[group_codes]
+        block **= 2
+        M2[groups] += np.add.reduceat(block, local_starts, axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stds = np.where(sizes > 1, np.sqrt(M2 / (sizes - 1)), np.nan)
+
+    summary[present, :, 1] = means[present]
+    summary[present, :, 2] = stds[present]
+    summary[present, :, 3] = minimums[present]
+    summary[present, :, 4] = maximums[present]
+
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('lv_file', help='A samples x LVs tsv with sample ids in the first column')
+    parser.add_argument('metadata_file', help='A tsv with information about each sample')
+    parser.add_argument('out_dir', help='The directory to build the store in')
+    parser.add_argument('--sample_column', default='external_id',
+                        help='The metadata column containing sample ids')
+    parser.add_argument('--study_column', default='study',
+                        help='The metadata column containing study ids')
+    parser.add_argument('--metadata_columns', nargs='*',
+                        help='The metadata columns to keep. Defaults to all columns')
+    parser.add_argument('--top_n', default=1000, type=int,
+                        help='The number of top-scoring samples to index for each LV')
+    args = parser.parse_args()
+
+    lv_df = pd.read_csv(args.lv_file, sep='\t', index_col=0)
+    metadata = pd.read_csv(args.metadata_file, sep='\t', dtype=str)
+    metadata = metadata[metadata[args.sample_column].notna()]
+    metadata = metadata.set_index(args.sample_column)
+
+    LVStore.build(args.out_dir, lv_df, metadata, args.study_column, args.metadata_columns,
+                  args.top_n)
@@ -0,0 +1,217 @@
+"""
+This script converts the recount3 sample metadata into the binary table format from
+storage.py, so stages that need a few metadata columns don't have to parse the whole tsv.
+Numeric columns keep their types, string columns are stored as categoricals, and the
+external_id column gets a hash index for looking up samples. Loading the columns a stage
+needs takes megabytes of memory and well under a second.
+
+Usage: `python src/metadata_table.py data/recount_metadata.tsv data/metadata_table`. An .rda
+file such as data/metadata_df.rda can be converted too if pyreadr is installed
+"""
+
+import argparse
+import os
+from typing import Dict, Iterator, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from storage import (SCHEMA_FILE, HashIndex, TableWriter, load_hash_index, load_table,
+                     save_hash_index)
+
+# The column holding the sample ids that the metadata is indexed on
+ID_COLUMN = 'external_id'
+# The number of rows to read from the tsv at once
+CHUNKSIZE = 20000
+
+
+def _read_chunks(path: str, chunksize: int,
+                 usecols: Optional[Sequence[str]] = None) -> Iterator[pd.DataFrame]:
+    """Read a metadata tsv in chunks, with every column as strings"""
+    with pd.read_csv(path, sep='\t', dtype=str, chunksize=chunksize,
+                     usecols=usecols) as reader:
+        for chunk in reader:
+            yield chunk
+
+
+def infer_column_types(path: str, chunksize: int = CHUNKSIZE) -> Dict[str, Optional[np.dtype]]:
+    """
+    Find the type of each column in a metadata tsv without loading it all at once
+
+    Arguments
+    ---------
+    path: The metadata tsv
+    chunksize: The number of rows to read at once
+
+    Returns
+    -------
+    column_types: A dict mapping each column to int64 or float64 if every value in it is a
+                  number, or None if it should be stored as a categorical
+    """
+    is_numeric = {}
+    is_integer = {}
+    for chunk in _read_chunks(path, chunksize):
+        for name in chunk.columns:
+            if not is_numeric.get(name, True):
+                continue
+            values = chunk[name]
+            numbers = pd.to_numeric(values, errors='coerce')
+            # Values that aren't missing but can't be parsed make the column a string column
+            is_numeric[name] = numbers.notna().sum() == values.notna().sum()
+            is_integer[name] = is_integer.get(name, True) and is_numeric[name] and \
+                values.notna().all() and bool((numbers % 1 == 0).all())
+
+    column_types = {}
+    for name, numeric in is_numeric.items():
+        # Sample ids are looked up as strings even if they look like numbers
+        if not numeric or name == ID_COLUMN:
+            column_types[name] = None
+        else:
+            column_types[name] = np.dtype(np.int64 if is_integer[name] else np.float64)
+    return column_types
+
+
+def _typed_chunk(chunk: pd.DataFrame, column_types: Dict[str, Optional[np.dtype]]) -> pd.DataFrame:
+    """Convert the numeric columns of a chunk of strings to numbers"""
+    chunk = chunk.copy()
+    for name, dtype in column_types.items():
+        if dtype is not None:
+            chunk[name] = pd.to_numeric(chunk[name]).astype(dtype)
+    return chunk
+
+
+def convert_metadata(in_path: str, out_path: str, chunksize: int = CHUNKSIZE) -> None:
+    """
+    Convert a metadata tsv or rda file to a binary table with an index on external_id
+
+    Arguments
+    ---------
+    in_path: The metadata file. Files ending in .rda or .RData are read with pyreadr, and
+             anything else is read as a tsv
+    out_path: The directory to save the table in
+    chunksize: The number of tsv rows to convert at once
+    """
+    if in_path.endswith(('.rda', '.RData')):
+        try:
+            import pyreadr
+        except ImportError as e:
+            raise ImportError('Converting rda files requires the pyreadr package') from e
+        df = next(iter(pyreadr.read_r(in_path).values()))
+        column_types = {name: df[name].dtype if pd.api.types.is_numeric_dtype(df[name])
+                        and not pd.api.types.is_bool_dtype(df[name]) and name != ID_COLUMN
+                        else None for name in df.columns}
+        chunks = [df]
+    else:
+        column_types = infer_column_types(in_path, chunksize)
+        chunks = (_typed_chunk(chunk, column_types)
+                  for chunk in _read_chunks(in_path, chunksize))
+
+    numeric_columns = {name: dtype for name, dtype in column_types.items() if dtype is not None}
+    categorical_columns = [name for name, dtype in column_types.items() if dtype is None]
+    with TableWriter(out_path, numeric_columns, categorical_columns) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+
+    save_hash_index(out_path, ID_COLUMN)
+
+
+class MetadataTable():
+    def __init__(self, path: str, columns: Optional[Sequence[str]] = None):
+        """
+        Load sample metadata along with an index for looking up samples by external_id
+
+        Arguments
+        ---------
+        path: A table directory created by `convert_metadata`, or a metadata tsv. Only the
+              requested columns of a tsv are parsed, but the whole file is still read and
+              every column is loaded as a categorical, so converting it first is much faster
+        columns: The columns to load. external_id is always loaded. Defaults to all columns
+        """
+        if columns is not None:
+            columns = [ID_COLUMN] + [name for name in columns if name != ID_COLUMN]
+
+        if os.path.exists(os.path.join(path, SCHEMA_FILE)):
+            self.df = load_table(path, columns, mmap_mode=None)
+            self.index = load_hash_index(path, ID_COLUMN)
+        else:
+            chunks = _read_chunks(path, CHUNKSIZE, usecols=columns)
+            self.df = pd.concat(chunks, ignore_index=True).astype('category')
+            ids = self.df[ID_COLUMN]
+            self.index = HashIndex.build(ids.cat.categories.to_numpy(dtype=str),
+                                         ids.cat.codes.to_numpy())
+
+    def rows(self, samples: Sequence[str]) -> np.ndarray:
+        """
+        Find the metadata row of each sample
+
+        Arguments
+        ---------
+        samples: The external ids of the samples
+
+        Returns
+        -------
+        rows: The first metadata row of each sample, or -1 for samples without metadata
+        """
+        return self.index.lookup(samples)
+
+    def lookup(self, samples: Sequence[str]) -> pd.DataFrame:
+        """
+        Get the metadata of some samples
+
+        Arguments
+        ---------
+        samples: The external ids of the samples
+
+        Returns
+        -------
+        metadata: The metadata of the samples that have it, indexed by external id
+        """
+        rows = self.rows(samples)
+        return self.df.iloc[rows[rows >= 0]].set_index(ID_COLUMN)
+
+    def join(self, df: pd.DataFrame, on: str) -> pd.DataFrame:
+        """
+        Add the metadata of each sample to a dataframe, like an inner merge on external_id
+        that uses the first metadata row of samples with several
+
+        Arguments
+        ---------
+        df: The dataframe to add metadata to
+        on: The column of `df` with the external ids of the samples
+
+        Returns
+        -------
+        joined: The rows of `df` with metadata, followed by the metadata columns
+        """
+        rows = self.rows(df[on].to_numpy())
+        found = rows >= 0
+        metadata = self.df.iloc[rows[found]].reset_index(drop=True)
+        return pd.concat([df[found].reset_index(drop=True), metadata], axis=1)
+
+
+def load_metadata(path: str, columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+    """
+    Load some columns of the sample metadata
+
+    Arguments
+    ---------
+    path: A table directory created by `convert_metadata`, or a metadata tsv
+    columns: The columns to load. Defaults to all columns
+
+    Returns
+    -------
+    metadata: A dataframe with numeric and categorical columns
+    """
+    return MetadataTable(path, columns).df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('metadata_file',
+                        help='The metadata tsv from 1a_metadata_to_tsv.R, or an rda file')
+    parser.add_argument('out_dir', help='The directory to save the table in')
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE,
+                        help='The number of rows to convert at once')
+    args = parser.parse_args()
+
+    convert_metadata(args.metadata_file, args.out_dir, args.chunksize)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+This script is a single entry point for the pipeline's Python stages, e.g.
+`python src/mousiplier.py remove_test_studies in.tsv out.tsv holdout.txt`.
+
+Each subcommand runs the script for its stage, so the arguments are the same as the script's.
+Nothing is imported until a subcommand runs, so a subcommand only pays for the libraries its
+own script needs. `batch` runs several subcommands in one process, so small stages share
+one interpreter startup and their common imports
+"""
+
+import argparse
+import os
+import runpy
+import shlex
+import sys
+import time
+import traceback
+from typing import Dict, List, NamedTuple
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Command(NamedTuple):
+    script: str
+    help: str
+
+
+COMMANDS: Dict[str, Command] = {
+    'fetch_sources': Command('fetch_sources.py',
+                             'Download the Reactome pathway and CellMarker files'),
+    'metadata_table': Command('metadata_table.py',
+                              'Convert the sample metadata into an indexed binary table'),
+    'remove_scrnaseq': Command('1b_remove_scrnaseq.py',
+                               'Remove single-cell samples from the compendium'),
+    'remove_test_studies': Command('1c_remove_test_studies.py',
+                                   'Remove held out samples from the compendium'),
+    'create_pathway_graph': Command('2_create_pathway_graph.py',
+                                    'Build the pathway matrix from Reactome and CellMarker'),
+    'add_brain_markers': Command('2.5_add_brain_markers.py',
+                                 'Add brain cell type marker pathways to the pathway matrix'),
+    'preprocess_expression': Command('3_preprocess_expression.py',
+                                     'RPKM normalize, filter, and z-score or robustly scale '
+                                     'counts'),
+    'count_transpose': Command('3a_count_transpose.py',
+                               'Transpose a genes x samples count matrix'),
+    'preprocess_shard': Command('3b_preprocess_shard.py',
+                                'Run one step of preprocess_expression on a shard of samples'),
+    'calculate_pcs': Command('5_calculate_pcs.py', 'Calculate PCs with incremental PCA'),
+    'reformat_counts': Command('8_reformat_counts.py', 'Reformat a count matrix for transform'),
+    'transform': Command('10_NAc_PFC_VTA_transform.py',
+                         'Project expression data onto the PLIER LVs'),
+    'select_lvs': Command('10a_select_lvs.py', 'Score LVs by how well they separate groups'),
+    'reformat_lvs': Command('11_reformat_LVs.py', 'Reshape a samples x LVs table to long form'),
+    'differential_lvs': Command('12_differential_LVs.py',
+                                'Test LVs for differences between groups of samples'),
+    'merge_shards': Command('sharding.py', 'Merge the outputs of sharded jobs'),
+    'recompress': Command('compressed_io.py',
+                          'Recompress a file, e.g. gzip to BGZF so it can be split into shards'),
+    'cache': Command('artifact_cache.py',
+                     'Run a command unless its outputs are cached, or list the cache'),
+    'subsample': Command('subsample_compendium.py', 'Select a random subset of the compendium'),
+    'precision_report': Command('precision_report.py',
+                                'Compare float32 LV scores to float64 scores'),
+    'lv_index': Command('lv_index.py', "Build an index of each LV's top genes and pathways"),
+    'lv_store': Command('lv_store.py', 'Build a study-indexed store of LV scores'),
+    'pathway_auc': Command('pathway_auc.py', 'Calculate the AUC of every pathway in every LV'),
+}
+
+
+def run_command(name: str, args: List[str]) -> int:
+    """
+    Run a subcommand's script in this process
+
+    Arguments
+    ---------
+    name: The name of the subcommand, a key in COMMANDS
+    args: The arguments to pass to the script
+
+    Returns
+    -------
+    exit_code: The script's exit code, 0 if it succeeded and 1 if it raised an exception
+    """
+    if name not in COMMANDS:
+        print('Unknown command {}. Choose from: {}'.format(name, ', '.join(COMMANDS)),
+              file=sys.stderr)
+        return 2
+
+    if SRC_DIR not in sys.path:
+        sys.path.insert(0, SRC_DIR)
+
+    script = os.path.join(SRC_DIR, COMMANDS[name].script)
+    old_argv = sys.argv
+    sys.argv = [script] + args
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        print(e.code, file=sys.stderr)
+        return 1
+    except Exception:
+        # Report the failure like an uncaught exception would, but return so a batch can
+        # carry on with --keep_going
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.argv = old_argv
+    return 0
+
+
+def parse_batch(path: str) -> List[List[str]]:
+    """
+    Read the commands to run in a batch
+
+    Arguments
+    ---------
+    path: A file with one subcommand and its arguments per line, or - to read from stdin.
+          Blank lines and lines starting with # are skipped
+
+    Returns
+    -------
+    commands: The subcommand and arguments of each line
+    """
+    in_file = sys.stdin if path == '-' else open(path)
+    with in_file:
+        lines = in_file.read().splitlines()
+    return [shlex.split(line) for line in lines
+            if len(line.strip()) > 0 and not line.strip().startswith('#')]
+
+
+def run_batch(commands: List[List[str]], keep_going: bool = False) -> int:
+    """
+    Run several subcommands one after another in this process
+
+    Arguments
+    ---------
+    commands: The subcommand and arguments of each command to run
+    keep_going: Whether to run the remaining commands after one fails
+
+    Returns
+    -------
+    exit_code: 0 if every command succeeded, otherwise the exit code of the first failure
+    """
+    exit_code = 0
+    for command in commands:
+        start = time.perf_counter()
+        command_code = run_command(command[0], command[1:])
+        print('{}: exit code {} after {:.2f}s'.format(' '.join(command), command_code,
+                                                     time.perf_counter() - start),
+              file=sys.stderr)
+        if command_code != 0:
+            if exit_code == 0:
+                exit_code = command_code
+            if not keep_going:
+                break
+    return exit_code
+
+
+def main(argv: List[str]) -> int:
+    description = 'Run a stage of the mousiplier pipeline. Run `<command> --help` to see the ' \
+                  'arguments of a command'
+    epilog = 'commands:\n' + '\n'.join('  {:<24}{}'.format(name, command.help)
+                                       for name, command in COMMANDS.items())
+    epilog += '\n  {:<24}{}'.format('batch', 'Run several commands in one process')
+    parser = argparse.ArgumentParser(prog='mousiplier', description=description, epilog=epilog,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=list(COMMANDS) + ['batch'], metavar='command',
+                        help='The command to run')
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='The arguments to pass to the command')
+    args = parser.parse_args(argv)
+
+    if args.command != 'batch':
+        return run_command(args.command, args.args)
+
+    batch_parser = argparse.ArgumentParser(prog='mousiplier batch',
+                                           description='Run several commands in one process, '
+                                                       'so they share startup and imports')
+    batch_parser.add_argument('batch_file',
+                              help='A file with one command and its arguments per line, '
+                                   'or - to read them from stdin')
+    batch_parser.add_argument('--keep_going', action='store_true',
+                              help='Keep running the remaining commands after one fails')
+    batch_args = batch_parser.parse_args(args.args)
+
+    return run_batch(parse_batch(batch_args.batch_file), batch_args.keep_going)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,170 @@
+"""
+This file scores how well each LV picks out the genes in each pathway, like the AUC summary
+PLIER computes in R. Each LV's gene weights are ranked once, and the rank sums of every
+pathway are computed for all LVs with a single sparse matrix product, so a whole model can be
+re-scored against new pathways (e.g. extra marker gene sets) in seconds
+"""
+
+import argparse
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse, stats
+
+from differential import benjamini_hochberg
+
+
+def align_genes(z_df: pd.DataFrame, pathway_df: pd.DataFrame) -> Tuple[np.ndarray,
+                                                                      sparse.csr_matrix]:
+    """
+    Restrict the loadings and the pathway matrix to the genes present in both
+
+    Arguments
+    ---------
+    z_df: A genes x LVs dataframe of PLIER loadings
+    pathway_df: A genes x pathways dataframe where nonzero entries mark pathway membership
+
+    Returns
+    -------
+    z_matrix: A genes x LVs array of loadings
+    membership: A sparse pathways x genes matrix with a one for each member gene
+    """
+    pathway_df = pathway_df[~pathway_df.index.duplicated()]
+    genes = z_df.index[z_df.index.isin(pathway_df.index)]
+    if len(genes) == 0:
+        raise ValueError('The loadings and pathway matrix have no genes in common')
+
+    z_matrix = z_df.loc[genes].to_numpy(dtype=np.float64)
+    membership = pathway_df.loc[genes].to_numpy() != 0
+    return z_matrix, sparse.csr_matrix(membership.T.astype(np.float64))
+
+
+def pathway_aucs(z_df: pd.DataFrame, pathway_df: pd.DataFrame,
+                 alternative: str = 'greater',
+                 continuity: bool = True) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Calculate the Mann-Whitney AUC and p-value of every pathway's genes in every LV
+
+    Arguments
+    ---------
+    z_df: A genes x LVs dataframe of PLIER loadings
+    pathway_df: A genes x pathways dataframe where nonzero entries mark pathway membership
+    alternative: 'greater' to test whether pathway genes have larger weights than other genes,
+                 or 'two-sided'
+    continuity: Whether to correct the normal approximation for continuity, as R's
+                `wilcox.test` and `differential.rank_sum_test` do
+
+    Returns
+    -------
+    auc_df: A pathways x LVs dataframe of AUCs
+    pvalue_df: A pathways x LVs dataframe of p-values from the normal approximation to the
+               Mann-Whitney U distribution, corrected for ties
+    """
+    if alternative not in ('greater', 'two-sided'):
+        raise ValueError('alternative must be greater or two-sided, not {}'.format(alternative))
+
+    z_matrix, membership = align_genes(z_df, pathway_df)
+    n_genes = z_matrix.shape[0]
+
+    # Rank each LV's gene weights once; ties get their average rank
+    ranks = stats.rankdata(z_matrix, method='average', axis=0)
+    # Every gene in a group of t tied weights has max rank - min rank + 1 == t, and the tie
+    # correction needs the sum over groups of t^3 - t, which is the sum over genes of t^2 - 1
+    tie_sizes = (stats.rankdata(z_matrix, method='max', axis=0)
+                 - stats.rankdata(z_matrix, method='min', axis=0) + 1)
+    tie_term = (tie_sizes ** 2 - 1).sum(axis=0)
+
+    # [pathways x genes] x [genes x LVs] = [pathways x LVs]
+    rank_sums = np.asarray(membership @ ranks)
+    n_in = np.asarray(membership.sum(axis=1))
+    n_out = n_genes - n_in
+
+    u_stats = rank_sums - n_in * (n_in + 1) / 2
+    deviations = u_stats - n_in * n_out / 2
+    correction = 0.5 if continuity else 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        aucs = u_stats / (n_in * n_out)
+        variance = n_in * n_out / 12 * ((n_genes + 1) - tie_term / (n_genes * (n_genes - 1)))
+        if alternative == 'greater':
+            pvalues = stats.norm.sf((deviations - correction) / np.sqrt(variance))
+        else:
+            z_scores = np.maximum(np.abs(deviations) - correction, 0) / np.sqrt(variance)
+            pvalues = np.minimum(2 * stats.norm.sf(z_scores), 1)
+
+    auc_df = pd.DataFrame(aucs, index=pathway_df.columns, columns=z_df.columns)
+    pvalue_df = pd.DataFrame(pvalues, index=pathway_df.columns, columns=z_df.columns)
+
+    return auc_df, pvalue_df
+
+
+def summarize_aucs(auc_df: pd.DataFrame, pvalue_df: pd.DataFrame,
+                   u_df: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    Convert the AUC and p-value matrices into a long table with BH adjusted p-values
+
+    Arguments
+    ---------
+    auc_df: A pathways x LVs dataframe of AUCs
+    pvalue_df: A pathways x LVs dataframe of p-values
+    u_df: An optional pathways x LVs dataframe (U.tsv) with the same pathways and LVs as the
+          AUC table. If given, only the pairs with nonzero entries in U are kept, as in PLIER's
+          summary
+
+    Returns
+    -------
+    summary: A dataframe with the columns pathway, LV_index, AUC, p-value, and FDR
+    """
+    pathway_indices, lv_indices = np.nonzero(np.ones(auc_df.shape, dtype=bool))
+    if u_df is not None:
+        for axis, u_labels, auc_labels in (('pathways', u_df.index, auc_df.index),
+                                          ('LVs', u_df.columns, auc_df.columns)):
+            if set(u_labels) != set(auc_labels):
+                raise ValueError('U\'s {} don\'t match the AUC table\'s: {} are only in U and {} '
+                                 'are only in the AUC table'.format(
+                                     axis, list(u_labels.difference(auc_labels))[:5],
+                                     list(auc_labels.difference(u_labels))[:5]))
+        u_df = u_df.reindex(index=auc_df.index, columns=auc_df.columns)
+        pathway_indices, lv_indices = np.nonzero(u_df.to_numpy() != 0)
+
+    pvalues = pvalue_df.to_numpy()[pathway_indices, lv_indices]
+    summary = pd.DataFrame({'pathway': auc_df.index[pathway_indices],
+                            'LV_index': lv_indices + 1,
+                            'AUC': auc_df.to_numpy()[pathway_indices, lv_indices],
+                            'p-value': pvalues,
+                            'FDR': benjamini_hochberg(pvalues)})
+    summary = summary.sort_values(['LV_index', 'AUC'], ascending=[True, False], kind='stable')
+
+    return summary.reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('z_file', help='The genes x LVs loadings saved by PLIER (Z.tsv)')
+    parser.add_argument('pathway_file',
+                        help='The genes x pathways matrix, e.g. from 2.5_add_brain_markers.py')
+    parser.add_argument('out_file', help='The tsv file to save the AUC summary to')
+    parser.add_argument('--u_file',
+                        help='If given, only keep the pathway/LV pairs with nonzero U values in '
+                             'the summary. All pairs are still scored, and the FDR is adjusted '
+                             'over the kept pairs')
+    parser.add_argument('--alternative', default='greater', choices=['greater', 'two-sided'],
+                        help='The alternative hypothesis for the Mann-Whitney test')
+    parser.add_argument('--no_continuity', action='store_true',
+                        help='Don\'t correct the p-values for continuity, which matches '
+                             'scipy\'s mannwhitneyu(use_continuity=False)')
+    args = parser.parse_args()
+
+    z_df = pd.read_csv(args.z_file, sep='\t')
+    # keep_default_na=False keeps us from clobbering the NA gene symbol
+    pathway_df = pd.read_csv(args.pathway_file, sep='\t', index_col=0, keep_default_na=False)
+
+    auc_df, pvalue_df = pathway_aucs(z_df, pathway_df, args.alternative,
+                                     not args.no_continuity)
+
+    u_df = None
+    if args.u_file is not None:
+        u_df = pd.read_csv(args.u_file, sep='\t')
+
+    summary = summarize_aucs(auc_df, pvalue_df, u_df)
+    summary.to_csv(args.out_file, sep='\t', index=False)
@@ -0,0 +1,125 @@
+"""
+This file measures how far LV scores computed in float32 (--dtype float32) drift from the
+scores of a float64 run of the same data, so the faster settings can be checked before they
+are used for a full analysis
+"""
+
+import argparse
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+
+def align_scores(reference_df: pd.DataFrame,
+                 test_df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray, pd.Index]:
+    """
+    Restrict two samples x LVs tables to their shared samples and LVs
+
+    Arguments
+    ---------
+    reference_df: The scores from the float64 run
+    test_df: The scores from the reduced precision run
+
+    Returns
+    -------
+    reference: A samples x LVs float64 array of the reference scores
+    test: The matching float64 array of the test scores
+    lvs: The names of the shared LVs
+    """
+    samples = reference_df.index[reference_df.index.isin(test_df.index)]
+    lvs = reference_df.columns[reference_df.columns.isin(test_df.columns)]
+    if len(samples) == 0 or len(lvs) == 0:
+        raise ValueError('The score tables have no samples or LVs in common')
+
+    reference = reference_df.loc[samples, lvs].to_numpy(dtype=np.float64)
+    test = test_df.loc[samples, lvs].to_numpy(dtype=np.float64)
+    return reference, test, lvs
+
+
+def lv_correlations(reference: np.ndarray, test: np.ndarray) -> np.ndarray:
+    """Calculate the Pearson correlation between the two runs for each LV"""
+    reference = reference - reference.mean(axis=0)
+    test = test - test.mean(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return ((reference * test).sum(axis=0)
+                / np.sqrt((reference ** 2).sum(axis=0) * (test ** 2).sum(axis=0)))
+
+
+def top_sample_overlap(reference: np.ndarray, test: np.ndarray, top_n: int) -> np.ndarray:
+    """
+    Calculate the fraction of each LV's top scoring samples that are the same in both runs
+
+    Arguments
+    ---------
+    reference: A samples x LVs array of the reference scores
+    test: The matching array of the test scores
+    top_n: The number of top samples to compare
+
+    Returns
+    -------
+    overlap: The fraction of shared top samples for each LV
+    """
+    top_n = min(top_n, reference.shape[0])
+    reference_top = np.argpartition(-reference, top_n - 1, axis=0)[:top_n]
+    test_top = np.argpartition(-test, top_n - 1, axis=0)[:top_n]
+
+    overlap = np.empty(reference.shape[1])
+    for lv in range(reference.shape[1]):
+        overlap[lv] = len(np.intersect1d(reference_top[:, lv], test_top[:, lv])) / top_n
+    return overlap
+
+
+def precision_report(reference_df: pd.DataFrame, test_df: pd.DataFrame,
+                     top_n: int = 100) -> pd.DataFrame:
+    """
+    Compare the LV scores from a reduced precision run to the scores from a float64 run
+
+    Arguments
+    ---------
+    reference_df: A samples x LVs dataframe of scores from the float64 run
+    test_df: A samples x LVs dataframe of scores from the reduced precision run
+    top_n: The number of top scoring samples per LV to compare
+
+    Returns
+    -------
+    report_df: A dataframe indexed by LV with the maximum absolute difference, the relative
+               error (the norm of the differences over the norm of the reference scores), the
+               correlation between runs, and the fraction of shared top samples
+    """
+    reference, test, lvs = align_scores(reference_df, test_df)
+    differences = test - reference
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        relative_error = (np.linalg.norm(differences, axis=0)
+                          / np.linalg.norm(reference, axis=0))
+
+    report_df = pd.DataFrame({'max_abs_diff': np.abs(differences).max(axis=0),
+                              'relative_error': relative_error,
+                              'correlation': lv_correlations(reference, test),
+                              'top_overlap': top_sample_overlap(reference, test, top_n)},
+                             index=pd.Index(lvs, name='LV'))
+    return report_df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('reference_file', help='A samples x LVs tsv from a float64 run')
+    parser.add_argument('test_file', help='The samples x LVs tsv from a float32 run')
+    parser.add_argument('out_file', help='The tsv file to write the per-LV report to')
+    parser.add_argument('--top_n', default=100, type=int,
+                        help='The number of top scoring samples per LV to compare')
+    args = parser.parse_args()
+
+    reference_df = pd.read_csv(args.reference_file, sep='\t', index_col=0)
+    test_df = pd.read_csv(args.test_file, sep='\t', index_col=0)
+
+    report_df = precision_report(reference_df, test_df, args.top_n)
+    report_df.to_csv(args.out_file, sep='\t')
+
+    reference, test, _ = align_scores(reference_df, test_df)
+    print('Max absolute difference: {}'.format(report_df['max_abs_diff'].max()))
+    print('Relative Frobenius error: {}'.format(np.linalg.norm(test - reference)
+                                                / np.linalg.norm(reference)))
+    print('Minimum LV correlation: {}'.format(report_df['correlation'].min()))
+    print('Mean top {} overlap: {}'.format(args.top_n, report_df['top_overlap'].mean()))
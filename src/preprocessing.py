@@ -0,0 +1,628 @@
+"""
+This file contains the functions used to RPKM normalize, filter, and z-score or robustly scale
+the recount compendium. They're shared by 3_preprocess_expression.py, which processes the whole
+compendium in one job, and 3b_preprocess_shard.py, which splits the work across sample shards
+"""
+
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+import numpy as np
+
+from block_pipeline import QUEUE_DEPTH, BlockPool, run_pipeline
+from instrumentation import StageMetrics
+from quantile_sketch import QuantileSketch
+from tsv_writer import TsvWriter
+
+# The number of samples to parse, normalize, and write at once
+BLOCK_SIZE = 256
+# Genes with a variance below this percentile are removed
+VARIANCE_PERCENTILE = 10
+# How genes are filtered: 'variance' removes the genes with the lowest variance, and 'expression'
+# removes the genes with the lowest EXPRESSION_QUANTILE of their RPKM values
+FILTER_MODES = ['variance', 'expression']
+# With expression filtering, genes whose median RPKM is below this percentile are removed
+EXPRESSION_QUANTILE = .5
+EXPRESSION_PERCENTILE = 10
+# How genes are scaled: 'zscore' subtracts their means and divides by their standard deviations,
+# and 'robust' uses their medians and median absolute deviations instead
+SCALING_MODES = ['zscore', 'robust']
+# The median absolute deviation of normally distributed values times this is their standard
+# deviation, so robust scaling gives values on the same scale as z-scores
+MAD_TO_STD = 1.4826
+
+
+def parse_gene_lengths(file_path: str) -> Dict[str, int]:
+    """Parses a tsv file containing genes and their length
+
+    Arguments
+    ---------
+    file_path - The path to the file mapping genes to lengths
+
+    Returns
+    -------
+    gene_to_len - A dict mapping ensembl gene ids to their length in base pairs
+    """
+    gene_to_len = {}
+    with open(file_path) as in_file:
+        # Throw out header
+        in_file.readline()
+        for line in in_file:
+            line = line.replace('"', '')
+            gene, length = line.strip().split('\t')
+            try:
+                gene_to_len[gene] = int(length)
+            except ValueError:
+                # Some genes have no length, but will be removed in a later step
+                pass
+    return gene_to_len
+
+
+def get_pathway_genes(pathway_file: str) -> Set[str]:
+    """
+    Read which genes are present in the pathway matrix file
+
+    Arguments
+    ---------
+    pathway_file: The path to the file storing the pathway matrix as a genes x pathways tsv
+
+    Returns
+    -------
+    pathway_genes: The set of all genes used in pathways
+    """
+    with open(pathway_file) as in_file:
+        pathway_genes = set()
+
+        # Throw out header
+        _ = in_file.readline()
+        for line in in_file:
+            line = line.strip().split('\t')
+            gene = line[0]
+            pathway_genes.add(gene)
+        return pathway_genes
+
+
+def calculate_rpkm(counts: np.ndarray, gene_length_arr: np.ndarray,
+                   dtype: np.dtype = np.float64) -> np.ndarray:
+    """"Given an array of counts, calculate the reads per kilobase million
+    based on the steps here:
+    https://www.rna-seqblog.com/rpkm-fpkm-and-tpm-clearly-explained/
+
+    Arguments
+    ---------
+    counts: The array of transcript counts per gene, or a samples x genes array of counts
+    gene_length_arr: The array of lengths for each gene in counts
+    dtype: The float dtype to calculate and return the results in
+
+    Returns
+    -------
+    rpkm: The rpkm normalized expression data
+    """
+    counts = np.asarray(counts, dtype=dtype)
+    gene_length_arr = gene_length_arr.astype(dtype, copy=False)
+
+    reads_per_kb = counts / gene_length_arr
+
+    # Each sample is normalized by its own total
+    sample_total_counts = np.sum(counts, axis=-1, keepdims=True)
+    per_million_transcripts = sample_total_counts / 1e6
+
+    rpkm = reads_per_kb / per_million_transcripts
+
+    return rpkm
+
+
+def select_genes(header: str, ensembl_to_genesymbol: Dict[str, str], gene_to_len: Dict[str, int],
+                 pathway_genes: Set[str]) -> Tuple[List[str], List[int], np.ndarray]:
+    """
+    Find the genes in the count file that can't be used, because they have no gene symbol,
+    duplicate another gene's symbol, aren't in any pathway, or have no known length
+
+    Arguments
+    ---------
+    header: The header line of the count file
+    ensembl_to_genesymbol: A dict mapping Ensembl ids to gene symbols
+    gene_to_len: A dict mapping Ensembl gene ids to their lengths
+    pathway_genes: The gene symbols used in pathways
+
+    Returns
+    -------
+    header_genes: The Ensembl ids in the header without version numbers
+    bad_indices: The sorted indices of the genes to remove
+    gene_length_arr: The lengths of the remaining genes
+    """
+    header = header.replace('"', '')
+    header_genes = header.strip().split('\t')
+    header_genes = [gene.split('.')[0] for gene in header_genes]
+
+    header_gene_symbols = []
+    for gene in header_genes:
+        if gene in ensembl_to_genesymbol:
+            header_gene_symbols.append(ensembl_to_genesymbol[gene])
+        else:
+            header_gene_symbols.append(None)
+
+    bad_indices = []
+    # Keep only the first instance of each gene in the case that multiple
+    # Ensembl genes get mapped to one gene symbol
+    genes_seen = set()
+    for i, gene in enumerate(header_gene_symbols):
+        if gene is None or gene in genes_seen:
+            bad_indices.append(i)
+        # Remove genes that aren't in our prior pathways
+        elif gene not in pathway_genes:
+            bad_indices.append(i)
+        else:
+            genes_seen.add(gene)
+
+    # Remove genes with unknown lengths
+    gene_length_arr = []
+    for i, gene in enumerate(header_genes):
+        if gene not in gene_to_len.keys():
+            bad_indices.append(i)
+            gene_length_arr.append(None)
+        else:
+            gene_length_arr.append(gene_to_len[gene])
+
+    # sort bad_indices and deduplicate
+    bad_indices = list(set(bad_indices))
+    bad_indices.sort()
+
+    for index in reversed(bad_indices):
+        del gene_length_arr[index]
+    gene_length_arr = np.array(gene_length_arr)
+
+    return header_genes, bad_indices, gene_length_arr
+
+
+def parse_line(line: str) -> Tuple[str, List[str]]:
+    """
+    Split a line of the count file into its sample id and counts
+
+    Arguments
+    ---------
+    line: A line of the count file
+
+    Returns
+    -------
+    sample: The sample id
+    counts: The counts for each gene, as strings
+    """
+    line = line.replace('"', '')
+    line = line.strip().split('\t')
+    # bad_indices is still correct because of how R saves tables
+    return line[0], line[1:]
+
+
+def remove_indices(values: List[str], indices: List[int]) -> List[str]:
+    """Delete the elements at the sorted `indices` from `values` in place"""
+    # Thanks to stackoverflow for this smart optimization
+    # https://stackoverflow.com/a/11303234/10930590
+    for index in reversed(indices):
+        del values[index]
+    return values
+
+
+def update_statistics(means: Optional[np.ndarray], M2, rpkm: np.ndarray,
+                      i: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Add a sample to the running per-gene means and sums of squared differences
+
+    Arguments
+    ---------
+    means: The running means, or None if this is the first sample
+    M2: The running sums of squared differences from the mean
+    rpkm: The sample's RPKM values
+    i: The line number of the sample in the count file
+
+    Returns
+    -------
+    means: The updated means
+    M2: The updated sums of squared differences
+    """
+    # Accumulate in float64 so rounding error doesn't build up over many samples
+    rpkm = rpkm.astype(np.float64, copy=False)
+
+    # Online variance calculation https://stackoverflow.com/a/15638726/10930590
+    if means is None:
+        return rpkm, 0
+
+    delta = rpkm - means
+    means = means + delta / (i + 1)
+    M2 = M2 + delta * (rpkm - means)
+    return means, M2
+
+
+class RunningStatistics():
+    def __init__(self):
+        """The running per-gene means and sums of squared differences of the samples seen so far"""
+        self.means = None
+        self.M2 = None
+
+    def update(self, rpkm: np.ndarray, i: int) -> None:
+        """Add a sample with line number `i` to the statistics"""
+        self.means, self.M2 = update_statistics(self.means, self.M2, rpkm, i)
+
+
+def combine_statistics(n_a: int, means_a: np.ndarray, M2_a: np.ndarray, n_b: int,
+                       means_b: np.ndarray, M2_b: np.ndarray
+                       ) -> Tuple[int, np.ndarray, np.ndarray]:
+    """
+    Combine the per-gene means and sums of squared differences of two sets of samples, using
+    Chan et al.'s parallel algorithm
+    https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+
+    Arguments
+    ---------
+    n_a: The number of samples in the first set
+    means_a: The first set's means
+    M2_a: The first set's sums of squared differences from the mean
+    n_b: The number of samples in the second set
+    means_b: The second set's means
+    M2_b: The second set's sums of squared differences from the mean
+
+    Returns
+    -------
+    n: The number of samples in both sets
+    means: The means of both sets
+    M2: The sums of squared differences from the mean of both sets
+    """
+    if n_a == 0:
+        return n_b, means_b, M2_b
+    if n_b == 0:
+        return n_a, means_a, M2_a
+
+    n = n_a + n_b
+    delta = means_b - means_a
+    means = means_a + delta * (n_b / n)
+    M2 = M2_a + M2_b + delta ** 2 * (n_a * n_b / n)
+    return n, means, M2
+
+
+def block_statistics(rpkm: np.ndarray) -> Tuple[int, np.ndarray, np.ndarray]:
+    """Calculate the per-gene means and sums of squared differences of a block of samples"""
+    rpkm = rpkm.astype(np.float64, copy=False)
+    means = rpkm.mean(axis=0)
+    M2 = ((rpkm - means) ** 2).sum(axis=0)
+    return len(rpkm), means, M2
+
+
+def remove_sample(n: int, means: np.ndarray, M2: np.ndarray,
+                  rpkm: np.ndarray) -> Tuple[int, np.ndarray, np.ndarray]:
+    """
+    Take a sample back out of the per-gene means and sums of squared differences
+
+    Arguments
+    ---------
+    n: The number of samples, including the one to remove
+    means: Their means
+    M2: Their sums of squared differences from the mean
+    rpkm: The RPKM values of the sample to remove
+
+    Returns
+    -------
+    n: The number of samples left
+    means: Their means
+    M2: Their sums of squared differences from the mean
+    """
+    rpkm = rpkm.astype(np.float64, copy=False)
+    if n == 1:
+        return 0, np.zeros_like(means), np.zeros_like(M2)
+
+    # This reverses a step of Welford's algorithm
+    new_means = means - (rpkm - means) / (n - 1)
+    # Rounding can take the sums of a gene without variance slightly below zero
+    M2 = np.maximum(M2 - (rpkm - new_means) * (rpkm - means), 0)
+    return n - 1, new_means, M2
+
+
+class CountBlock(NamedTuple):
+    counts: np.ndarray
+    samples: List[str]
+    line_numbers: List[int]
+    n_rows: int
+
+
+class CountBlockReader():
+    def __init__(self, lines: Iterable[str], remove: List[List[int]], pool: BlockPool,
+                 metrics: StageMetrics, count_skipped: bool = True):
+        """
+        Parses the lines of a count file into blocks of counts, skipping duplicate samples and
+        malformed lines
+
+        Arguments
+        ---------
+        lines: The lines of the count file after the header
+        remove: Lists of sorted gene indices to remove from each line, removed one after another
+        pool: The pool of samples x genes blocks to parse the counts into
+        metrics: The metrics to record the parse time and skipped lines in
+        count_skipped: Whether to count duplicate, malformed, and NaN samples. The second
+                       pass through a file skips the same samples, so it doesn't count them
+        """
+        self.lines = lines
+        self.remove = remove
+        self.pool = pool
+        self.metrics = metrics
+        self.count_skipped = count_skipped
+        # The number of lines read so far, including skipped ones
+        self.n_lines = 0
+        # Every sample read so far, including skipped ones
+        self.samples_seen = set()
+
+    def _count(self, name: str, n: int = 1) -> None:
+        if self.count_skipped and n > 0:
+            self.metrics.count(name, n)
+
+    def __iter__(self) -> Iterator[CountBlock]:
+        block = None
+        for i, line in enumerate(self.lines):
+            self.n_lines += 1
+            with self.metrics.phase('parse'):
+                sample, counts = parse_line(line)
+
+            # Remove duplicates
+            if sample in self.samples_seen:
+                self._count('duplicate')
+                continue
+            self.samples_seen.add(sample)
+
+            if block is None:
+                block = CountBlock(self.pool.acquire(), [], [], 0)
+            try:
+                with self.metrics.phase('parse'):
+                    for indices in self.remove:
+                        remove_indices(counts, indices)
+                    block.counts[block.n_rows] = np.array(counts, dtype=self.pool.dtype)
+            except ValueError as e:
+                # Throw out malformed lines caused by issues with downloading data
+                self._count('malformed')
+                print(e)
+                continue
+
+            block.samples.append(sample)
+            block.line_numbers.append(i)
+            block = block._replace(n_rows=block.n_rows + 1)
+            if block.n_rows == len(block.counts):
+                yield block
+                block = None
+
+        if block is not None:
+            if block.n_rows > 0:
+                yield block
+            else:
+                self.pool.release(block.counts)
+
+    def rpkm(self, block: CountBlock,
+             gene_length_arr: np.ndarray) -> Tuple[np.ndarray, List[str], List[int]]:
+        """
+        RPKM normalize a block and return its counts to the pool
+
+        Arguments
+        ---------
+        block: A block produced by iterating over the reader
+        gene_length_arr: The lengths of the genes in the block
+
+        Returns
+        -------
+        rpkm: The RPKM values of the samples without NaNs
+        samples: The ids of those samples
+        line_numbers: The line numbers of those samples
+        """
+        with self.metrics.phase('compute'):
+            rpkm = calculate_rpkm(block.counts[:block.n_rows], gene_length_arr,
+                                  self.pool.dtype)
+        self.pool.release(block.counts)
+
+        is_nan = np.isnan(rpkm).any(axis=1)
+        n_nan = int(is_nan.sum())
+        self._count('nan', n_nan)
+        if n_nan == 0:
+            return rpkm, block.samples, block.line_numbers
+        keep = np.where(~is_nan)[0]
+        return (rpkm[keep], [block.samples[row] for row in keep],
+                [block.line_numbers[row] for row in keep])
+
+
+def filter_low_variance(means: np.ndarray, M2: np.ndarray, i: int, gene_length_arr: np.ndarray,
+                        dtype: np.dtype, percentile: float = VARIANCE_PERCENTILE
+                        ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Remove the genes whose variance is in the bottom `percentile` percent
+
+    Arguments
+    ---------
+    means: The per-gene means
+    M2: The per-gene sums of squared differences from the mean
+    i: The line number of the last line in the count file
+    gene_length_arr: The lengths of the genes
+    dtype: The float type to return the means and standard deviations in
+    percentile: The percentile of the variances below which genes are removed
+
+    Returns
+    -------
+    low_variance_indices: The indices of the removed genes
+    gene_length_arr: The lengths of the remaining genes
+    filtered_means: The means of the remaining genes
+    stds: The standard deviations of the remaining genes
+    """
+    per_gene_variances = M2 / (i-1)
+
+    # Get the cutoff variance value
+    variance_cutoff = np.percentile(per_gene_variances, percentile)
+    low_variance_indices = np.where(per_gene_variances < variance_cutoff)[0]
+
+    # Adjust gene length array to match the final genes
+    gene_length_arr = np.delete(gene_length_arr, low_variance_indices)
+
+    filtered_variances = np.delete(per_gene_variances, low_variance_indices)
+    stds = np.sqrt(filtered_variances).astype(dtype)
+    filtered_means = np.delete(means, low_variance_indices).astype(dtype)
+
+    return low_variance_indices, gene_length_arr, filtered_means, stds
+
+
+def needs_sketch(filter_mode: str, scaling: str) -> bool:
+    """Check whether a filtering and scaling mode need per-gene quantiles"""
+    return filter_mode == 'expression' or scaling == 'robust'
+
+
+def filter_and_scale(means: np.ndarray, M2: np.ndarray, i: int, gene_length_arr: np.ndarray,
+                     dtype: np.dtype, variance_percentile: float = VARIANCE_PERCENTILE,
+                     filter_mode: str = 'variance', scaling: str = 'zscore',
+                     sketch: Optional[QuantileSketch] = None,
+                     expression_quantile: float = EXPRESSION_QUANTILE,
+                     expression_percentile: float = EXPRESSION_PERCENTILE
+                     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Remove low variance or low expression genes, and find the values to center and scale the
+    remaining genes by
+
+    Arguments
+    ---------
+    means: The per-gene means
+    M2: The per-gene sums of squared differences from the mean
+    i: The line number of the last line in the count file
+    gene_length_arr: The lengths of the genes
+    dtype: The float type to return the centers and scales in
+    variance_percentile: With variance filtering, the percentile of the variances below which
+                         genes are removed
+    filter_mode: 'variance' or 'expression', see FILTER_MODES
+    scaling: 'zscore' or 'robust', see SCALING_MODES
+    sketch: A sketch of the RPKM values of each gene. It's needed for expression filtering and
+            robust scaling
+    expression_quantile: With expression filtering, the quantile of each gene's RPKM values
+                         to compare
+    expression_percentile: With expression filtering, the percentile of the genes' quantiles
+                           below which genes are removed
+
+    Returns
+    -------
+    removed_indices: The indices of the removed genes
+    gene_length_arr: The lengths of the remaining genes
+    centers: The means or medians of the remaining genes
+    scales: The standard deviations or scaled median absolute deviations of the remaining genes
+    """
+    if filter_mode == 'variance' and scaling == 'zscore':
+        return filter_low_variance(means, M2, i, gene_length_arr, dtype, variance_percentile)
+    if sketch is None:
+        raise ValueError('{} filtering and {} scaling need a quantile sketch'.format(filter_mode,
+                                                                                 scaling))
+
+    per_gene_variances = M2 / (i-1)
+    if filter_mode == 'variance':
+        scores = per_gene_variances
+        cutoff = np.percentile(scores, variance_percentile)
+    elif filter_mode == 'expression':
+        scores = sketch.quantiles(expression_quantile)
+        cutoff = np.percentile(scores, expression_percentile)
+    else:
+        raise ValueError('Unknown filter mode {}'.format(filter_mode))
+    removed_indices = np.where(scores < cutoff)[0]
+    kept = np.delete(np.arange(len(scores)), removed_indices)
+
+    gene_length_arr = np.delete(gene_length_arr, removed_indices)
+    stds = np.sqrt(per_gene_variances[kept])
+    if scaling == 'zscore':
+        centers = means[kept]
+        scales = stds
+    elif scaling == 'robust':
+        medians = sketch.quantiles(.5)
+        deviations = sketch.median_absolute_deviations(medians)
+        centers = medians[kept]
+        scales = MAD_TO_STD * deviations[kept]
+        # Genes that are mostly one value have no median absolute deviation, so they're
+        # scaled by their standard deviations instead
+        scales = np.where(scales > 0, scales, stds)
+    else:
+        raise ValueError('Unknown scaling {}'.format(scaling))
+
+    return removed_indices, gene_length_arr, centers.astype(dtype), scales.astype(dtype)
+
+
+def write_normalized(lines: Iterable[str], bad_indices: List[int],
+                     low_variance_indices: np.ndarray, gene_length_arr: np.ndarray,
+                     means: np.ndarray, stds: np.ndarray, out_file: TsvWriter,
+                     metrics: StageMetrics, queue_depth: int = QUEUE_DEPTH) -> Dict:
+    """
+    Z-score the RPKM values of the samples in a count file and write them. Lines are read,
+    normalized, and written at the same time by a block_pipeline
+
+    Arguments
+    ---------
+    lines: The lines of the count file after the header
+    bad_indices: The indices of the genes removed by `select_genes`
+    low_variance_indices: The indices of the genes removed by `filter_low_variance` or
+                          `filter_and_scale`
+    gene_length_arr: The lengths of the remaining genes
+    means: The means of the remaining genes, or the centers from `filter_and_scale`
+    stds: The standard deviations of the remaining genes, or the scales from
+          `filter_and_scale`
+    out_file: The writer to write the normalized samples to
+    metrics: The metrics to record the time in each phase in
+    queue_depth: The number of blocks that can wait between two stages of the pipeline
+
+    Returns
+    -------
+    stats: The time each stage of the pipeline spent working and waiting
+    """
+    dtype = means.dtype
+    # Each stage can hold a block while queue_depth more wait between the stages
+    n_blocks = queue_depth + 2
+    count_pool = BlockPool(n_blocks, (BLOCK_SIZE, len(gene_length_arr)), dtype)
+    normalized_pool = BlockPool(n_blocks, (BLOCK_SIZE, len(gene_length_arr)), dtype)
+    reader = CountBlockReader(lines, [bad_indices, low_variance_indices], count_pool, metrics,
+                              count_skipped=False)
+
+    def normalize(block: CountBlock) -> Optional[Tuple[np.ndarray, List[str]]]:
+        rpkm, samples, _ = reader.rpkm(block, gene_length_arr)
+        if len(samples) == 0:
+            return None
+        normalized = normalized_pool.acquire()
+        with metrics.phase('compute'):
+            # Normalize the genes
+            rows = normalized[:len(samples)]
+            np.subtract(rpkm, means, out=rows)
+            np.divide(rows, stds, out=rows)
+        metrics.count('written', len(samples))
+        return normalized, samples
+
+    def write(result: Tuple[np.ndarray, List[str]]) -> None:
+        normalized, samples = result
+        with metrics.phase('write'):
+            out_file.write_block(normalized[:len(samples)], samples)
+        normalized_pool.release(normalized)
+
+    return run_pipeline(reader, normalize, write, queue_depth)
+
+
+def output_genes(header_genes: List[str], ensembl_to_genesymbol: Dict[str, str],
+                 bad_indices: List[int], low_variance_indices: np.ndarray) -> List[str]:
+    """
+    Get the gene symbols of the genes that are kept, for the header of the output
+
+    Arguments
+    ---------
+    header_genes: The Ensembl ids in the count file header
+    ensembl_to_genesymbol: A dict mapping Ensembl ids to gene symbols
+    bad_indices: The indices of the genes removed by `select_genes`
+    low_variance_indices: The indices of the genes removed by `filter_low_variance` or
+                          `filter_and_scale`
+
+    Returns
+    -------
+    genes: The symbols of the remaining genes
+    """
+    # Use numpy to allow indexing with a list of indices
+    genesymbol_header = []
+    for gene in header_genes:
+        if gene in ensembl_to_genesymbol:
+            symbol = ensembl_to_genesymbol[gene]
+            if len(symbol) == 0:
+                symbol = None
+            genesymbol_header.append(symbol)
+        else:
+            genesymbol_header.append(None)
+    header_arr = np.array(genesymbol_header)
+
+    header_arr = np.delete(header_arr, bad_indices)
+    header_arr = np.delete(header_arr, low_variance_indices)
+    return header_arr.tolist()
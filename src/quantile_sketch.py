@@ -0,0 +1,216 @@
+"""
+This file implements a streaming quantile sketch for every column of a matrix at once, used to
+get per-gene medians and quantiles of the compendium without holding it in memory.
+
+Each column's values are counted in logarithmically spaced bins, as in DDSketch, so a
+quantile is accurate to a fixed relative error that depends only on the memory budget. Unlike
+sampling sketches such as KLL or t-digest, the counts don't depend on the order the values
+arrive in, and sketches of separate shards add up to exactly the sketch of all of them. This
+keeps the quantiles of the sharded and single job preprocessing identical
+"""
+
+from typing import Iterator, Optional, Tuple, Union
+
+import numpy as np
+
+# The default memory budget for a sketch's counts, in megabytes
+SKETCH_MB = 256
+# Values are binned between these bounds. Smaller positive values are counted in the first
+# bin and larger ones in the last bin
+MIN_VALUE = 1e-6
+MAX_VALUE = 1e7
+# Quantiles and median absolute deviations are calculated a chunk of columns at a time, with
+# temporary arrays taking at most this fraction of the memory used by the counts
+WORKING_MEMORY_FRACTION = .25
+# The bytes of temporary arrays per bin of each column in the chunk. Updates take the int64
+# counts from np.bincount, quantiles take a cumulative sum and a comparison, and median absolute
+# deviations take the bins' deviations and sort order, the sorted counts, and their cumulative
+# sum and comparison
+UPDATE_BYTES_PER_BIN = 8
+QUANTILE_BYTES_PER_BIN = 9
+DEVIATION_BYTES_PER_BIN = 40
+
+
+class QuantileSketch():
+    def __init__(self, n_columns: int, memory_mb: float = SKETCH_MB,
+                 min_value: float = MIN_VALUE, max_value: float = MAX_VALUE,
+                 counts: Optional[np.ndarray] = None):
+        """
+        Approximate quantiles of each column of a stream of non-negative values, such as RPKM
+
+        Arguments
+        ---------
+        n_columns: The number of columns, e.g. genes
+        memory_mb: The memory to use for the counts. More memory means more bins, which makes
+                   the quantiles more accurate. Calculating quantiles takes up to
+                   WORKING_MEMORY_FRACTION of this much more
+        min_value: The smallest positive value with its own bin
+        max_value: The largest value with its own bin
+        counts: The n_columns x n_bins counts of a saved sketch
+        """
+        if counts is None:
+            n_bins = int(memory_mb * 2 ** 20) // (n_columns * np.dtype(np.uint32).itemsize)
+            if n_bins < 3:
+                raise ValueError('{} MB is too little memory to sketch {} columns'.format(
+                                 memory_mb, n_columns))
+            counts = np.zeros((n_columns, n_bins), dtype=np.uint32)
+
+        self.counts = counts
+        self.min_value = min_value
+        self.max_value = max_value
+        n_bins = counts.shape[1]
+        # Bin 0 holds zeros, and the rest are evenly spaced in log space
+        self.log_min = np.log(min_value)
+        self.log_gamma = (np.log(max_value) - self.log_min) / (n_bins - 1)
+        # Each bin's values are estimated by the geometric midpoint of the bin
+        self.values = np.exp(self.log_min + self.log_gamma * (np.arange(n_bins) - .5))
+        self.values[0] = 0
+        self.column_offsets = np.arange(n_columns, dtype=np.intp)[:, None] * n_bins
+
+    @property
+    def relative_error(self) -> float:
+        """The largest relative error of a quantile of values between min_value and max_value"""
+        return float(np.expm1(self.log_gamma / 2))
+
+    def _bins(self, values: np.ndarray) -> np.ndarray:
+        """Find the flat index of the bin each value of a rows x columns array falls in"""
+        with np.errstate(divide='ignore'):
+            log_values = np.log(np.asarray(values, dtype=np.float64))
+        bins = np.floor((log_values - self.log_min) / self.log_gamma) + 1
+        # Zeros have a log of -inf, so they go in bin 0
+        np.clip(bins, 1, self.counts.shape[1] - 1, out=bins)
+        bins[~(log_values > -np.inf)] = 0
+        return (bins.astype(np.intp).T + self.column_offsets).ravel()
+
+    def _count(self, values: np.ndarray, operation: np.ufunc) -> None:
+        """
+        Add or subtract the bin counts of rows of values, a chunk of columns at a time
+
+        Arguments
+        ---------
+        values: A rows x columns array
+        operation: np.add or np.subtract
+        """
+        n_bins = self.counts.shape[1]
+        bins = self._bins(values)
+        # The bins are column major, so each chunk of columns is a contiguous run of them
+        n_rows = bins.size // self.counts.shape[0]
+        for start, end in self._column_chunks(UPDATE_BYTES_PER_BIN):
+            chunk_counts = np.bincount(bins[start * n_rows:end * n_rows] - start * n_bins,
+                                       minlength=(end - start) * n_bins)
+            chunk = self.counts[start:end].reshape(-1)
+            operation(chunk, chunk_counts, out=chunk, casting='unsafe')
+
+    def update(self, values: np.ndarray) -> None:
+        """
+        Add rows of values to the sketch
+
+        Arguments
+        ---------
+        values: A rows x columns array
+        """
+        self._count(values, np.add)
+
+    def remove(self, values: np.ndarray) -> None:
+        """
+        Remove rows of values that were added to the sketch earlier
+
+        Arguments
+        ---------
+        values: A rows x columns array
+        """
+        self._count(values, np.subtract)
+
+    def merge(self, other: 'QuantileSketch') -> None:
+        """Add the values counted by another sketch with the same bins to this one"""
+        if self.counts.shape != other.counts.shape or self.min_value != other.min_value or \
+                self.max_value != other.max_value:
+            raise ValueError('Only sketches with the same bins can be merged')
+        self.counts += other.counts
+
+    def _column_chunks(self, bytes_per_bin: int) -> Iterator[Tuple[int, int]]:
+        """
+        Split the columns into chunks whose temporary arrays fit in the working memory
+
+        Arguments
+        ---------
+        bytes_per_bin: The bytes of temporary arrays needed for each bin of a column
+
+        Yields
+        ------
+        start: The first column of the chunk
+        end: One past the last column of the chunk
+        """
+        n_columns, n_bins = self.counts.shape
+        working_bytes = int(self.counts.nbytes * WORKING_MEMORY_FRACTION)
+        columns_per_chunk = max(1, working_bytes // (n_bins * bytes_per_bin))
+        for start in range(0, n_columns, columns_per_chunk):
+            yield start, min(start + columns_per_chunk, n_columns)
+
+    @property
+    def n_values(self) -> int:
+        """The number of values in each column"""
+        if len(self.counts) == 0:
+            return 0
+        return int(self.counts[0].sum())
+
+    def quantiles(self, q: Union[float, np.ndarray]) -> np.ndarray:
+        """
+        Estimate a quantile of each column
+
+        Arguments
+        ---------
+        q: The quantile, from 0 to 1, or an array with a quantile for each column
+
+        Returns
+        -------
+        quantiles: The estimated quantile of each column. The value at rank q * (n - 1) is
+                   found, without interpolating between values
+        """
+        n_values = self.n_values
+        if n_values == 0:
+            raise ValueError('Quantiles of an empty sketch are undefined')
+        ranks = np.floor(np.broadcast_to(q, (len(self.counts),)) * (n_values - 1))
+        bins = np.empty(len(self.counts), dtype=np.intp)
+        for start, end in self._column_chunks(QUANTILE_BYTES_PER_BIN):
+            cumulative_counts = np.cumsum(self.counts[start:end], axis=1, dtype=np.int64)
+            bins[start:end] = np.argmax(cumulative_counts > ranks[start:end, None], axis=1)
+        return self.values[bins]
+
+    def median_absolute_deviations(self, centers: np.ndarray) -> np.ndarray:
+        """
+        Estimate the median absolute deviation of each column from a center such as its median
+
+        Arguments
+        ---------
+        centers: The center of each column
+
+        Returns
+        -------
+        deviations: The median of each column's absolute differences from its center
+        """
+        rank = (self.n_values - 1) // 2
+        deviations = np.empty(len(self.counts))
+        for start, end in self._column_chunks(DEVIATION_BYTES_PER_BIN):
+            bin_deviations = self.values[None, :] - centers[start:end, None]
+            np.abs(bin_deviations, out=bin_deviations)
+            # Order each column's bins by their distance from the center
+            order = np.argsort(bin_deviations, axis=1, kind='stable')
+            sorted_counts = np.take_along_axis(self.counts[start:end], order, axis=1)
+            cumulative_counts = np.cumsum(sorted_counts, axis=1, dtype=np.int64)
+            median_bins = np.argmax(cumulative_counts > rank, axis=1)[:, None]
+            median_bins = np.take_along_axis(order, median_bins, axis=1)
+            deviations[start:end] = np.take_along_axis(bin_deviations, median_bins, axis=1)[:, 0]
+        return deviations
+
+    def save(self, path: str) -> None:
+        """Save the sketch to a .npz file. Most bins are empty, so it's compressed"""
+        np.savez_compressed(path, counts=self.counts, min_value=self.min_value,
+                            max_value=self.max_value)
+
+    @staticmethod
+    def load(path: str) -> 'QuantileSketch':
+        """Load a sketch saved by `save`"""
+        with np.load(path) as data:
+            return QuantileSketch(data['counts'].shape[0], min_value=float(data['min_value']),
+                                  max_value=float(data['max_value']), counts=data['counts'])
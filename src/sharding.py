@@ -0,0 +1,220 @@
+"""
+This file contains functions for splitting a samples x genes table into shards of lines that
+can be processed by separate jobs, and for gathering the shards' outputs back into one file.
+Shards are byte ranges of the input, so no job has to read lines outside its own shard.
+
+Stages that drop duplicate samples can only do so within a shard, so each shard job also saves
+the samples it saw. When the outputs are merged, lines whose sample was seen in an earlier shard
+are dropped, which gives the same result as processing the whole file in one job.
+
+Compressed inputs are read directly. Shards of BGZF files are byte ranges of compressed blocks,
+and each shard gets the lines whose preceding newline is in its blocks. Other gzip and zstd
+files can't be split, so the first shard gets every line
+"""
+
+import argparse
+import os
+import shutil
+import sys
+from typing import Iterable, Iterator, List, Set, Tuple
+
+from compressed_io import detect_compression, next_bgzf_block, open_input, open_output, \
+    read_bgzf_blocks
+
+
+def read_header(path: str) -> str:
+    """Read the header line of a file"""
+    with open_input(path, 'rb') as in_file:
+        return in_file.readline().decode()
+
+
+def shard_offsets(path: str, n_shards: int) -> List[Tuple[int, int]]:
+    """
+    Split the lines after a file's header into shards of roughly equal size
+
+    Arguments
+    ---------
+    path: The file to split
+    n_shards: The number of shards to split the file into
+
+    Returns
+    -------
+    offsets: The (start, end) byte offsets of each shard. Each shard starts at the beginning
+             of a line, or of a block in BGZF files, and some shards may be empty if the file
+             has fewer lines than shards
+    """
+    if n_shards < 1:
+        raise ValueError('n_shards must be at least 1, not {}'.format(n_shards))
+
+    size = os.path.getsize(path)
+    compression = detect_compression(path)
+    if compression == 'bgzip':
+        boundaries = [0]
+        for shard in range(1, n_shards):
+            boundaries.append(max(boundaries[-1], next_bgzf_block(path, size * shard // n_shards)))
+        boundaries.append(size)
+        return list(zip(boundaries[:-1], boundaries[1:]))
+    if compression is not None:
+        if n_shards > 1:
+            print('{} is {} compressed and can\'t be split, so one shard will process all of it. '
+                  'Recompress it with bgzip or compressed_io.py to split it'.format(path,
+                                                                                  compression),
+                  file=sys.stderr)
+        return [(0, size)] + [(size, size)] * (n_shards - 1)
+
+    with open(path, 'rb') as in_file:
+        header_end = len(in_file.readline())
+        boundaries = [header_end]
+        for shard in range(1, n_shards):
+            target = header_end + (size - header_end) * shard // n_shards
+            if target <= boundaries[-1]:
+                boundaries.append(boundaries[-1])
+                continue
+            # Move the boundary forward to the start of the next line
+            in_file.seek(target - 1)
+            in_file.readline()
+            boundaries.append(in_file.tell())
+        boundaries.append(size)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def shard_lines(path: str, start: int, end: int) -> Iterator[str]:
+    """
+    Iterate over the lines in a shard of a file
+
+    Arguments
+    ---------
+    path: The file the shard is from
+    start: The byte offset of the first line in the shard
+    end: The byte offset after the last line in the shard
+    """
+    compression = detect_compression(path)
+    if compression == 'bgzip':
+        yield from _bgzf_shard_lines(path, start, end)
+        return
+    if compression is not None:
+        if start < end:
+            with open_input(path, 'rb') as in_file:
+                in_file.readline()
+                for line in in_file:
+                    yield line.decode()
+        return
+
+    with open(path, 'rb') as in_file:
+        in_file.seek(start)
+        position = start
+        while position < end:
+            line = in_file.readline()
+            if len(line) == 0:
+                break
+            position += len(line)
+            yield line.decode()
+
+
+def _bgzf_shard_lines(path: str, start: int, end: int) -> Iterator[str]:
+    """
+    Iterate over the lines of a BGZF file whose preceding newline is in the blocks from start
+    to end. The first newline ends the header or a line from the previous shard, so it's
+    skipped, and the last line may continue into the next shard's blocks
+    """
+    if start >= end:
+        return
+    # The position in the decompressed data of the start of the next line
+    line_start = 0
+    # The position in the decompressed data of the first block after the shard
+    boundary = None
+    found_first_newline = False
+    parts = []
+    position = 0
+    for offset, data in read_bgzf_blocks(path, start):
+        if boundary is None and offset >= end:
+            boundary = position
+        position += len(data)
+        if b'\n' not in data:
+            parts.append(data)
+            continue
+
+        parts.append(data)
+        lines = b''.join(parts).split(b'\n')
+        parts = [lines.pop()]
+        for line in lines:
+            if found_first_newline:
+                if boundary is not None and line_start > boundary:
+                    return
+                yield (line + b'\n').decode()
+            found_first_newline = True
+            line_start += len(line) + 1
+
+    # The last line may not end with a newline
+    last_line = b''.join(parts)
+    if found_first_newline and len(last_line) > 0 and \
+            (boundary is None or line_start <= boundary):
+        yield last_line.decode()
+
+
+def get_sample(line: str) -> str:
+    """Get the sample id from the start of a line"""
+    return line.split('\t', 1)[0].replace('"', '').strip()
+
+
+def write_samples(path: str, samples: Iterable[str]) -> None:
+    """
+    Save the ids of the samples seen by a shard, one per line. They're sorted so rerunning
+    a shard writes the same file, which keeps the artifact cache keys of later stages the same
+    """
+    with open(path, 'w') as out_file:
+        for sample in sorted(samples):
+            out_file.write('{}\n'.format(sample))
+
+
+def read_samples(path: str) -> Set[str]:
+    """Load the ids of the samples seen by a shard"""
+    with open(path) as in_file:
+        return set(line.rstrip('\n') for line in in_file)
+
+
+def merge_shards(out_path: str, shard_paths: List[str], seen_paths: List[str]) -> None:
+    """
+    Concatenate the outputs of each shard, keeping only the first shard's header and
+    dropping lines whose sample was already seen in an earlier shard
+
+    Arguments
+    ---------
+    out_path: The file to write the merged output to
+    shard_paths: The output of each shard, in order. Each one starts with a header line
+    seen_paths: The files listing the samples seen by each shard, in the same order
+    """
+    if len(shard_paths) != len(seen_paths):
+        raise ValueError('Got {} shards but {} seen sample files'.format(len(shard_paths),
+                                                                      len(seen_paths)))
+
+    samples_seen = set()
+    with open_output(out_path, 'wb') as out_file:
+        for shard, (shard_path, seen_path) in enumerate(zip(shard_paths, seen_paths)):
+            shard_samples = read_samples(seen_path)
+            with open_input(shard_path, 'rb') as shard_file:
+                header = shard_file.readline()
+                if shard == 0:
+                    out_file.write(header)
+
+                if samples_seen.isdisjoint(shard_samples):
+                    # Nothing to drop, so copy the shard without parsing it
+                    shutil.copyfileobj(shard_file, out_file)
+                else:
+                    for line in shard_file:
+                        if get_sample(line.decode()) not in samples_seen:
+                            out_file.write(line)
+            samples_seen.update(shard_samples)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the outputs of sharded jobs')
+    parser.add_argument('out_file', help='The file to write the merged output to')
+    parser.add_argument('--shards', nargs='+', required=True,
+                        help='The output files of each shard, in order')
+    parser.add_argument('--seen', nargs='+', required=True,
+                        help='The files listing the samples each shard saw, in the same order')
+    args = parser.parse_args()
+
+    merge_shards(args.out_file, args.shards, args.seen)
@@ -0,0 +1,404 @@
+"""
+This file contains functions for storing labeled matrices and columnar tables in binary
+formats that can be memory-mapped, allowing pipeline stages to work on data that doesn't
+fit in RAM. String columns of tables can be given hash indexes for looking up rows by value
+"""
+
+import json
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+VALUES_FILE = 'values.npy'
+ROWS_FILE = 'rows.npy'
+COLUMNS_FILE = 'columns.npy'
+SCHEMA_FILE = 'schema.json'
+
+
+def save_names(path: str, names: Sequence[str]) -> None:
+    """Save a list of row or column names as a unicode numpy array"""
+    np.save(path, np.array([str(name) for name in names], dtype=str))
+
+
+def create_matrix(path: str, shape: Tuple[int, int], dtype: np.dtype,
+                  row_names: Sequence[str], column_names: Sequence[str]) -> np.memmap:
+    """
+    Create an empty on-disk matrix that can be filled in incrementally
+
+    Arguments
+    ---------
+    path: The directory to store the matrix in. It will be created if it doesn't exist
+    shape: The (rows, columns) shape of the matrix
+    dtype: The numpy dtype of the matrix values
+    row_names: The labels for each row in the matrix
+    column_names: The labels for each column in the matrix
+
+    Returns
+    -------
+    values: A writable memory-mapped array backed by the file storing the matrix values
+    """
+    if len(row_names) != shape[0] or len(column_names) != shape[1]:
+        raise ValueError('Matrix shape {} does not match the number of row ({}) and column ({}) '
+                         'names'.format(shape, len(row_names), len(column_names)))
+
+    os.makedirs(path, exist_ok=True)
+    save_names(os.path.join(path, ROWS_FILE), row_names)
+    save_names(os.path.join(path, COLUMNS_FILE), column_names)
+
+    values = np.lib.format.open_memmap(os.path.join(path, VALUES_FILE), mode='w+',
+                                       dtype=dtype, shape=shape)
+    return values
+
+
+def save_matrix(path: str, matrix: np.ndarray, row_names: Sequence[str],
+                column_names: Sequence[str]) -> None:
+    """
+    Store an in-memory matrix and its labels in the binary matrix format
+
+    Arguments
+    ---------
+    path: The directory to store the matrix in
+    matrix: The 2-d array to store
+    row_names: The labels for each row in the matrix
+    column_names: The labels for each column in the matrix
+    """
+    values = create_matrix(path, matrix.shape, matrix.dtype, row_names, column_names)
+    values[:] = matrix
+    values.flush()
+
+
+def load_matrix(path: str, mmap_mode: str = 'r') -> Tuple[np.ndarray, List[str], List[str]]:
+    """
+    Load a matrix stored by `create_matrix` or `save_matrix`
+
+    Arguments
+    ---------
+    path: The directory the matrix was stored in
+    mmap_mode: The mode to memory-map the values with. Pass None to read them into memory
+
+    Returns
+    -------
+    values: The (possibly memory-mapped) matrix values
+    row_names: The labels for each row in the matrix
+    column_names: The labels for each column in the matrix
+    """
+    values = np.load(os.path.join(path, VALUES_FILE), mmap_mode=mmap_mode)
+    row_names = np.load(os.path.join(path, ROWS_FILE)).tolist()
+    column_names = np.load(os.path.join(path, COLUMNS_FILE)).tolist()
+
+    return values, row_names, column_names
+
+
+class TableWriter():
+    def __init__(self, path: str, numeric_columns: Dict[str, np.dtype],
+                 categorical_columns: Sequence[str]):
+        """
+        Write a table to disk one chunk of rows at a time. Each column is stored in its own
+        file so readers can load only the columns they need. String columns are stored as
+        integer codes into a list of categories to keep them compact
+
+        Arguments
+        ---------
+        path: The directory to store the table in. It will be created if it doesn't exist
+        numeric_columns: A dict mapping the names of numeric columns to their dtypes
+        categorical_columns: The names of the columns to store as categoricals
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.n_rows = 0
+        self.columns = []
+        self.files = {}
+        self.categories = {}
+
+        for name, dtype in numeric_columns.items():
+            self.columns.append({'name': name, 'kind': 'numeric',
+                                 'dtype': np.dtype(dtype).str})
+        for name in categorical_columns:
+            self.columns.append({'name': name, 'kind': 'categorical',
+                                 'dtype': np.dtype(np.int32).str})
+            self.categories[name] = {}
+
+        for i, column in enumerate(self.columns):
+            column['file'] = 'column_{}.bin'.format(i)
+            self.files[column['name']] = open(os.path.join(path, column['file']), 'wb')
+
+    def write(self, chunk: pd.DataFrame) -> None:
+        """
+        Append a chunk of rows to the table
+
+        Arguments
+        ---------
+        chunk: A dataframe containing every column in the table
+        """
+        for column in self.columns:
+            name = column['name']
+            if column['kind'] == 'numeric':
+                values = chunk[name].to_numpy(dtype=column['dtype'])
+            else:
+                chunk_codes, uniques = pd.factorize(chunk[name])
+                category_to_code = self.categories[name]
+                for category in uniques:
+                    if category not in category_to_code:
+                        category_to_code[category] = len(category_to_code)
+                code_map = np.array([category_to_code[category] for category in uniques],
+                                    dtype=np.int32)
+                # Missing values are factorized to -1, so keep them as -1
+                values = np.where(chunk_codes >= 0, code_map[chunk_codes], -1).astype(np.int32)
+            self.files[name].write(values.tobytes())
+
+        self.n_rows += len(chunk)
+
+    def close(self) -> None:
+        """
+        Finish writing the table by storing its categories and schema
+        """
+        for column in self.columns:
+            self.files[column['name']].close()
+            if column['kind'] == 'categorical':
+                categories = list(self.categories[column['name']].keys())
+                column['categories'] = column['file'].replace('.bin', '.categories.npy')
+                np.save(os.path.join(self.path, column['categories']),
+                        np.array([str(category) for category in categories], dtype=str))
+
+        with open(os.path.join(self.path, SCHEMA_FILE), 'w') as out_file:
+            json.dump({'n_rows': self.n_rows, 'columns': self.columns}, out_file, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def save_table(path: str, df: pd.DataFrame) -> None:
+    """
+    Store a dataframe in the binary table format, keeping numeric columns as they are and
+    storing all other columns as categoricals
+
+    Arguments
+    ---------
+    path: The directory to store the table in
+    df: The dataframe to store. Its index is not saved
+    """
+    numeric_columns = {name: df[name].dtype for name in df.columns
+                       if pd.api.types.is_numeric_dtype(df[name])
+                       and not pd.api.types.is_bool_dtype(df[name])}
+    categorical_columns = [name for name in df.columns if name not in numeric_columns]
+
+    with TableWriter(path, numeric_columns, categorical_columns) as writer:
+        writer.write(df)
+
+
+def load_table(path: str, columns: Optional[Sequence[str]] = None,
+               mmap_mode: Optional[str] = 'r', rows: Optional[slice] = None) -> pd.DataFrame:
+    """
+    Load a table stored by `TableWriter` or `save_table`
+
+    Arguments
+    ---------
+    path: The directory the table was stored in
+    columns: The columns to load. Only the files for these columns are read. Defaults to all
+    mmap_mode: The mode to memory-map numeric columns with. Pass None to read them into memory
+    rows: A slice of rows to load. Defaults to all rows
+
+    Returns
+    -------
+    table: A dataframe with numeric columns and pandas categorical columns
+    """
+    with open(os.path.join(path, SCHEMA_FILE)) as in_file:
+        schema = json.load(in_file)
+
+    column_info = {column['name']: column for column in schema['columns']}
+    if columns is None:
+        columns = [column['name'] for column in schema['columns']]
+
+    data = {}
+    for name in columns:
+        if name not in column_info:
+            raise KeyError('Column {} is not present in the table at {}'.format(name, path))
+        column = column_info[name]
+        file_path = os.path.join(path, column['file'])
+
+        if schema['n_rows'] == 0:
+            values = np.empty(0, dtype=column['dtype'])
+        elif mmap_mode is None:
+            values = np.fromfile(file_path, dtype=column['dtype'])
+        else:
+            values = np.memmap(file_path, dtype=column['dtype'], mode=mmap_mode,
+                               shape=(schema['n_rows'],))
+
+        if rows is not None:
+            values = values[rows]
+
+        if column['kind'] == 'categorical':
+            categories = np.load(os.path.join(path, column['categories']))
+            values = pd.Categorical.from_codes(np.asarray(values), categories=categories)
+        data[name] = values
+
+    return pd.DataFrame(data, columns=list(columns))
+
+
+class HashIndex():
+    def __init__(self, slots: np.ndarray, first_rows: np.ndarray, categories: np.ndarray):
+        """
+        An open addressing hash table that maps the values of a categorical column to the
+        first row they appear in. The table is stored as plain arrays, so it can be saved with
+        the column and memory-mapped instead of being rebuilt every time it's loaded
+
+        Arguments
+        ---------
+        slots: The hash table. Each slot holds a category code, or -1 if it's empty
+        first_rows: The first row each category appears in, or -1 if it isn't in any row
+        categories: The strings the codes refer to
+        """
+        self.slots = slots
+        self.first_rows = first_rows
+        self.categories = categories
+        self.mask = len(slots) - 1
+
+    @staticmethod
+    def _hash(keys: np.ndarray) -> np.ndarray:
+        # pandas' hash is seeded with a fixed key, so it's the same in every process
+        return pd.util.hash_array(np.asarray(keys, dtype=str).astype(object))
+
+    @staticmethod
+    def build(categories: np.ndarray, codes: np.ndarray) -> 'HashIndex':
+        """
+        Build an index of a categorical column
+
+        Arguments
+        ---------
+        categories: The unique strings in the column
+        codes: The category code of each row, or -1 for missing values
+
+        Returns
+        -------
+        index: The index mapping each category to the first row it's in
+        """
+        categories = np.asarray(categories, dtype=str)
+        n_categories = len(categories)
+        # Keep the table at most half full so probe sequences stay short
+        n_slots = 2
+        while n_slots < 2 * n_categories:
+            n_slots *= 2
+        mask = n_slots - 1
+
+        slots = np.full(n_slots, -1, dtype=np.int64)
+        positions = (HashIndex._hash(categories) & np.uint64(mask)).astype(np.int64)
+        pending = np.arange(n_categories)
+        # Insert every category at once with linear probing. When several categories want the
+        # same empty slot the first one gets it, and the rest move on to the next slot
+        while len(pending) > 0:
+            pending_positions = positions[pending]
+            free = slots[pending_positions] == -1
+            _, first_claims = np.unique(pending_positions[free], return_index=True)
+            winners = pending[free][first_claims]
+            slots[positions[winners]] = winners
+
+            placed = np.zeros(n_categories, dtype=bool)
+            placed[winners] = True
+            pending = pending[~placed[pending]]
+            positions[pending] = (positions[pending] + 1) & mask
+
+        codes = np.asarray(codes)
+        first_rows = np.full(n_categories, -1, dtype=np.int64)
+        valid_rows = np.where(codes >= 0)[0]
+        present_codes, first_indices = np.unique(codes[valid_rows], return_index=True)
+        first_rows[present_codes] = valid_rows[first_indices]
+
+        return HashIndex(slots, first_rows, categories)
+
+    def lookup(self, keys: Sequence[str]) -> np.ndarray:
+        """
+        Find the first row containing each key
+
+        Arguments
+        ---------
+        keys: The values to look up
+
+        Returns
+        -------
+        rows: The first row containing each key, or -1 for keys that aren't in the column
+        """
+        keys = np.asarray(keys, dtype=str)
+        codes = np.full(len(keys), -1, dtype=np.int64)
+        positions = (self._hash(keys) & np.uint64(self.mask)).astype(np.int64)
+        pending = np.arange(len(keys))
+        while len(pending) > 0:
+            slot_codes = self.slots[positions[pending]]
+            occupied = slot_codes >= 0
+            # An empty slot ends the probe sequence, so those keys aren't in the index
+            pending = pending[occupied]
+            slot_codes = slot_codes[occupied]
+
+            matches = self.categories[slot_codes] == keys[pending]
+            codes[pending[matches]] = slot_codes[matches]
+            pending = pending[~matches]
+            positions[pending] = (positions[pending] + 1) & self.mask
+
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        found = codes >= 0
+        rows[found] = self.first_rows[codes[found]]
+        return rows
+
+
+def save_hash_index(path: str, column: str) -> HashIndex:
+    """
+    Build a hash index of a categorical column in a table stored by `TableWriter` and save it
+    alongside the column
+
+    Arguments
+    ---------
+    path: The directory the table was stored in
+    column: The name of the categorical column to index
+
+    Returns
+    -------
+    index: The new index
+    """
+    schema_path = os.path.join(path, SCHEMA_FILE)
+    with open(schema_path) as in_file:
+        schema = json.load(in_file)
+    column_info = {info['name']: info for info in schema['columns']}
+    if column not in column_info or column_info[column]['kind'] != 'categorical':
+        raise KeyError('{} is not a categorical column in the table at {}'.format(column, path))
+    info = column_info[column]
+
+    codes = np.fromfile(os.path.join(path, info['file']), dtype=info['dtype'])
+    categories = np.load(os.path.join(path, info['categories']))
+    index = HashIndex.build(categories, codes)
+
+    info['index_slots'] = info['file'].replace('.bin', '.index_slots.npy')
+    info['index_rows'] = info['file'].replace('.bin', '.index_rows.npy')
+    np.save(os.path.join(path, info['index_slots']), index.slots)
+    np.save(os.path.join(path, info['index_rows']), index.first_rows)
+    with open(schema_path, 'w') as out_file:
+        json.dump(schema, out_file, indent=2)
+    return index
+
+
+def load_hash_index(path: str, column: str) -> HashIndex:
+    """
+    Load the hash index saved by `save_hash_index`. The table arrays are memory-mapped, so
+    loading is fast however many rows the table has
+
+    Arguments
+    ---------
+    path: The directory the table was stored in
+    column: The name of the indexed column
+
+    Returns
+    -------
+    index: The column's index
+    """
+    with open(os.path.join(path, SCHEMA_FILE)) as in_file:
+        schema = json.load(in_file)
+    info = {info['name']: info for info in schema['columns']}[column]
+    if 'index_slots' not in info:
+        raise KeyError('Column {} of the table at {} has no index'.format(column, path))
+    return HashIndex(np.load(os.path.join(path, info['index_slots']), mmap_mode='r'),
+                     np.load(os.path.join(path, info['index_rows']), mmap_mode='r'),
+                     np.load(os.path.join(path, info['categories'])))
@@ -0,0 +1,189 @@
+"""
+This script selects a reproducible random subset of the samples in a compendium file
+(e.g. sra_counts.tsv or no_scrna_rpkm.tsv) in a single pass with reservoir sampling, so
+pipeline changes can be tried end to end on a small compendium before running on all the data
+"""
+
+import argparse
+import sys
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import tqdm
+
+from compressed_io import open_input, open_output
+
+# The number of metadata rows to filter at once when writing --metadata_out
+CHUNKSIZE = 100000
+
+
+class LineReservoir():
+    def __init__(self, size: int, rng: np.random.Generator):
+        """
+        Keep a uniform random sample of the lines added to the reservoir (Algorithm R)
+
+        Arguments
+        ---------
+        size: The number of lines to keep
+        rng: The random number generator to sample with
+        """
+        self.size = size
+        self.rng = rng
+        self.n_seen = 0
+        self.lines: List[Tuple[int, str]] = []
+
+    def add(self, line_number: int, line: str) -> None:
+        """Offer a line to the reservoir, keeping it with probability size / lines seen"""
+        self.n_seen += 1
+        if len(self.lines) < self.size:
+            self.lines.append((line_number, line))
+        else:
+            i = self.rng.integers(self.n_seen)
+            if i < self.size:
+                self.lines[i] = (line_number, line)
+
+
+def allocate_samples(study_sizes: pd.Series, n_samples: int) -> Dict[str, int]:
+    """
+    Split a number of samples between studies in proportion to their sizes, giving leftover
+    samples to the studies with the largest remainders
+
+    Arguments
+    ---------
+    study_sizes: The number of samples in each study, indexed by study
+    n_samples: The total number of samples to select
+
+    Returns
+    -------
+    quotas: The number of samples to select from each study
+    """
+    n_samples = min(n_samples, int(study_sizes.sum()))
+    exact = study_sizes * n_samples / study_sizes.sum()
+    quotas = np.floor(exact).astype(int)
+
+    leftover = n_samples - quotas.sum()
+    # Break ties by study name so the allocation doesn't depend on the metadata order
+    remainders = (exact - quotas).sort_index().sort_values(ascending=False, kind='stable')
+    quotas[remainders.index[:leftover]] += 1
+
+    return quotas.to_dict()
+
+
+def get_sample(line: str) -> str:
+    """Get the (possibly quoted) sample id at the start of a compendium line"""
+    return line.split('\t', 1)[0].strip('"')
+
+
+def read_sample_ids(in_path: str) -> List[str]:
+    """
+    Read the sample ids of a compendium file without parsing the rest of its lines
+
+    Arguments
+    ---------
+    in_path: The path to the compendium file
+
+    Returns
+    -------
+    samples: The sample ids in the order they appear in the file
+    """
+    with open_input(in_path) as in_file:
+        # Throw out header
+        in_file.readline()
+        return [get_sample(line) for line in tqdm.tqdm(in_file, desc='Reading sample ids')]
+
+
+def subsample(in_file, n_samples: int, seed: int,
+              sample_to_study: Optional[Dict[str, str]] = None,
+              quotas: Optional[Dict[str, int]] = None) -> List[str]:
+    """
+    Select random lines from a compendium file in a single pass
+
+    Arguments
+    ---------
+    in_file: An open compendium file positioned after the header
+    n_samples: The number of lines to select
+    seed: The seed for the random number generator
+    sample_to_study: If given, sample from each study separately. Samples without a study
+                     are skipped
+    quotas: The number of samples to select from each study, required with sample_to_study
+
+    Returns
+    -------
+    lines: The selected lines in the order they appear in the file
+    """
+    rng = np.random.default_rng(seed)
+
+    if sample_to_study is None:
+        reservoir = LineReservoir(n_samples, rng)
+        for line_number, line in enumerate(tqdm.tqdm(in_file)):
+            reservoir.add(line_number, line)
+        reservoirs = [reservoir]
+    else:
+        study_reservoirs = {study: LineReservoir(quota, rng) for study, quota in quotas.items()
+                            if quota > 0}
+        for line_number, line in enumerate(tqdm.tqdm(in_file)):
+            study = sample_to_study.get(get_sample(line))
+            if study in study_reservoirs:
+                study_reservoirs[study].add(line_number, line)
+        reservoirs = study_reservoirs.values()
+
+    selected = sorted(entry for reservoir in reservoirs for entry in reservoir.lines)
+    return [line for _, line in selected]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('in_file', help='A samples x genes compendium tsv with a header line')
+    parser.add_argument('out_file', help='The file to save the selected samples to')
+    parser.add_argument('n_samples', type=int, help='The number of samples to select')
+    parser.add_argument('--seed', default=42, type=int,
+                        help='The seed for the random number generator')
+    parser.add_argument('--metadata_file', help='The recount metadata')
+    parser.add_argument('--metadata_out',
+                        help='A file to save the metadata of the selected samples to')
+    parser.add_argument('--stratify', action='store_true',
+                        help='Select samples from each study in proportion to the number of '
+                             'samples it has in the compendium file')
+    parser.add_argument('--sample_column', default='external_id',
+                        help='The metadata column containing sample ids')
+    parser.add_argument('--study_column', default='study',
+                        help='The metadata column containing study ids')
+    args = parser.parse_args()
+
+    if args.metadata_file is None and (args.stratify or args.metadata_out is not None):
+        parser.error('--stratify and --metadata_out require --metadata_file')
+
+    sample_to_study = None
+    quotas = None
+    if args.stratify:
+        studies = pd.read_csv(args.metadata_file, sep='\t', dtype=str,
+                              usecols=[args.sample_column, args.study_column]).dropna()
+        # Only the samples in the compendium count towards the quotas, so studies removed
+        # from it (e.g. scRNA-seq or held out studies) don't take any
+        studies = studies[studies[args.sample_column].isin(set(read_sample_ids(args.in_file)))]
+        studies = studies.drop_duplicates(subset=args.sample_column)
+        sample_to_study = dict(zip(studies[args.sample_column], studies[args.study_column]))
+        quotas = allocate_samples(studies[args.study_column].value_counts(), args.n_samples)
+
+    with open_input(args.in_file) as in_file:
+        header = in_file.readline()
+        lines = subsample(in_file, args.n_samples, args.seed, sample_to_study, quotas)
+
+    with open_output(args.out_file) as out_file:
+        out_file.write(header)
+        out_file.writelines(lines)
+
+    if args.metadata_out is not None:
+        selected_samples = set(get_sample(line) for line in lines)
+        with pd.read_csv(args.metadata_file, sep='\t', dtype=str,
+                         chunksize=CHUNKSIZE) as reader:
+            for i, chunk in enumerate(reader):
+                chunk = chunk[chunk[args.sample_column].isin(selected_samples)]
+                chunk.to_csv(args.metadata_out, sep='\t', index=False, header=(i == 0),
+                             mode='w' if i == 0 else 'a')
+
+    if len(lines) < args.n_samples:
+        print('Warning: only {} of the {} requested samples were selected'.format(
+              len(lines), args.n_samples), file=sys.stderr)
+    print('Selected {} samples'.format(len(lines)))
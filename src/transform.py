@@ -4,14 +4,21 @@ expression data into LV space
 """
 
 import random
-from typing import List
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 
+from block_pipeline import QUEUE_DEPTH, BlockPool, run_pipeline
+from tsv_writer import TsvWriter
+
+# The number of samples to read and transform at once in transform_file
+CHUNKSIZE = 1000
+
 
 class PlierTransform():
-    def __init__(self, weight_file: str, lambda_file: str, debug: bool = False):
+    def __init__(self, weight_file: str, lambda_file: str, debug: bool = False,
+                 dtype: np.dtype = np.float64):
         """
         Load the PLIER weights into a numpy array
 
@@ -21,12 +28,15 @@ class PlierTransform():
                      be called Z.tsv
         lambda_file: The file containing the L2 norm used by PLIER for training
         debug: A flag that prints more information about the input data when set to True
+        dtype: The float type to project expression data in. The (small) LVs x LVs inverse is
+               always calculated in float64 and then converted
         """
         lv_df = pd.read_csv(weight_file, sep='\t')
         with open(lambda_file) as in_file:
             self.l2 = float(in_file.readline().strip())
         self.lv_df = lv_df
         loadings = lv_df.to_numpy()
+        self.dtype = np.dtype(dtype)
         self.loadings = loadings
         self.file = weight_file
         self.genes = list(lv_df.index)
@@ -70,18 +80,104 @@ class PlierTransform():
             print('Loading dims: {}'.format(self.loadings.shape))
             raise e
 
-        expression_matrix = reordered_expression.values
+        expression_matrix = reordered_expression.to_numpy(dtype=self.dtype)
+
+        loadings, inv_term = self._projection()
+        transformed_matrix = expression_matrix @ loadings @ inv_term
+
+        transformed_df = pd.DataFrame(transformed_matrix, index=reordered_expression.index,
+                                      columns=self._lv_names())
+
+        return transformed_df
 
+    def _projection(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the loadings and the regularized inverse that project expression onto the LVs"""
         xTx = self.loadings.T @ self.loadings
         inv_term = np.linalg.inv(xTx + np.identity(self.loadings.shape[1]) * self.l2)
-        transformed_matrix = expression_matrix @ self.loadings @ inv_term
+        return (self.loadings.astype(self.dtype, copy=False),
+                inv_term.astype(self.dtype, copy=False))
 
-        col_names = ['LV{}'.format(i+1) for i in range(transformed_matrix.shape[1])]
+    def _lv_names(self) -> List[str]:
+        return ['LV{}'.format(i+1) for i in range(self.loadings.shape[1])]
 
-        transformed_df = pd.DataFrame(transformed_matrix, index=reordered_expression.index,
-                                      columns=col_names)
+    def _read_chunks(self, expression_file: str, chunksize: int, fill_missing: bool,
+                     pool: BlockPool) -> Iterator[Tuple[np.ndarray, List[str]]]:
+        """
+        Read a samples x genes tsv in chunks with the genes in the same order as PLIER's. Each
+        chunk is copied into a block from the pool, which is released once it's transformed
+        """
+        columns = pd.read_csv(expression_file, sep='\t', index_col=0, nrows=0).columns
+        positions = columns.get_indexer(self.genes)
+        missing = np.flatnonzero(positions < 0)
+        if len(missing) > 0 and not fill_missing:
+            raise KeyError('{} of the PLIER genes are missing from {}, e.g. {}'.format(
+                           len(missing), expression_file, [self.genes[i] for i in missing[:5]]))
+        positions[missing] = 0
+
+        # Parsing the values as the block dtype lets them be copied straight into the blocks
+        dtypes = {column: self.dtype for column in columns}
+        with pd.read_csv(expression_file, sep='\t', index_col=0, chunksize=chunksize,
+                         dtype=dtypes) as reader:
+            for chunk in reader:
+                block = pool.acquire()
+                rows = block[:len(chunk)]
+                np.take(chunk.to_numpy(), positions, axis=1, out=rows)
+                rows[:, missing] = 0
+                yield block, chunk.index.tolist()
+
+    def transform_file(self, expression_file: str, out_file: str, chunksize: int = CHUNKSIZE,
+                       fill_missing: bool = False, float_format: Optional[str] = None,
+                       queue_depth: int = QUEUE_DEPTH) -> Dict[str, Dict[str, float]]:
+        """
+        Transform a samples x genes tsv into the PLIER latent space without loading it all
+        into memory. Chunks of samples are read, transformed, and written at the same time
 
-        return transformed_df
+        Arguments
+        ---------
+        expression_file: A tsv with sample ids in the first column and a column per gene
+        out_file: The tsv to write the samples x LVs matrix to
+        chunksize: The number of samples to transform at once
+        fill_missing: Whether to fill genes that aren't in the expression file with zeros.
+                      Otherwise missing genes raise a KeyError
+        float_format: A printf-style format for the values. Defaults to the shortest exact
+                      representation
+        queue_depth: The number of chunks that can wait between reading, transforming,
+                     and writing
+
+        Returns
+        -------
+        stats: The time reading, transforming, and writing spent working and waiting
+        """
+        loadings, inv_term = self._projection()
+        # Each stage can hold a block while queue_depth more wait between the stages
+        n_blocks = queue_depth + 2
+        expression_pool = BlockPool(n_blocks, (chunksize, len(self.genes)), self.dtype)
+        pool = BlockPool(n_blocks, (chunksize, loadings.shape[1]), self.dtype)
+
+        index_name = pd.read_csv(expression_file, sep='\t', index_col=0, nrows=0).index.name
+        writer = TsvWriter(out_file, float_format=float_format)
+        writer.write_line(['' if index_name is None else index_name] + self._lv_names())
+
+        def transform_chunk(chunk: Tuple[np.ndarray, List[str]]) -> Tuple[np.ndarray, List[str]]:
+            expression_matrix, samples = chunk
+            transformed = pool.acquire()
+            np.matmul(expression_matrix[:len(samples)] @ loadings, inv_term,
+                      out=transformed[:len(samples)])
+            expression_pool.release(expression_matrix)
+            return transformed, samples
+
+        def write_chunk(result: Tuple[np.ndarray, List[str]]) -> None:
+            transformed, samples = result
+            writer.write_block(transformed[:len(samples)], samples)
+            pool.release(transformed)
+
+        try:
+            stats = run_pipeline(self._read_chunks(expression_file, chunksize, fill_missing,
+                                                   expression_pool),
+                                 transform_chunk, write_chunk, queue_depth)
+        finally:
+            writer.close()
+        return stats
 
     def __str__(self):
         """
@@ -0,0 +1,202 @@
+"""
+This file implements a fast writer for tab separated numeric data. Whole 2-D blocks are
+formatted with a single string formatting operation instead of one call per value, the
+output is buffered in large chunks, and writing (and optionally BGZF/gzip/zstd compression)
+happens in a background thread so it overlaps with formatting
+"""
+
+import queue
+import threading
+from typing import Optional, Sequence
+
+import numpy as np
+
+from compressed_io import open_output
+
+# The number of characters to buffer before handing data to the writer thread
+BUFFER_SIZE = 16 * 2 ** 20
+# The number of buffers that can wait to be written before formatting blocks
+QUEUE_DEPTH = 4
+# The number of values to format at once, which bounds the memory used by large blocks
+VALUES_PER_FORMAT = 2 ** 20
+
+
+def precision_format(precision: Optional[int],
+                     dtype: np.dtype = np.float64) -> Optional[str]:
+    """
+    Get the float format that writes a fixed number of significant digits
+
+    Arguments
+    ---------
+    precision: The number of significant digits, or None to write floats exactly
+    dtype: The dtype of the values being written. Python's shortest representation is only
+           exact for float64, so float32 values default to the nine digits needed to read
+           them back exactly
+
+    Returns
+    -------
+    float_format: A printf-style format, or None to use Python's shortest exact representation
+    """
+    if precision is None:
+        if np.dtype(dtype) == np.float32:
+            return '%.9g'
+        return None
+    return '%.{}g'.format(precision)
+
+
+def _value_format(dtype: np.dtype, float_format: Optional[str]) -> str:
+    """Choose the printf-style format for the values in an array"""
+    if np.issubdtype(dtype, np.integer) or np.issubdtype(dtype, np.bool_):
+        return '%d'
+    if np.issubdtype(dtype, np.floating):
+        # %r uses repr, which matches str(x) and '{}'.format(x) for Python floats
+        return float_format if float_format is not None else '%r'
+    return '%s'
+
+
+def format_block(values: np.ndarray, row_labels: Optional[Sequence[str]] = None,
+                 float_format: Optional[str] = None, delimiter: str = '\t') -> str:
+    """
+    Format a 2-D block of values as delimited text with one formatting operation
+
+    Arguments
+    ---------
+    values: A rows x columns array. Integer arrays are written as integers, float arrays
+            with float_format, and anything else with str
+    row_labels: An optional label to write at the start of each row
+    float_format: A printf-style format for floats such as '%.6g'. Defaults to the shortest
+                  representation that reads back as the same float, like '{}'.format(x)
+    delimiter: The string to put between fields
+
+    Returns
+    -------
+    text: The formatted block, with a newline after every row
+    """
+    values = np.asarray(values)
+    if values.ndim == 1:
+        values = values[:, None]
+    n_rows, n_columns = values.shape
+    if n_rows == 0:
+        return ''
+
+    value_format = _value_format(values.dtype, float_format)
+    row_format = delimiter.join([value_format] * n_columns)
+
+    if row_labels is None:
+        flat_values = values.ravel().tolist()
+    else:
+        if len(row_labels) != n_rows:
+            raise ValueError('Got {} row labels for {} rows'.format(len(row_labels), n_rows))
+        row_format = '%s' + delimiter + row_format if n_columns > 0 else '%s'
+        labeled = np.empty((n_rows, n_columns + 1), dtype=object)
+        labeled[:, 0] = list(row_labels)
+        # tolist converts numpy scalars into Python scalars so %r formats them like str()
+        labeled[:, 1:] = values.tolist()
+        flat_values = labeled.ravel().tolist()
+
+    return ((row_format + '\n') * n_rows) % tuple(flat_values)
+
+
+class TsvWriter():
+    def __init__(self, path: str, float_format: Optional[str] = None,
+                 compression: Optional[str] = 'infer', compresslevel: int = 3,
+                 buffer_size: int = BUFFER_SIZE):
+        """
+        Open a file to write tab separated blocks to
+
+        Arguments
+        ---------
+        path: The file to write to
+        float_format: A printf-style format for floats such as '%.6g'. Defaults to the
+                      shortest exact representation, which matches '{}'.format(x)
+        compression: 'bgzip', 'gzip', 'zstd', None, or 'infer' to choose based on the file
+                     extension
+        compresslevel: The compression level to use
+        buffer_size: The number of characters to buffer before passing them to the writer
+        """
+        self.float_format = float_format
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered_chars = 0
+
+        self.out_file = open_output(path, 'wb', compression, compresslevel)
+        self.queue = queue.Queue(maxsize=QUEUE_DEPTH)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def _write_loop(self) -> None:
+        """Write (and compress) buffers from the queue until the sentinel None arrives"""
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self.out_file.write(data)
+            except Exception as e:
+                self.error = e
+
+    def _check_error(self) -> None:
+        if self.error is not None:
+            raise self.error
+
+    def _append(self, text: str) -> None:
+        self.buffer.append(text)
+        self.buffered_chars += len(text)
+        if self.buffered_chars >= self.buffer_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Pass the buffered text to the writer thread"""
+        self._check_error()
+        if len(self.buffer) > 0:
+            self.queue.put(''.join(self.buffer).encode())
+            self.buffer = []
+            self.buffered_chars = 0
+
+    def write_line(self, fields: Sequence[str]) -> None:
+        """
+        Write a single row of strings, such as a header
+
+        Arguments
+        ---------
+        fields: The fields to join with tabs
+        """
+        self._append('\t'.join(str(field) for field in fields) + '\n')
+
+    def write_block(self, values: np.ndarray,
+                    row_labels: Optional[Sequence[str]] = None) -> None:
+        """
+        Format and write a block of rows
+
+        Arguments
+        ---------
+        values: A rows x columns array, or a 1-D array to write one value per row
+        row_labels: An optional label to write at the start of each row
+        """
+        values = np.asarray(values)
+        if values.ndim == 1:
+            values = values[:, None]
+
+        n_columns = max(values.shape[1], 1)
+        rows_per_format = max(1, VALUES_PER_FORMAT // n_columns)
+        for start in range(0, len(values), rows_per_format):
+            end = start + rows_per_format
+            labels = None if row_labels is None else row_labels[start:end]
+            self._append(format_block(values[start:end], labels, self.float_format))
+
+    def close(self) -> None:
+        """Write any buffered text, wait for the writer thread, and close the file"""
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.out_file.close()
+        self._check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
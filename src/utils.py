@@ -1,23 +1,29 @@
-
+import os
 from functools import lru_cache
 from typing import Dict
 
-import biomart
+import pandas as pd
 
+# If this environment variable points to a file, Ensembl mappings are read from it instead of
+# BioMart. The file should be in the format returned by BioMart: tab separated transcript ids,
+# gene symbols, gene ids, and (optionally empty) peptide ids
+MAPPING_FILE_VARIABLE = 'ENSEMBL_MAPPING_FILE'
+# The samples of the NAc, PFC, and VTA experiment are named like day1_cocaine_NAc_rep1
+SAMPLE_NAME_PATTERN = r'^(?P<day>[^_]+)_(?P<treatment>[^_]+)_(?P<region>[^_]+)_(?P<rep>[^_]+)$'
 
-@lru_cache()
-def get_ensembl_mappings() -> Dict[str, str]:
-    # Set up connection to server
-    server = biomart.BiomartServer('http://uswest.ensembl.org/biomart')
-    mart = server.datasets['mmusculus_gene_ensembl']
 
-    # List the types of data we want
-    attributes = ['ensembl_transcript_id', 'mgi_symbol', 'ensembl_gene_id', 'ensembl_peptide_id']
+def parse_ensembl_mappings(data: str) -> Dict[str, str]:
+    """
+    Parse the BioMart output mapping Ensembl ids to gene symbols
 
-    # Get the mapping between the attributes
-    response = mart.search({'attributes': attributes})
-    data = response.raw.data.decode('ascii')
+    Arguments
+    ---------
+    data: The tab separated text returned by BioMart
 
+    Returns
+    -------
+    ensembl_to_genesymbol: A dict mapping Ensembl transcript, gene, and peptide ids to symbols
+    """
     ensembl_to_genesymbol = {}
     # Store the data in a dict
     for line in data.splitlines():
@@ -33,3 +39,48 @@ def get_ensembl_mappings() -> Dict[str, str]:
             ensembl_to_genesymbol[ensembl_peptide] = gene_symbol
 
     return ensembl_to_genesymbol
+
+
+@lru_cache()
+def get_ensembl_mappings() -> Dict[str, str]:
+    mapping_file = os.environ.get(MAPPING_FILE_VARIABLE)
+    if mapping_file is not None:
+        with open(mapping_file) as in_file:
+            return parse_ensembl_mappings(in_file.read())
+
+    # Only import biomart when it's needed so runs from a mapping file work offline
+    import biomart
+
+    # Set up connection to server
+    server = biomart.BiomartServer('http://uswest.ensembl.org/biomart')
+    mart = server.datasets['mmusculus_gene_ensembl']
+
+    # List the types of data we want
+    attributes = ['ensembl_transcript_id', 'mgi_symbol', 'ensembl_gene_id', 'ensembl_peptide_id']
+
+    # Get the mapping between the attributes
+    response = mart.search({'attributes': attributes})
+    data = response.raw.data.decode('ascii')
+
+    return parse_ensembl_mappings(data)
+
+
+def parse_sample_names(samples: pd.Index, pattern: str = SAMPLE_NAME_PATTERN) -> pd.DataFrame:
+    """
+    Split sample names into fields using a regular expression with named groups
+
+    Arguments
+    ---------
+    samples: The names of the samples to parse
+    pattern: A regular expression with one named group per field
+
+    Returns
+    -------
+    fields: A dataframe with one row per sample and one column per named group
+    """
+    fields = samples.to_series().str.extract(pattern)
+    unmatched = fields.isna().all(axis='columns')
+    if unmatched.any():
+        raise ValueError('Sample names {} do not match the pattern {}'.format(
+                         list(samples[unmatched.to_numpy()]), pattern))
+    return fields